@@ -1,8 +1,22 @@
 import pygame, time, math
+import os
+import sys
+import glob
+import threading
+import queue
+from collections import namedtuple
+import numpy as np
 from mathfx import sind, cosd
+from scheduler import waitUntil, NS_PER_S
+import tracing
 
 pygame.init()
 pygame.joystick.init()
+
+# SDL reads the joystick when its events are pumped. On Linux and Windows that can happen in
+# the polling thread; macOS only allows it on the main thread, where the GUI has to pump.
+# Set COIL_JOYSTICK_MAIN_PUMP=1 to pump on the main thread on every platform.
+MAIN_THREAD_PUMP = sys.platform == 'darwin' or os.environ.get('COIL_JOYSTICK_MAIN_PUMP') == '1'
 # joystick = pygame.joystick.Joystick(0)
 # joystick.init()
  
@@ -12,7 +26,27 @@ If you see one solid indicator light, it is on.
 If you see four lights blinking it is off.
 '''
 
-class DualShock(object):
+#=============================================================================================
+# State of the controller at one instant. Snapshots are never modified after they are made,
+# so they can be passed between threads without locking.
+#   t        time.perf_counter_ns() of the poll that produced the state
+#   axes     read-only float32 array, one value per axis
+#   buttons  read-only bool array, one value per button
+#=============================================================================================
+JoystickState = namedtuple('JoystickState', ['t', 'axes', 'buttons'])
+
+# A button was pressed or released. *state* is the snapshot in which the change was seen.
+ButtonEvent = namedtuple('ButtonEvent', ['t', 'button', 'pressed', 'state'])
+
+def readOnly(array):
+    array.setflags(write=False)
+    return array
+
+#=============================================================================================
+# Everything that is computed from the state. Subclasses provide state() and the event queue.
+# The helpers take an optional snapshot so that several values can be read from the same one.
+#=============================================================================================
+class Gamepad(object):
 
     KEY = {
         'CROSS': 0,
@@ -38,41 +72,114 @@ class DualShock(object):
         'R2': 5
     }
 
-    def __init__(self):
-        self._name = joystick.get_name()
-        self._numAxes = joystick.get_numaxes()
-        self._numButtons = joystick.get_numbuttons()
-        self.axis_data = {}
-        self.button_data = {}
-        for i in range(self._numAxes): self.axis_data[i] = 0.0
-        self.axis_data[2] = -1.0
-        self.axis_data[5] = -1.0
-        for i in range(self._numButtons): self.button_data[i] = False
-        self.showInfo()
+    def __init__(self,numAxes,numButtons,eventQueueSize=256):
+        self.events = queue.Queue(maxsize=eventQueueSize)
+        self.droppedEvents = 0
+        self.recorder = None # JoystickRecorder that receives every new state
+        axes = np.zeros(numAxes,dtype=np.float32)
+        axes[[i for i in (2, 5) if i < numAxes]] = -1.0 # L2 and R2 released
+        self._state = JoystickState(time.perf_counter_ns(), readOnly(axes), readOnly(np.zeros(numButtons,dtype=bool)))
+        self._thread = None
+        self._stopped = False
+        self.mainThreadPump = False # True if the owner must call pump() on the main thread
+
+    def state(self):
+        return self._state
+
+    def publish(self,t,axes,buttons):
+        ''' Make (axes, buttons) the current state if it differs from the last one, and queue the button edges '''
+        previous = self._state
+        if np.array_equal(axes,previous.axes) and np.array_equal(buttons,previous.buttons):
+            return
+        state = JoystickState(t, readOnly(axes), readOnly(buttons))
+        self._state = state # replaced as a whole
+        for button in np.flatnonzero(buttons != previous.buttons):
+            self.pushEvent(ButtonEvent(t, int(button), bool(buttons[button]), state))
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(state)
+
+    #==============================================================================================
+    # Background thread that runs self._run() until stop()
+    #==============================================================================================
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
     def quit(self):
-        pygame.joystick.quit()
-        pygame.quit()
+        self.stop()
+        self.stopRecording()
 
-    def update(self):
-        for event in pygame.event.get():
-            if event.type == pygame.JOYAXISMOTION:
-                self.axis_data[event.axis] = round(event.value,2)
-            elif event.type == pygame.JOYBUTTONDOWN:
-                self.button_data[event.button] = True
-            elif event.type == pygame.JOYBUTTONUP:
-                self.button_data[event.button] = False
-
-    def isPressed(self,keycode):
-        return self.button_data[self.KEY[keycode]]
-
-    def getAngleLeft(self):
-        rad = math.atan2(-self.axis_data[1],self.axis_data[0])
+    def pump(self):
+        ''' Process the events of the input driver on the main (GUI) thread, if mainThreadPump is set '''
+        pass
+
+    #==============================================================================================
+    # Called by the consumer (e.g. SubThread.tianqiGripper): begin() when it starts,
+    # advance(t) once per iteration with its own clock t (s since begin()).
+    # A live controller only drops the button presses from before begin().
+    #==============================================================================================
+    def begin(self):
+        self.clearEvents()
+
+    def advance(self,t):
+        pass
+
+    #==============================================================================================
+    # Record the states to a file that JoystickPlayback can play
+    #==============================================================================================
+    def startRecording(self,path):
+        self.recorder = JoystickRecorder(path,self._state)
+
+    def stopRecording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    #==============================================================================================
+    # Button edges, oldest first
+    #==============================================================================================
+    def pushEvent(self,event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.droppedEvents += 1
+
+    def getEvents(self):
+        ''' Return the button events since the last call, without waiting '''
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def clearEvents(self):
+        self.getEvents()
+
+    #==============================================================================================
+    # Helpers
+    #==============================================================================================
+    def isPressed(self,keycode,state=None):
+        state = state or self.state()
+        return bool(state.buttons[self.KEY[keycode]])
+
+    def getAngleLeft(self,state=None):
+        axes = (state or self.state()).axes
+        rad = math.atan2(-axes[1],axes[0])
         return math.degrees(rad)
 
-    def getTiltLeft(self):
-        azimuth = abs(self.getAngleLeft())
-        magnitude = self.getMagniudeLeft()
+    def getTiltLeft(self,state=None):
+        state = state or self.state()
+        azimuth = abs(self.getAngleLeft(state))
+        magnitude = self.getMagniudeLeft(state)
         if magnitude == 0:
             return 90
         if azimuth < 45:
@@ -83,22 +190,25 @@ class DualShock(object):
             magnitudeMax = 1 / cosd(azimuth-90)
         elif azimuth <= 180:
             magnitudeMax = 1 / cosd(180-azimuth)
-        ratio = self.getMagniudeLeft() / magnitudeMax
+        ratio = magnitude / magnitudeMax
         if ratio > 1: ratio = 1
         return math.degrees(math.acos(ratio))
 
-    def getMagniudeLeft(self):
-        return math.sqrt(self.axis_data[0]**2 + self.axis_data[1]**2)
+    def getMagniudeLeft(self,state=None):
+        axes = (state or self.state()).axes
+        return math.sqrt(axes[0]**2 + axes[1]**2)
 
-    def getAngleRight(self):
-        rad = math.atan2(-self.axis_data[4],self.axis_data[3])
+    def getAngleRight(self,state=None):
+        axes = (state or self.state()).axes
+        rad = math.atan2(-axes[4],axes[3])
         return math.degrees(rad)
 
-    def getMagniudeRight(self):
-        return math.sqrt(self.axis_data[3]**2 + self.axis_data[4]**2)
+    def getMagniudeRight(self,state=None):
+        axes = (state or self.state()).axes
+        return math.sqrt(axes[3]**2 + axes[4]**2)
 
-    def getStick(self,index):
-        raw = self.axis_data[index]
+    def getStick(self,index,state=None):
+        raw = float((state or self.state()).axes[index])
         if index == 1 or index == 4: # leftY or rightY
             return -raw
         elif index == 0 or index == 3: # leftX or rightX
@@ -108,6 +218,74 @@ class DualShock(object):
         else:
             return raw * 0.5 + 0.5 # map the value to 0(released)-1(pressed)
 
+#=============================================================================================
+# PS3 controller read with pygame.
+# start() pumps the SDL events and reads the state in a separate thread at a fixed rate and
+# publishes the changes, so the latency does not depend on the GUI. Where SDL must be pumped
+# on the main thread (MAIN_THREAD_PUMP) the thread only reads, and the GUI calls pump() from
+# a QTimer; the stick latency is then up to the pump interval plus the time the GUI thread is
+# busy. The intervals between pumps are traced as 'joystick.pump' either way.
+# update() pumps and reads once, for use on the main thread without the thread.
+#=============================================================================================
+class DualShock(Gamepad):
+
+    def __init__(self,index=0):
+        self.joystick = pygame.joystick.Joystick(index)
+        self.joystick.init()
+        self._name = self.joystick.get_name()
+        self._numAxes = self.joystick.get_numaxes()
+        self._numButtons = self.joystick.get_numbuttons()
+        super(DualShock, self).__init__(self._numAxes,self._numButtons)
+        self.rate = 0
+        self.polls = 0
+        self.mainThreadPump = MAIN_THREAD_PUMP
+        self._lastPump = None
+        self.showInfo()
+
+    def quit(self):
+        super(DualShock, self).quit()
+        pygame.joystick.quit()
+        pygame.quit()
+
+    def pump(self):
+        pygame.event.pump()
+        now = time.perf_counter_ns()
+        if self._lastPump is not None:
+            tracing.recordDuration('joystick.pump', now - self._lastPump)
+        self._lastPump = now
+
+    def update(self):
+        self.pump()
+        self.read()
+
+    def read(self):
+        ''' Publish the state of the last pump(). Safe to call from any thread. '''
+        now = time.perf_counter_ns()
+        axes = np.round([self.joystick.get_axis(i) for i in range(self._numAxes)],2).astype(np.float32)
+        buttons = np.array([self.joystick.get_button(i) for i in range(self._numButtons)],dtype=bool)
+        self.polls += 1
+        self.publish(now,axes,buttons)
+
+    #==============================================================================================
+    # Polling thread
+    #==============================================================================================
+    def start(self,rate=500):
+        self.rate = rate
+        super(DualShock, self).start()
+
+    def _run(self):
+        period = int(NS_PER_S / self.rate)
+        deadline = time.perf_counter_ns()
+        while not self._stopped:
+            if not self.mainThreadPump:
+                self.pump()
+            self.read()
+            deadline += period
+            now = time.perf_counter_ns()
+            if now > deadline:
+                deadline = now # do not try to catch up
+            waitUntil(deadline)
+
     def showInfo(self):
         print("===========================================")
         print('Name: {}'.format(self._name))
@@ -115,17 +293,191 @@ class DualShock(object):
         print('Buttons: {}'.format(self._numButtons))
         print("===========================================")
 
+#=============================================================================================
+# Recording and playback
+# A recording is a directory of chunk files joystick_00000.npz, ... with the arrays
+#   t        int64 (N,)      time.perf_counter_ns() of each state
+#   axes     float32 (N, A)
+#   buttons  bool (N, B)
+# Only the states that differ from the previous one are stored. loadRecording() joins the
+# chunks and makes t start at 0.
+#=============================================================================================
+RECORD_CHUNK_ROWS = 4096 # states per chunk file, about 8 s at 500 Hz
+
+class JoystickRecorder(object):
+    '''
+    The states go into preallocated arrays. Each full chunk is handed to a writer thread that
+    saves it, so a long session needs constant memory and a crash loses at most one chunk.
+    '''
+    def __init__(self,path,initialState,chunkRows=RECORD_CHUNK_ROWS):
+        self.path = path
+        self.chunkRows = chunkRows
+        self.numAxes = len(initialState.axes)
+        self.numButtons = len(initialState.buttons)
+        self.states = 0
+        self.chunks = 0
+        self._lock = threading.Lock() # record() and close() may run in different threads
+        self._closed = False
+        self._queue = queue.Queue()
+        os.makedirs(path,exist_ok=True)
+        self._thread = threading.Thread(target=self._writeLoop,daemon=True)
+        self._thread.start()
+        self._newChunk()
+        self.record(initialState)
+
+    def _newChunk(self):
+        self._t = np.empty(self.chunkRows,dtype=np.int64)
+        self._axes = np.empty((self.chunkRows,self.numAxes),dtype=np.float32)
+        self._buttons = np.empty((self.chunkRows,self.numButtons),dtype=bool)
+        self._fill = 0
+
+    def _queueChunk(self):
+        if self._fill:
+            self._queue.put((self._t[:self._fill], self._axes[:self._fill], self._buttons[:self._fill]))
+        self._newChunk()
+
+    def record(self,state):
+        with self._lock:
+            if self._closed:
+                return
+            i = self._fill
+            self._t[i] = state.t
+            self._axes[i] = state.axes
+            self._buttons[i] = state.buttons
+            self._fill += 1
+            self.states += 1
+            if self._fill == self.chunkRows:
+                self._queueChunk()
+
+    def close(self):
+        ''' Write the last chunk and wait for the writer '''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queueChunk()
+        self._queue.put(None)
+        self._thread.join()
+        print('Joystick: {} states recorded to {} in {} files'.format(self.states,self.path,self.chunks))
+
+    def _writeLoop(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            t, axes, buttons = chunk
+            np.savez(os.path.join(self.path,'joystick_{:05d}.npz'.format(self.chunks)),t=t,axes=axes,buttons=buttons)
+            self.chunks += 1
+
+def loadRecording(path):
+    ''' Return (t, axes, buttons) of the recording in the directory *path*, t in ns from the first state '''
+    files = sorted(glob.glob(os.path.join(path,'joystick_*.npz')))
+    if not files:
+        raise IOError('Joystick: no recording in {}'.format(path))
+    parts = [np.load(f) for f in files]
+    t = np.concatenate([p['t'] for p in parts])
+    return t - t[0], np.concatenate([p['axes'] for p in parts]), np.concatenate([p['buttons'] for p in parts])
+
+class JoystickPlayback(Gamepad):
+    '''
+    Plays a recording with the same interface as DualShock, e.g. to repeat a session of
+    tianqiGripper with the simulated DAC. The playback runs on the clock of the consumer:
+    begin() rewinds to the first state, and advance(t) publishes every state recorded up to
+    t * rateScale after it, with the same button events. The same consumer times therefore
+    always see the same states, independent of the thread timing.
+    '''
+    def __init__(self,path,rateScale=1.0,loop=False):
+        self.t, self.axes, self.buttons = loadRecording(path)
+        super(JoystickPlayback, self).__init__(self.axes.shape[1],self.buttons.shape[1])
+        self.rateScale = rateScale
+        self.loop = loop
+        self.finished = threading.Event() # set when advance() has played the last state
+        self.publishTimes = [] # time at which each state was played
+        self.begin()
+
+    def duration(self):
+        return self.t[-1] / NS_PER_S
+
+    def begin(self):
+        self.clearEvents()
+        self._state = JoystickState(time.perf_counter_ns(), readOnly(self.axes[0].copy()), readOnly(self.buttons[0].copy()))
+        self._next = 1 # the first state is the one the recording started in; it has no events
+        self._offset = 0 # recording time of the current pass (ns), for loop
+        self.publishTimes = []
+        self.finished.clear()
+
+    def advance(self,t):
+        recorded = int(t * NS_PER_S * self.rateScale)
+        while True:
+            if self._next == len(self.t):
+                if not self.loop or self.t[-1] == 0:
+                    self.finished.set()
+                    return
+                self._offset += int(self.t[-1])
+                self._next = 0
+            if self._offset + self.t[self._next] > recorded:
+                return
+            now = time.perf_counter_ns()
+            self.publish(now,self.axes[self._next].copy(),self.buttons[self._next].copy())
+            self.publishTimes.append(now)
+            self._next += 1
+
+    def start(self):
+        pass # driven by advance()
+
 if __name__ == "__main__":
-    ''' Run this script directly for testing '''
+    '''
+    Run this script directly for testing
+        python PS3Controller.py                     print the state and the button events
+        python PS3Controller.py record session      record to the directory session until Ctrl+C
+        python PS3Controller.py play session        run tianqiGripper with the recording on the
+                                                    simulated DAC and report rate and latency
+    '''
+    import sys
     import time
-  
-    j = DualShock()
-    while True:
-        j.update()
-        print(j.axis_data)
-         
-
 
+    if len(sys.argv) > 2 and sys.argv[1] == 'play':
+        from fieldManager import FieldManager
+        from simS826 import SimulatedS826
+        from subThread import SubThread
 
-        print(j.button_data)
-        time.sleep(0.1)
+        j = JoystickPlayback(sys.argv[2])
+        dac = SimulatedS826()
+        thrd = SubThread(FieldManager(dac),None,None,None,j)
+        thrd.setup('tianqiGripper')
+        thrd.params = [0,15,0.5,0,0]
+        thrd.statusSignal.connect(print)
+        worker = threading.Thread(target=thrd.run)
+        dac.sim.reset()
+        worker.start()
+        j.finished.wait() # played by tianqiGripper on its own clock
+        thrd.stop()
+        worker.join()
+        j.quit()
+        print(dac.sim.report())
+        # time from each played state to the first DAC write after it
+        timestamps = dac.sim.records()[0]
+        published = np.array(j.publishTimes,dtype=np.int64)
+        after = np.searchsorted(timestamps,published)
+        latency = timestamps[after[after < len(timestamps)]] - published[after < len(timestamps)]
+        if len(latency):
+            print('{} states played in {:.1f} s, latency to DAC p50/p99/max {:.1f}/{:.1f}/{:.1f} us'.format(
+                len(published), j.duration(), *[v / 1e3 for v in np.percentile(latency,[50,99,100])]))
+    else:
+        j = DualShock()
+        if len(sys.argv) > 2 and sys.argv[1] == 'record':
+            j.startRecording(sys.argv[2])
+        j.start()
+        try:
+            nextPrint = time.perf_counter()
+            while True:
+                if j.mainThreadPump:
+                    j.pump() # on the main thread, like the QTimer of the GUI
+                if time.perf_counter() >= nextPrint:
+                    state = j.state()
+                    print(state.axes)
+                    print(state.buttons, j.getEvents())
+                    nextPrint += 0.1
+                time.sleep(0.002)
+        except KeyboardInterrupt:
+            j.quit()
@@ -7,6 +7,7 @@ pip3 install opencv-contrib-python
 pip3 install numpy
 pip3 install matplotlib
 pip3 install pyqt5
+pip3 install pygame
 apt-get install qttools5-dev-tools
 apt-get install coriander
 
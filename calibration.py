@@ -0,0 +1,124 @@
+"""
+=============================================================================
+calibration.py
+----------------------------------------------------------------------------
+Mapping from magnetic field to DAC setpoints.
+The calibration of the coils is kept in data/calibration.json:
+    {
+     "coils": {
+      "X1": {"channel": 5, "mTPerVolt": 4.433, "field": [1, 0, 0], "offsetV": 0, "maxV": null},
+      ...
+     }
+    }
+    channel    DAC channel of the coil
+    mTPerVolt  field of the coil per volt of DAC output
+    field      value of the coil (mT) per mT of field x, y, z. Cross terms can be used
+               to compensate coupling between the axes. Default: 1 for the axis of the coil.
+    offsetV    DAC output for a coil value of 0 (optional)
+    maxV       limit of |output - offsetV| (optional). The DAC range is always a limit.
+If the file does not exist the built-in values below are used.
+
+Calibration.compile(dac) folds all of this and the DAC ranges into one
+affine map per input type, so a batch of samples (N,3) or (N,6) is converted
+to setpoints (N,6) with one matmul, one add and one clip.
+=============================================================================
+"""
+import os
+import json
+import numpy as np
+from s826 import SETPOINT_MAX
+
+CALIBRATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'calibration.json')
+COILS = ['X1', 'X2', 'Y1', 'Y2', 'Z1', 'Z2'] # order of the setpoints everywhere
+AXES = {'X': [1, 0, 0], 'Y': [0, 1, 0], 'Z': [0, 0, 1]}
+
+# pin number, factor number (mT/V)
+DEFAULT_COILS = {
+    'X1': {'channel': 5, 'mTPerVolt': 4.433},
+    'X2': {'channel': 1, 'mTPerVolt': 5.024},
+    'Y1': {'channel': 2, 'mTPerVolt': 5.224},
+    'Y2': {'channel': 6, 'mTPerVolt': 5.224},
+    'Z1': {'channel': 3, 'mTPerVolt': 4.879},
+    'Z2': {'channel': 7, 'mTPerVolt': 5.000},
+}
+
+class Calibration(object):
+    def __init__(self,coils=None,path=None):
+        '''
+        @param coils: dict coil name -> dict of the keys described above
+        @param path: file the calibration was loaded from, for messages
+        '''
+        coils = coils or DEFAULT_COILS
+        missing = [name for name in COILS if name not in coils]
+        if missing:
+            raise ValueError('calibration: coils {} are missing'.format(', '.join(missing)))
+        self.path = path
+        self.coils = {}
+        for name in COILS:
+            coil = dict(coils[name])
+            coil.setdefault('field', AXES[name[0]])
+            coil.setdefault('offsetV', 0.0)
+            coil.setdefault('maxV', None)
+            self.coils[name] = coil
+        self.channels = np.array([self.coils[name]['channel'] for name in COILS])
+        self.mTPerVolt = np.array([self.coils[name]['mTPerVolt'] for name in COILS],dtype=float)
+        self.fieldGain = np.array([self.coils[name]['field'] for name in COILS],dtype=float) # (6,3)
+        self.offsetV = np.array([self.coils[name]['offsetV'] for name in COILS],dtype=float)
+        self.maxV = np.array([np.inf if self.coils[name]['maxV'] is None else self.coils[name]['maxV'] for name in COILS])
+
+    def save(self,path=CALIBRATION_PATH):
+        with open(path + '.tmp','w') as f:
+            json.dump({'coils': self.coils},f,indent=1)
+        os.replace(path + '.tmp',path)
+
+    def compile(self,dac):
+        ''' Return the CoilMap of this calibration for the current ranges of *dac* '''
+        return CoilMap(self,dac.lowerV[self.channels],dac.rangeV[self.channels])
+
+def load(path=CALIBRATION_PATH):
+    if not os.path.exists(path):
+        print('calibration: {} not found, using the built-in calibration'.format(path))
+        return Calibration()
+    with open(path) as f:
+        return Calibration(json.load(f)['coils'],path)
+
+#=============================================================================================
+# Compiled calibration
+#   setpoints = clip(values @ matrix.T + offset, lower, upper)
+# fieldMatrix (6,3) converts the field x, y, z; coilMatrix (6,6) the per-coil values.
+# Setpoints are truncated like S826.s826_aoPin does. Recompile after changing the DAC ranges.
+#=============================================================================================
+class CoilMap(object):
+    def __init__(self,calibration,lowerV,rangeV):
+        self.channels = calibration.channels
+        scale = SETPOINT_MAX / rangeV # setpoints per volt
+        self.coilMatrix = np.diag(scale / calibration.mTPerVolt)
+        self.fieldMatrix = self.coilMatrix @ calibration.fieldGain
+        self.offset = (calibration.offsetV - lowerV) * scale
+        self.lower = np.maximum(self.offset - calibration.maxV * scale,0)
+        self.upper = np.minimum(self.offset + calibration.maxV * scale,SETPOINT_MAX)
+        self._key = (calibration.channels.tolist(), calibration.mTPerVolt.tolist(), calibration.fieldGain.tolist(),
+                     calibration.offsetV.tolist(), calibration.maxV.tolist(), lowerV.tolist(), rangeV.tolist())
+
+    def key(self):
+        ''' Everything that affects the conversion, e.g. to key cached waveforms '''
+        return self._key
+
+    def _apply(self,values,matrix):
+        raw = np.asarray(values,dtype=float) @ matrix.T
+        raw += self.offset
+        np.clip(raw,self.lower,self.upper,out=raw)
+        return raw.astype(np.uint16)
+
+    def fieldsToSetpoints(self,fields):
+        ''' fields (...,3) in mT -> setpoints (...,6) '''
+        return self._apply(fields,self.fieldMatrix)
+
+    def coilsToSetpoints(self,coils):
+        ''' per-coil values (...,6) in mT, in the order X1, X2, Y1, Y2, Z1, Z2 -> setpoints (...,6) '''
+        return self._apply(coils,self.coilMatrix)
+
+    def coilSetpoint(self,coil,mT):
+        ''' Setpoint of the coil with index *coil* alone '''
+        raw = mT * self.coilMatrix[coil,coil] + self.offset[coil]
+        return int(min(max(raw,self.lower[coil]),self.upper[coil]))
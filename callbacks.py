@@ -4,24 +4,40 @@ from PyQt5.QtWidgets import QMainWindow, QLabel, QVBoxLayout, QWidget, QGroupBox
 from PyQt5.QtGui import QImage, QPixmap
 from fieldManager import FieldManager
 from s826 import S826
+from simS826 import SimulatedS826
 from subThread import SubThread
 from realTimePlot import CustomFigCanvas
 import syntax
 from vision import Vision
-from pypylon import pylon
 import cv2
 from camera import CameraWindow 
 
+import os
 import time
-from PS3Controller import DualShock
+import tracing
+from telemetry import TelemetryRecorder
+from PS3Controller import DualShock, JoystickPlayback
 
 import pygame
 
 pygame.joystick.init()
 
+#=========================================================
+# Set COIL_JOYSTICK_PLAYBACK=<directory> to replay a recorded session instead of the controller,
+# and COIL_JOYSTICK_RECORD=<directory> to record the controller until the GUI is closed
+#=========================================================
+JOYSTICK_PLAYBACK = os.environ.get('COIL_JOYSTICK_PLAYBACK')
+JOYSTICK_RECORD = os.environ.get('COIL_JOYSTICK_RECORD')
+
 try:
-    if pygame.joystick.get_count() > 0:
+    if JOYSTICK_PLAYBACK:
+        joystick = JoystickPlayback(JOYSTICK_PLAYBACK) # played from the start each time tianqiGripper starts
+        print("✅ Joystick playback of {} ({:.1f} s).".format(JOYSTICK_PLAYBACK, joystick.duration()))
+    elif pygame.joystick.get_count() > 0:
         joystick = DualShock()
+        if JOYSTICK_RECORD:
+            joystick.startRecording(JOYSTICK_RECORD)
+        joystick.start(rate=500) # read in its own thread
         print("✅ Joystick initialized.")
     else:
         raise Exception("No joystick detected")
@@ -38,8 +54,14 @@ Ui_MainWindow, QtBaseClass = uic.loadUiType(qtCreatorFile)
 
 #=========================================================
 # Creating instances of fieldManager
+# Set COIL_DAC_BACKEND=simulated to run without the s826 board
 #=========================================================
-field = FieldManager(S826())
+DAC_BACKEND = os.environ.get('COIL_DAC_BACKEND', 's826')
+if DAC_BACKEND == 'simulated':
+    dac = SimulatedS826()
+else:
+    dac = S826()
+field = FieldManager(dac)
 
 
 vision1 = Vision(index=1, type='usb')
@@ -51,6 +73,15 @@ vision3 = Vision(index=3, type='usb')
 # a class that handles the signal and callbacks of the GUI
 #=========================================================
 ENABLE_CAMERA=False
+TRACING_UPDATE_RATE = 500 # msec, refresh of the Tracing tab
+JOYSTICK_PUMP_INTERVAL = 2 # msec, SDL events of the joystick are pumped on the GUI thread where the platform requires it
+TRACING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tracing')
+# Set COIL_TELEMETRY=1 to log every field command of the session to data/telemetry/session_<time>/
+# (read it with telemetry.load()). Off by default.
+TELEMETRY = os.environ.get('COIL_TELEMETRY', '0') == '1'
+TELEMETRY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'telemetry')
+# Raw capture writes every camera frame to data/raw/<time>/cam<id>/ (frameStore.py, replay.py)
+RAW_CAPTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'raw')
 
 class GUI(QMainWindow, Ui_MainWindow):
     def __init__(self):
@@ -59,6 +90,7 @@ class GUI(QMainWindow, Ui_MainWindow):
         self.updateRate = 10  
         self.setupUi(self)
         self.setupTimer()
+        self.setupTelemetry()
 
         self.setupSubThread(field, vision1, vision2, vision3, joystick)
         self.setupRealTimePlot()
@@ -66,7 +98,7 @@ class GUI(QMainWindow, Ui_MainWindow):
         self.linkWidgets()
         self._closing = False 
         if ENABLE_CAMERA:
-            self.camera_window = CameraWindow(field)
+            self.camera_window = CameraWindow(field, [vision1, vision2, vision3])
             self.camera_window.show()  # 默认显示摄像头窗口
 
         self.cbb_subThread.clear()
@@ -82,12 +114,19 @@ class GUI(QMainWindow, Ui_MainWindow):
 
         self.thrd.stop()
         self.timer.stop()
+        self.tracingTimer.stop()
+        self.joystickTimer.stop()
+        self.chb_rawCapture.setChecked(False) # closes the frame stores
         if ENABLE_CAMERA:
             self.camera_window.close()
 
         if joystick:
             joystick.quit()
 
+        if self.telemetry:
+            field.setTelemetry(None)
+            self.telemetry.stop()
+
         cv2.destroyAllWindows()
 
         event.accept()
@@ -96,6 +135,17 @@ class GUI(QMainWindow, Ui_MainWindow):
 
 
 
+    #=====================================================
+    # Telemetry of the field commands of the GUI and of all modes
+    #=====================================================
+    def setupTelemetry(self):
+        self.telemetry = None
+        if TELEMETRY:
+            name = 'session_{}'.format(time.strftime('%Y%m%d_%H%M%S'))
+            self.telemetry = TelemetryRecorder(os.path.join(TELEMETRY_DIR, name), poseSource=vision1)
+            self.telemetry.start()
+            field.setTelemetry(self.telemetry)
+
     #=====================================================
     # QTimer handles updates of the GUI
     #=====================================================
@@ -103,6 +153,13 @@ class GUI(QMainWindow, Ui_MainWindow):
         self.timer = QTimer()
         self.timer.timeout.connect(self.update)
         self.timer.start(self.updateRate)  # msec
+        self.tracingTimer = QTimer()
+        self.tracingTimer.timeout.connect(self.updateTracing)
+        self.tracingTimer.start(TRACING_UPDATE_RATE)  # msec
+        self.joystickTimer = QTimer()
+        if joystick and joystick.mainThreadPump:
+            self.joystickTimer.timeout.connect(joystick.pump)
+            self.joystickTimer.start(JOYSTICK_PUMP_INTERVAL)  # msec
         # print(f"✅ Timer started with update rate {self.updateRate}ms")
      
 
@@ -111,10 +168,6 @@ class GUI(QMainWindow, Ui_MainWindow):
         vision2.updateFrame()
         vision3.updateFrame() 
 
-   
-        if joystick:
-            joystick.update()
-     
 
         try:
             self.realTimePlot
@@ -143,10 +196,16 @@ class GUI(QMainWindow, Ui_MainWindow):
         self.chb_bypassFilters.toggled.connect(self.on_chb_bypassFilters)
         self.btn_refreshFilterRouting.clicked.connect(self.on_btn_refreshFilterRouting)
         self.btn_snapshot.clicked.connect(self.on_btn_snapshot)
+        self.cbb_snapshotFormat.currentTextChanged.connect(self.on_cbb_snapshotFormat)
+        self.chb_rawCapture.toggled.connect(self.on_chb_rawCapture)
 
         # object detection
         self.chb_objectDetection.toggled.connect(self.on_chb_objectDetection)
 
+        # Tracing Tab
+        self.btn_dumpTracing.clicked.connect(self.on_btn_dumpTracing)
+        self.btn_resetTracing.clicked.connect(self.on_btn_resetTracing)
+
         # Subthread Tab
         self.cbb_subThread.currentTextChanged.connect(self.on_cbb_subThread)
         self.chb_startStopSubthread.toggled.connect(self.on_chb_startStopSubthread)
@@ -155,6 +214,8 @@ class GUI(QMainWindow, Ui_MainWindow):
         self.dsb_subThreadParam2.valueChanged.connect(self.thrd.setParam2)
         self.dsb_subThreadParam3.valueChanged.connect(self.thrd.setParam3)
         self.dsb_subThreadParam4.valueChanged.connect(self.thrd.setParam4)
+        self.spb_updateRate.setValue(self.thrd.updateRate)
+        self.spb_updateRate.valueChanged.connect(self.thrd.setUpdateRate)
 
     #=====================================================
     # Link GUI elements
@@ -209,9 +270,8 @@ class GUI(QMainWindow, Ui_MainWindow):
  
 
     def updatePlot(self):
-        self.realTimePlot.addDataX(field.x)
-        self.realTimePlot.addDataY(field.y)
-        self.realTimePlot.addDataZ(field.z)
+        state = field.state # x, y, z of the same command
+        self.realTimePlot.addData(time.perf_counter(), state.x, state.y, state.z)
   
 
     #=====================================================
@@ -248,9 +308,13 @@ class GUI(QMainWindow, Ui_MainWindow):
 
     def on_btn_refreshFilterRouting(self):
 
+        # timing of the routing that is replaced
+        for vision in [vision1, vision2, vision3]:
+            if vision.filterRouting:
+                print(vision.filterTimingReport())
         # filter_text = self.editor_vision.toPlainText().splitlines()
         vision1.createFilterRouting(self.editor_vision.toPlainText().splitlines())
-        vision2.createFilterRouosc_sinting(self.editor_vision.toPlainText().splitlines())
+        vision2.createFilterRouting(self.editor_vision.toPlainText().splitlines())
         vision3.createFilterRouting(self.editor_vision.toPlainText().splitlines())
 
 
@@ -260,6 +324,23 @@ class GUI(QMainWindow, Ui_MainWindow):
         vision2.setStateSnapshotEnabled(True)
         vision3.setStateSnapshotEnabled(True)
 
+    def on_cbb_snapshotFormat(self, fileFormat):
+        # png is viewable, npy is the raw array and the fastest to write
+        vision1.setSnapshotFormat(fileFormat)
+        vision2.setSnapshotFormat(fileFormat)
+        vision3.setSnapshotFormat(fileFormat)
+
+    def on_chb_rawCapture(self, state):
+        if state:
+            # a new directory for every capture, an old one is never overwritten
+            directory = os.path.join(RAW_CAPTURE_DIR, time.strftime('%Y%m%d_%H%M%S'))
+            for i, vision in enumerate([vision1, vision2, vision3], 1):
+                vision.startRawCapture(os.path.join(directory, 'cam{}'.format(i)))
+        else:
+            vision1.stopRawCapture()
+            vision2.stopRawCapture()
+            vision3.stopRawCapture()
+
 
     def on_chb_objectDetection(self, state):
 
@@ -270,6 +351,23 @@ class GUI(QMainWindow, Ui_MainWindow):
 
         self.cbb_objectDetectionAlgorithm.setEnabled(not state)
 
+    # tracing tab
+    def updateTracing(self):
+        if self.tabWidget.currentWidget() is self.tab_tracing:
+            # skew: time from the first to the last channel of the recent six-coil writes
+            skew = 'DAC skew p50/p99/max {:.1f}/{:.1f}/{:.1f} us'.format(*[v / 1e3 for v in field.skewStats()])
+            self.txt_tracing.setPlainText(tracing.tracer.report() + '\n' + skew)
+
+    def on_btn_dumpTracing(self):
+        os.makedirs(TRACING_DIR, exist_ok=True)
+        path = os.path.join(TRACING_DIR, 'tracing_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+        tracing.tracer.dump(path)
+        print('✅ tracing: {}'.format(path))
+
+    def on_btn_resetTracing(self):
+        tracing.tracer.reset()
+        self.txt_tracing.clear()
+
     # subthread
     def on_cbb_subThread(self,subThreadName):
         # an array that stores the name for params. Return param0, param1, ... if not defined.
@@ -292,9 +390,11 @@ class GUI(QMainWindow, Ui_MainWindow):
         subThreadName = self.cbb_subThread.currentText()
         if state:
             self.cbb_subThread.setEnabled(False)
+            self.spb_updateRate.setEnabled(False) # taken when the mode starts
             self.thrd.setup(subThreadName)
             self.thrd.start()
             print('Subthread "{}" starts.'.format(subThreadName))
         else:
             self.cbb_subThread.setEnabled(True)
+            self.spb_updateRate.setEnabled(True)
             self.thrd.stop()
\ No newline at end of file
@@ -7,10 +7,91 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
-from vision import CameraThread  
+from vision import CameraThread, VisionWorker
+import tracing
+
+PLOT_INTERVAL = 33 # ms between updates of the field plots
+
+#=============================================================================================
+# 3D view and one 2D projection of the field vector in one figure.
+# The sphere, the axes and the labels are drawn once and kept as a background image;
+# an update only restores the background and draws the two arrows on top (blitting).
+# Everything is drawn in units of the sphere radius (|B| + 5 mT), which gives the same
+# picture as scaling the sphere with the field.
+#=============================================================================================
+class FieldProjection(object):
+    def __init__(self, fig, canvas, title, axes):
+        '''
+        @param axes: indices of the two field components shown in the projection, e.g. (0, 2) for XZ
+        '''
+        self.fig = fig
+        self.canvas = canvas
+        self.axes = axes
+        self.background = None
+        self.lastField = None
+
+        u, v = np.mgrid[0:2 * np.pi:30j, 0:np.pi:15j]
+        ax3d = fig.add_axes([0.05, 0.1, 0.4, 0.8], projection='3d')  # 3D 
+        ax2d = fig.add_axes([0.55, 0.1, 0.4, 0.8])                   # 2D 
+        ax3d.plot_surface(np.cos(u) * np.sin(v), np.sin(u) * np.sin(v), np.cos(v), color='white', alpha=0.2, edgecolor='none')
+        ax3d.quiver(0, 0, 0, 1, 0, 0, color='b', linewidth=1, arrow_length_ratio=0.05)
+        ax3d.quiver(0, 0, 0, 0, 1, 0, color='g', linewidth=1, arrow_length_ratio=0.05)
+        ax3d.quiver(0, 0, 0, 0, 0, 1, color='k', linewidth=1, arrow_length_ratio=0.05)
+        ax3d.text(1, 0, 0, 'X', color='b')
+        ax3d.text(0, 1, 0, 'Y', color='g')
+        ax3d.text(0, 0, 1, 'Z', color='k')
+        ax3d.set_xlim([-1, 1])
+        ax3d.set_ylim([-1, 1])
+        ax3d.set_zlim([-1, 1])
+        ax3d.set_title("XYZ")
+        ax3d.axis('off')
+
+        # 2D 投影图（使用指定投影）
+        ax2d.add_patch(plt.Circle((0, 0), 1, color='r', fill=False))
+        ax2d.set_xlim([-1.8, 1.8])
+        ax2d.set_ylim([-1.8, 1.8])
+        ax2d.set_aspect('equal')
+        ax2d.set_title(title)
+        ax2d.axis('off')
+
+        # animated artists are left out of canvas.draw() and drawn by update()
+        self.arrow3d, = ax3d.plot([0, 0], [0, 0], [0, 0], color='r', linewidth=2, marker='o', markevery=[1], animated=True)
+        self.arrow2d = ax2d.quiver(0, 0, 0, 0, color='r', angles='xy', scale_units='xy', scale=1, animated=True)
+        self.ax3d = ax3d
+        self.ax2d = ax2d
+        canvas.mpl_connect('draw_event', self.onDraw)
+
+    def onDraw(self, event):
+        # the figure was drawn in full (first show, resize, rotation of the 3D view): keep it as the background
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.drawArrows()
+
+    def drawArrows(self):
+        self.ax3d.draw_artist(self.arrow3d)
+        self.ax2d.draw_artist(self.arrow2d)
+
+    def update(self, x, y, z):
+        if (x, y, z) == self.lastField:
+            return
+        self.lastField = (x, y, z)
+        radius = np.linalg.norm([x, y, z]) + 5
+        b = np.array([x, y, z]) / radius
+        self.arrow3d.set_data_3d([0, b[0]], [0, b[1]], [0, b[2]])
+        self.arrow2d.set_UVC(b[self.axes[0]], b[self.axes[1]])
+        if self.background is None:
+            self.canvas.draw_idle() # onDraw() draws the arrows
+            return
+        self.canvas.restore_region(self.background)
+        self.drawArrows()
+        self.canvas.blit(self.fig.bbox)
+
 
 class CameraWindow(QWidget):
-    def __init__(self, field_manager):
+    def __init__(self, field_manager, visions=None):
+        '''
+        @param visions: list of Vision instances, one per camera. If given, the frames of each camera are
+                        processed by its Vision in a VisionWorker thread and the processed frames are shown.
+        '''
         super().__init__()
         self.setWindowTitle("Camera Window")
         self.resize(1600, 900)
@@ -30,7 +111,8 @@ class CameraWindow(QWidget):
 
             label = QLabel(self)
             # label.setFixedSize(1536, 2048)
-            label.setScaledContents(True)  
+            label.setAlignment(Qt.AlignCenter) # frames arrive already scaled by the camera thread
+            label.setMinimumSize(1, 1) # the pixmap must not stop the label from shrinking
             label.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)  
             row_layout.addWidget(label)
 
@@ -52,10 +134,20 @@ class CameraWindow(QWidget):
             self.camThread2 = CameraThread(camera_index=1)
             self.camThread3 = CameraThread(camera_index=2)
 
-            self.camThread1.frame_ready.connect(lambda frame: self.display_frame(self.cameras[0], frame))
-            self.camThread2.frame_ready.connect(lambda frame: self.display_frame(self.cameras[1], frame))
-            self.camThread3.frame_ready.connect(lambda frame: self.display_frame(self.cameras[2], frame))
+            self.camThreads = [self.camThread1, self.camThread2, self.camThread3]
 
+            self.workers = []
+            if visions:
+                self.workers = [VisionWorker(vision, thread) for vision, thread in zip(visions, self.camThreads)]
+            # show the processed frames where there is a worker
+            self.sources = self.workers + self.camThreads[len(self.workers):]
+
+            for label, source in zip(self.cameras, self.sources):
+                source.frame_ready.connect(lambda frameId, label=label, source=source: self.display_frame(label, source))
+            self.updateDisplaySize()
+
+            for worker in self.workers:
+                worker.start()
             self.camThread1.start()
             self.camThread2.start()
             self.camThread3.start()
@@ -64,78 +156,46 @@ class CameraWindow(QWidget):
             print(f"Initializtion failed {e}")
 
 
+        self.projections = [FieldProjection(fig, canvas, title, axes) for fig, canvas, (title, axes) in
+                            zip(self.figures, self.canvases, [("XZ", (0, 2)), ("XY", (0, 1)), ("YZ", (1, 2))])]
+
         self.timer = QTimer()
         self.timer.timeout.connect(self.updateAllPlots)
-        self.timer.start(200) 
+        self.timer.start(PLOT_INTERVAL) 
 
-    def display_frame(self, label, frame):
-     
+    def display_frame(self, label, thread):
+        # several queued signals may arrive for one frame; only the first one gets it
+        frame, info = thread.displayFrames.read()
         if frame is None or frame.size == 0:
             return
-        height, width, channel = frame.shape
-        bytesPerLine = channel * width
-        qtImg = QImage(frame.data, width, height, bytesPerLine, QImage.Format_BGR888)
-        # label.setPixmap(QPixmap.fromImage(qtImg))
-        pixmap = QPixmap.fromImage(qtImg).scaled(
-            label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation
-        )
-        label.setPixmap(pixmap)
-        label.repaint()
-
-    def updateAllPlots(self):
-        x = self.field.x
-        y = self.field.y
-        z = self.field.z
-        vec_norm = np.linalg.norm([x, y, z])
-        radius = vec_norm + 5 if vec_norm > 0 else 15
-
-        u, v = np.mgrid[0:2 * np.pi:30j, 0:np.pi:15j]
-        sx = radius * np.cos(u) * np.sin(v)
-        sy = radius * np.sin(u) * np.sin(v)
-        sz = radius * np.cos(v)
-
-
-        projections = [
-            ("XZ", lambda x, y, z: (x, z)),
-            ("XY", lambda x, y, z: (x, y)),
-            ("YZ", lambda x, y, z: (y, z))
-        ]
-
-        for fig, canvas, (title, project_func) in zip(self.figures, self.canvases, projections):
-            fig.clf()
+        height, width = frame.shape[:2]
+        bytesPerLine = frame.strides[0]
+        imageFormat = QImage.Format_Grayscale8 if frame.ndim == 2 else QImage.Format_BGR888 # filters may return binary images
+        # the buffer is not written by the camera thread until the next read(), and fromImage() copies it
+        qtImg = QImage(frame.data, width, height, bytesPerLine, imageFormat)
+        label.setPixmap(QPixmap.fromImage(qtImg))
+        tracing.record('frame.displayed', info[1])
+
+    def updateDisplaySize(self):
+        try:
+            for label, source in zip(self.cameras, self.sources):
+                source.setDisplaySize(label.width(), label.height())
+        except AttributeError:
+            pass # camera threads were not created
 
-            ax3d = fig.add_axes([0.05, 0.1, 0.4, 0.8], projection='3d')  # 3D 
-            ax2d = fig.add_axes([0.55, 0.1, 0.4, 0.8])                   # 2D 
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.updateDisplaySize()
 
-    
-            ax3d.plot_surface(sx, sy, sz, color='white', alpha=0.2, edgecolor='none')
-            ax3d.quiver(0, 0, 0, x, y, z, color='r', linewidth=2)
-            ax3d.quiver(0, 0, 0, radius, 0, 0, color='b', linewidth=1, arrow_length_ratio=0.05)
-            ax3d.quiver(0, 0, 0, 0, radius, 0, color='g', linewidth=1, arrow_length_ratio=0.05)
-            ax3d.quiver(0, 0, 0, 0, 0, radius, color='k', linewidth=1, arrow_length_ratio=0.05)
-            ax3d.text(radius, 0, 0, 'X', color='b')
-            ax3d.text(0, radius, 0, 'Y', color='g')
-            ax3d.text(0, 0, radius, 'Z', color='k')
-            ax3d.set_xlim([-radius, radius])
-            ax3d.set_ylim([-radius, radius])
-            ax3d.set_zlim([-radius, radius])
-            ax3d.set_title("XYZ")
-            ax3d.axis('off')
-
-            # 2D 投影图（使用指定投影）
-            u2d, v2d = project_func(x, y, z)
-            ax2d.add_patch(plt.Circle((0, 0), radius, color='r', fill=False))
-            ax2d.arrow(0, 0, u2d, v2d, head_width=0.5, head_length=0.5, fc='r', ec='r')
-            ax2d.set_xlim([-radius * 1.8, radius * 1.8])
-            ax2d.set_ylim([-radius * 1.8, radius * 1.8])
-            ax2d.set_aspect('equal')
-            ax2d.set_title(title)
-            ax2d.axis('off')
-
-            canvas.draw()
+    def updateAllPlots(self):
+        state = self.field.state # x, y, z of the same command
+        for projection in self.projections:
+            projection.update(state.x, state.y, state.z)
 
     def closeEvent(self, event):
         try:
+            for worker in self.workers:
+                worker.stop()
             self.camThread1.stop()
             self.camThread2.stop()
             self.camThread3.stop()
@@ -0,0 +1,195 @@
+"""
+=============================================================================
+closedLoop.py
+----------------------------------------------------------------------------
+Building blocks of the closed-loop SubThread modes.
+The control law runs once per new detection: DetectionWaiter blocks until
+a Vision publishes a new agentState and returns the pose of the agent
+fused from all cameras (poseFusion.py). The result of the control law is a
+CarrierCommand (heading, magnitude, frequency), handed over to
+CarrierOutput as one immutable tuple. CarrierOutput generates the rotating
+field on a FixedRateLoop in its own thread, so the field keeps rotating
+smoothly between frames.
+
+The latency from the frame of a pose to the first DAC write with the
+command computed from it is measured for every command. Its recent median
+can be passed to DetectionWaiter.wait() as lookahead, so that the control
+law acts on the predicted position of the agent at the time the field is
+applied instead of the position in the frame.
+
+Both take an optional scheduler.SimulatedClock for offline runs
+(replay.py). The carrier is then stepped by the clock instead of a thread,
+and wait() returns after each frame of the replay.
+=============================================================================
+"""
+import time
+import threading
+from collections import namedtuple
+from math import pi, sin, cos
+import numpy as np
+from mathfx import sind, cosd
+from scheduler import FixedRateLoop
+from vision import detectionCondition
+from poseFusion import PoseFusion
+import tracing
+
+LATENCY_WINDOW = 64 # commands used to estimate the latency to compensate
+
+#=============================================================================================
+# Waits for new detections and fuses them with poseFusion.PoseFusion.
+# The cameras are numbered 1, 2, ... in the order of *visions* (keys of data/cameras.json).
+#=============================================================================================
+class DetectionWaiter(object):
+    def __init__(self,visions,fusion=None,clock=None):
+        self.visions = [(str(i + 1), vision) for i, vision in enumerate(visions) if vision]
+        self.fusion = fusion or PoseFusion()
+        self.clock = clock
+        self.now = clock.now if clock is not None else time.perf_counter_ns
+        self.lastTimestamp = {cameraId: None for cameraId, _ in self.visions}
+
+    def _poll(self):
+        fresh = []
+        for cameraId, vision in self.visions:
+            state = vision.agentState
+            if state[0] is not None and state[0] != self.lastTimestamp[cameraId]:
+                fresh.append((cameraId, state))
+        return fresh
+
+    def wait(self,timeout=None,lookahead=0):
+        '''
+        Return the poseFusion.FusedPose after a new detection of any camera,
+        or None if there was none within *timeout* (s).
+        @param lookahead: the pose is extrapolated this far (ns) beyond the time of the frame,
+                          e.g. CarrierOutput.expectedLatency() to act on where the agent will be
+        '''
+        if self.clock is not None:
+            fresh = self.clock.waitFrame(self._poll) # the next frame of the replay; no timeout
+        else:
+            with detectionCondition:
+                fresh = detectionCondition.wait_for(self._poll,timeout)
+        if not fresh:
+            return None
+        for cameraId, (timestamp, x, y, _) in fresh:
+            self.lastTimestamp[cameraId] = timestamp
+            self.fusion.addDetection(cameraId,timestamp,x,y)
+        pose = self.fusion.update()
+        tracing.record('frame.fused', max(s[0] for _, s in fresh), self.now())
+        if pose is None or not lookahead:
+            return pose
+        return self.fusion.predict(lookahead)._replace(cameras=pose.cameras)
+
+#=============================================================================================
+# Output of the control law
+#   angle      heading of the rotation plane (deg)
+#   magnitude  (mT)
+#   frequency  of the rotation (Hz)
+#   t          time of the pose the command was computed from (perf_counter_ns), None if open loop
+#=============================================================================================
+CarrierCommand = namedtuple('CarrierCommand', ['angle', 'magnitude', 'frequency', 't'])
+
+class CarrierOutput(object):
+    '''
+    Rotating field
+        x = magnitude * cos(theta) * cos(angle)
+        y = magnitude * cos(theta) * sin(angle)
+        z = magnitude * sin(theta)
+    The phase theta is integrated, so a new frequency does not make the field jump.
+    '''
+    def __init__(self,field,rate=2000,report=None,historySize=4096,clock=None):
+        '''
+        @param field: FieldManager
+        @param report: called with a status text every second, e.g. SubThread.statusSignal.emit
+        @param clock: scheduler.SimulatedClock that steps the output, None for a thread on the wall clock
+        '''
+        self.field = field
+        self.rate = rate
+        self.report = report
+        self.clock = clock
+        self.now = clock.now if clock is not None else time.perf_counter_ns
+        self.command = CarrierCommand(0, 0, 0, None) # replaced as a whole by setCommand()
+        self.latency = np.zeros(historySize,dtype=np.int64) # ring: pose -> first DAC write of its command (ns)
+        self.commands = 0 # number of closed-loop commands that reached the DAC
+        self._stopped = False
+        self._thread = None
+        self._loop = None # registration with the clock
+
+    def setCommand(self,angle,magnitude,frequency,t=None):
+        self.command = CarrierCommand(angle,magnitude,frequency,t)
+        if t is not None:
+            tracing.record('frame.command', t, self.now())
+
+    def recentLatency(self,n=None):
+        ''' Latencies (ns) of the last *n* commands (all that are kept if None), oldest first '''
+        n = min(self.commands,len(self.latency)) if n is None else min(n,self.commands,len(self.latency))
+        i = self.commands % len(self.latency)
+        return np.concatenate((self.latency[i:],self.latency[:i]))[-n:] if n > i else self.latency[i-n:i]
+
+    def latencyStats(self,n=None):
+        ''' p50, p99 and max (ns) of the latency of the last *n* commands '''
+        samples = self.recentLatency(n)
+        if len(samples) == 0:
+            return (0, 0, 0)
+        return tuple(float(v) for v in np.percentile(samples,[50,99])) + (int(samples.max()),)
+
+    def expectedLatency(self,n=LATENCY_WINDOW):
+        ''' Median latency (ns) of the last *n* commands; 0 before the first one '''
+        samples = self.recentLatency(n)
+        return int(np.median(samples)) if len(samples) else 0
+
+    def start(self):
+        self._stopped = False
+        if self.clock is not None:
+            self._loop = self.clock.add(self.rate,self._makeTick())
+            return
+        self._thread = threading.Thread(target=self._run,daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._loop is not None:
+            self.clock.remove(self._loop)
+            self._loop = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _makeTick(self):
+        setXYZ = self.field.setXYZ
+        now = self.now
+        theta = 0.0
+        lastT = 0.0
+        lastCommand = None
+        def tick(t):
+            nonlocal theta, lastT, lastCommand
+            command = self.command # one snapshot per tick
+            theta = (theta + 2 * pi * command.frequency * (t - lastT)) % (2 * pi)
+            lastT = t
+            magnitude = command.magnitude
+            setXYZ(magnitude * cos(theta) * cosd(command.angle),
+                   magnitude * cos(theta) * sind(command.angle),
+                   magnitude * sin(theta))
+            if command is not lastCommand:
+                lastCommand = command
+                if command.t is not None:
+                    latency = now() - command.t
+                    self.latency[self.commands % len(self.latency)] = latency
+                    self.commands += 1
+                    tracing.recordDuration('frame.dac', latency)
+        return tick
+
+    def _run(self):
+        loop = FixedRateLoop(self.rate)
+        tick = self._makeTick()
+        self._reportedCommands = 0
+        loop.run(tick,lambda: self._stopped,self._report)
+
+    def _report(self,summary):
+        ''' Rate of the output and latency of the commands since the last report '''
+        commands = self.commands
+        n = commands - self._reportedCommands
+        self._reportedCommands = commands
+        if self.report is None:
+            return
+        p50, p99, pmax = self.latencyStats(n) if n else (0, 0, 0)
+        self.report('{}, commands {}, frame to DAC p50/p99/max {:.1f}/{:.1f}/{:.1f} ms'.format(
+            summary, n, p50 / 1e6, p99 / 1e6, pmax / 1e6))
@@ -1,74 +1,174 @@
-# assign pin # to the coil
-# PIN_X1 = [0, 5.003] # pin number, factor number (mT/V)
-# PIN_X2 = [3, 4.879]
-# PIN_Y1 = [4, 5.143]
-# PIN_Y2 = [1, 5.024]
-# PIN_Z1 = [2, 5.024]
-# PIN_Z2 = [5, 4.433]
-
-PIN_X1 = [5, 4.433] # pin number, factor number (mT/V)
-PIN_X2 = [1, 5.024]
-PIN_Y1 = [2, 5.224]
-PIN_Y2 = [6, 5.224]
-PIN_Z1 = [3, 4.879]
-PIN_Z2 = [7, 5.000]
+import time
+import threading
+from collections import namedtuple
+import numpy as np
+
+import calibration
+import tracing
+
+#=============================================================================================
+# Field after a command. A new snapshot replaces the old one after every command, so readers
+# in other threads (GUI, plots) always see x, y, z and setpoints of the same command.
+#   version    number of commands since start
+#   t          time.perf_counter_ns() at the end of the DAC write
+#   x, y, z    commanded field (mT)
+#   setpoints  read-only uint16 array, coils X1, X2, Y1, Y2, Z1, Z2
+#   skew       time between the first and the last DAC write of the command (ns)
+#=============================================================================================
+FieldState = namedtuple('FieldState', ['version', 't', 'x', 'y', 'z', 'setpoints', 'skew'])
+
+SKEW_HISTORY = 4096 # number of skews kept for skewStats()
 
 class FieldManager(object):
-    def __init__(self,dac):
-        self.x = 0
-        self.y = 0
-        self.z = 0
+    def __init__(self,dac,coilCalibration=None):
+        '''
+        @param coilCalibration: calibration.Calibration. Loaded from data/calibration.json if None.
+        '''
         self.dac = dac
-        
+        self.lock = threading.RLock() # the GUI and a SubThread mode may write at the same time
+        self.telemetry = None # telemetry.TelemetryRecorder that logs every command
+        self.setCalibration(coilCalibration or calibration.load())
+        self.setpoints = self.coilMap.coilsToSetpoints(np.zeros(6)) # last setpoints of the coils X1, X2, Y1, Y2, Z1, Z2
+        self.skews = np.zeros(SKEW_HISTORY,dtype=np.int64) # ring of the skews of the full (six coil) writes
+        self.fullWrites = 0
+        setpoints = self.setpoints.copy()
+        setpoints.setflags(write=False)
+        self.state = FieldState(0, time.perf_counter_ns(), 0, 0, 0, setpoints, 0)
+
+    # Also call this after changing the range of a DAC channel
+    def setCalibration(self,coilCalibration):
+        self.coilCalibration = coilCalibration
+        self.coilMap = coilCalibration.compile(self.dac) # replaced as a whole
+
+    def setTelemetry(self,recorder):
+        self.telemetry = recorder
+
+    # The field of the last command. Read self.state to get x, y and z of the same command.
+    @property
+    def x(self):
+        return self.state.x
+
+    @property
+    def y(self):
+        return self.state.y
+
+    @property
+    def z(self):
+        return self.state.z
+
+    #==============================================================================================
+    # Publish the command that was just written to the DAC. Called with self.lock held.
+    #==============================================================================================
+    def publish(self,x_mT,y_mT,z_mT,fullWrite=False):
+        skew = self.dac.lastWriteLatency
+        tracing.recordDuration('dac.write', skew)
+        setpoints = self.setpoints.copy()
+        setpoints.setflags(write=False)
+        self.state = FieldState(self.state.version + 1, time.perf_counter_ns(), x_mT, y_mT, z_mT, setpoints, skew)
+        if fullWrite:
+            self.skews[self.fullWrites % SKEW_HISTORY] = skew
+            self.fullWrites += 1
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.record(setpoints, x_mT, y_mT, z_mT)
+
+    def skewStats(self):
+        ''' p50, p99 and max (ns) of the skew of the last SKEW_HISTORY writes of all six coils '''
+        skews = self.skews[:min(self.fullWrites,SKEW_HISTORY)]
+        if len(skews) == 0:
+            return (0, 0, 0)
+        return tuple(float(v) for v in np.percentile(skews,[50,99])) + (int(skews.max()),)
+
     # Uniform field
+    # Only the coils of the axis are written. The other axes are taken as they are for the cross terms.
     def setX(self,mT):
         # print(f"Setting X to {mT} mT") 
-        self.dac.s826_aoPin(PIN_X1[0], mT / PIN_X1[1])
-        self.dac.s826_aoPin(PIN_X2[0], mT / PIN_X2[1])
-        self.x = mT
+        with self.lock:
+            state = self.state
+            self.writeAxis(0,(mT,state.y,state.z))
+            self.publish(mT,state.y,state.z)
 
     def setY(self,mT):
-        self.dac.s826_aoPin(PIN_Y1[0], mT / PIN_Y1[1])
-        self.dac.s826_aoPin(PIN_Y2[0], mT / PIN_Y2[1])
-        self.y = mT
+        with self.lock:
+            state = self.state
+            self.writeAxis(1,(state.x,mT,state.z))
+            self.publish(state.x,mT,state.z)
 
     def setZ(self,mT):
-        self.dac.s826_aoPin(PIN_Z1[0], mT / PIN_Z1[1])
-        self.dac.s826_aoPin(PIN_Z2[0], mT / PIN_Z2[1])
-        self.z = mT
+        with self.lock:
+            state = self.state
+            self.writeAxis(2,(state.x,state.y,mT))
+            self.publish(state.x,state.y,mT)
 
+    def writeAxis(self,axis,field):
+        coils = slice(2 * axis, 2 * axis + 2)
+        setpoints = self.coilMap.fieldsToSetpoints(field)[coils]
+        self.dac.s826_writeSetpoints(setpoints, self.coilMap.channels[coils])
+        self.setpoints[coils] = setpoints
+
+    # Write all six coils in one burst so that the three axes are updated together.
+    # The setpoints are computed before the first write, so the burst is only the DAC writes.
     def setXYZ(self,x_mT,y_mT,z_mT):
-      
-        self.setX(x_mT)
-        self.setY(y_mT)
-        self.setZ(z_mT)
-        # print(f"⚡ Updated Field: X={x_mT}, Y={y_mT}, Z={z_mT}")s
+        coilMap = self.coilMap
+        setpoints = coilMap.fieldsToSetpoints((x_mT, y_mT, z_mT))
+        with self.lock:
+            self.dac.s826_writeSetpoints(setpoints, coilMap.channels)
+            self.setpoints[:] = setpoints
+            self.publish(x_mT,y_mT,z_mT,fullWrite=True)
+        # print(f"⚡ Updated Field: X={x_mT}, Y={y_mT}, Z={z_mT}")
+
+    # Set each coil to a value in mT, in the order X1, X2, Y1, Y2, Z1, Z2.
+    # (x_mT, y_mT, z_mT) is the resulting field, for the display and the telemetry.
+    def setCoils(self,coils,x_mT,y_mT,z_mT):
+        self.setCoilSetpoints(self.coilMap.coilsToSetpoints(coils),x_mT,y_mT,z_mT)
+
+    # Everything that affects the conversion from mT to setpoints. Used to key cached waveforms.
+    def calibration(self):
+        return self.coilMap.key()
+
+    # Convert an array of fields (N,3) in mT to coil setpoints (N,6), e.g. for precomputed waveforms
+    def toCoilSetpoints(self,fields):
+        return self.coilMap.fieldsToSetpoints(fields)
+
+    # Convert an array of per-coil values (N,6) in mT, in the order X1, X2, Y1, Y2, Z1, Z2, to coil setpoints (N,6)
+    def coilsToSetpoints(self,coils):
+        return self.coilMap.coilsToSetpoints(coils)
+
+    # Write coil setpoints computed by toCoilSetpoints()
+    def setCoilSetpoints(self,setpoints,x_mT,y_mT,z_mT):
+        with self.lock:
+            self.dac.s826_writeSetpoints(setpoints, self.coilMap.channels)
+            self.setpoints[:] = setpoints
+            self.publish(x_mT,y_mT,z_mT,fullWrite=True)
 
     # Generate a pulling force by applying current to only one coil
     # mT is a measurement of current in the coil. It has nothing to do with actual field strength.
     def setXGradient(self,mT):
         # print(f"Setting X Gradient to {mT} mT") 
-        if mT > 0:
-            self.dac.s826_aoPin(PIN_X1[0], mT / PIN_X1[1])
-        else:
-            self.dac.s826_aoPin(PIN_X2[0], mT / PIN_X2[1])
-        # self.x = 0
-        self.x = 0
+        with self.lock:
+            self.setCoil(0 if mT > 0 else 1, mT)
+            # self.x = 0
+            state = self.state
+            self.publish(0,state.y,state.z)
 
 
     def setYGradient(self,mT):
-        if mT > 0:
-            self.dac.s826_aoPin(PIN_Y1[0], mT / PIN_Y1[1])
-        else:
-            self.dac.s826_aoPin(PIN_Y2[0], mT / PIN_Y2[1])
-        # self.y = 0
-        self.y = 0
+        with self.lock:
+            self.setCoil(2 if mT > 0 else 3, mT)
+            # self.y = 0
+            state = self.state
+            self.publish(state.x,0,state.z)
 
     def setZGradient(self,mT):
-        if mT > 0:
-            self.dac.s826_aoPin(PIN_Z1[0], mT / PIN_Z1[1])
-        else:
-            self.dac.s826_aoPin(PIN_Z2[0], mT / PIN_Z2[1])
-        # self.z = 0
-        self.z = 0
+        with self.lock:
+            self.setCoil(4 if mT > 0 else 5, mT)
+            # self.z = 0
+            state = self.state
+            self.publish(state.x,state.y,0)
 
+    # Write one coil (index in X1, X2, Y1, Y2, Z1, Z2) without touching the others
+    def setCoil(self,coil,mT):
+        setpoint = self.coilMap.coilSetpoint(coil,mT)
+        with self.lock:
+            self.dac.s826_writeSetpoints((setpoint,),(self.coilMap.channels[coil],))
+            self.setpoints[coil] = setpoint
@@ -1,4 +1,6 @@
 import cv2
+import time
+import numpy as np
 
 #=============================================================================================
 # Call this function if selected filterName is not defined
@@ -70,3 +72,123 @@ def dilate(inputImage,args):
     arg = args.split(',')
     kernel = np.ones((int(arg[0]),int(arg[0])), np.uint8)
     return cv2.dilate(inputImage, kernel, iterations=1)
+
+#=============================================================================================
+# Compiled filters
+# The filters above parse their args on every call. compileFilter() parses the args once,
+# builds kernels etc. in advance and returns a CompiledFilter that writes into its own
+# preallocated output buffer. The buffer is overwritten by the next frame, so the output
+# of a stage is only valid until the filter is called again.
+#=============================================================================================
+class OutputBuffer(object):
+    def __init__(self):
+        self.buf = None
+
+    def get(self,shape,dtype=np.uint8):
+        if self.buf is None or self.buf.shape != shape or self.buf.dtype != dtype:
+            self.buf = np.empty(shape,dtype=dtype)
+        return self.buf
+
+def _compileGrey(args):
+    out = OutputBuffer()
+    def run(image):
+        if image.ndim == 3:
+            return cv2.cvtColor(image,cv2.COLOR_BGR2GRAY,dst=out.get(image.shape[:2],image.dtype))
+        return image
+    return run
+
+def _compileColor(args):
+    out = OutputBuffer()
+    def run(image):
+        if image.ndim == 2:
+            return cv2.cvtColor(image,cv2.COLOR_GRAY2BGR,dst=out.get(image.shape + (3,),image.dtype))
+        return image
+    return run
+
+def _compileBlur(args):
+    size = int(args[0])*2+1
+    out = OutputBuffer()
+    def run(image):
+        return cv2.GaussianBlur(image,(size,size),0,dst=out.get(image.shape,image.dtype))
+    return run
+
+def _compileThreshold(args):
+    lower, upper = int(args[0]), int(args[1])
+    out = OutputBuffer()
+    def run(image):
+        return cv2.threshold(image,lower,upper,cv2.THRESH_BINARY,dst=out.get(image.shape,image.dtype))[1]
+    return run
+
+def _compileCanny(args):
+    minVal, maxVal = int(args[0]), int(args[1])
+    out = OutputBuffer()
+    def run(image):
+        return cv2.Canny(image,minVal,maxVal,out.get(image.shape[:2]))
+    return run
+
+def _compileErode(args):
+    kernel = np.ones((int(args[0]),int(args[0])), np.uint8)
+    out = OutputBuffer()
+    def run(image):
+        return cv2.erode(image,kernel,dst=out.get(image.shape,image.dtype),iterations=1)
+    return run
+
+def _compileDilate(args):
+    kernel = np.ones((int(args[0]),int(args[0])), np.uint8)
+    out = OutputBuffer()
+    def run(image):
+        return cv2.dilate(image,kernel,dst=out.get(image.shape,image.dtype),iterations=1)
+    return run
+
+COMPILERS = {
+    'grey': _compileGrey,
+    'color': _compileColor,
+    'blur': _compileBlur,
+    'threshold': _compileThreshold,
+    'canny': _compileCanny,
+    'erode': _compileErode,
+    'dilate': _compileDilate,
+}
+
+class CompiledFilter(object):
+    ''' One stage of the filter chain. Keeps the time spent in the stage. '''
+    def __init__(self,name,args,function):
+        self.name = name
+        self.args = args
+        self.function = function
+        self.calls = 0
+        self.totalTime = 0 # ns
+        self.maxTime = 0 # ns
+
+    def __call__(self,image):
+        start = time.perf_counter_ns()
+        image = self.function(image)
+        elapsed = time.perf_counter_ns() - start
+        self.calls += 1
+        self.totalTime += elapsed
+        if elapsed > self.maxTime:
+            self.maxTime = elapsed
+        return image
+
+    def report(self):
+        mean = self.totalTime / self.calls if self.calls else 0
+        return '{}({}): mean {:.2f} ms, max {:.2f} ms, {} frames'.format(
+            self.name, self.args, mean / 1e6, self.maxTime / 1e6, self.calls)
+
+def compileFilter(name,args):
+    '''
+    Return a CompiledFilter for filterName(args), or None if the filter is not defined or
+    the args are invalid. Filters without a compiler in COMPILERS are called with their string args.
+    '''
+    try:
+        if name in COMPILERS:
+            function = COMPILERS[name](args.split(','))
+        elif callable(globals().get(name)):
+            function = lambda image, f=globals()[name]: f(image,args)
+        else:
+            filterNotDefined(None)
+            return None
+    except (ValueError, IndexError):
+        print('Invalid args for filter {}({})'.format(name,args))
+        return None
+    return CompiledFilter(name,args,function)
@@ -0,0 +1,74 @@
+"""
+=============================================================================
+frameBuffer.py
+----------------------------------------------------------------------------
+Triple buffer for handing frames from one thread to another.
+The writer fills its back slot and publishes it; the reader takes the most
+recently published slot. Frames that were never read are overwritten
+(latest frame wins), neither side waits for the other, and frames are not
+copied when they change hands. Only the slot swap is done under a lock.
+=============================================================================
+"""
+import threading
+import numpy as np
+
+class TripleBuffer(object):
+    def __init__(self):
+        self._slots = [None, None, None]  # numpy arrays, allocated when the first frame arrives
+        self._info = [None, None, None]   # (frameId, timestamp, meta) of the frame in each slot
+        self._back = 0   # being written
+        self._ready = 1  # latest published frame
+        self._front = 2  # being read
+        self._fresh = False # the ready slot holds a frame that has not been read
+        self._lock = threading.Lock()
+        self._published = threading.Condition(self._lock)
+        self.framesPublished = 0
+        self.framesDropped = 0 # published but overwritten before they were read
+
+    #==============================================================================================
+    # Writer side
+    #==============================================================================================
+    def writeBuffer(self,shape,dtype=np.uint8):
+        ''' Return the back slot, (re)allocated if the frame size has changed. '''
+        buf = self._slots[self._back]
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = self._slots[self._back] = np.empty(shape,dtype=dtype)
+        return buf
+
+    def publish(self,timestamp=0,meta=None):
+        '''
+        Make the back slot the latest frame. Returns the frame id.
+        @param timestamp: time.perf_counter_ns() at which the frame was grabbed
+        @param meta: anything else that belongs to the frame
+        '''
+        frameId = self.framesPublished
+        self._info[self._back] = (frameId, timestamp, meta)
+        with self._lock:
+            self._back, self._ready = self._ready, self._back
+            if self._fresh:
+                self.framesDropped += 1
+            self._fresh = True
+            self._published.notify_all()
+        self.framesPublished += 1
+        return frameId
+
+    #==============================================================================================
+    # Reader side
+    # The returned array stays valid until the next call of read().
+    #==============================================================================================
+    def read(self,timeout=0):
+        '''
+        Return (frame, (frameId, timestamp, meta)) of the latest frame,
+        or (None, None) if there is no new frame within *timeout* seconds.
+        '''
+        with self._lock:
+            if not self._fresh and timeout:
+                self._published.wait(timeout)
+            if not self._fresh:
+                return None, None
+            self._front, self._ready = self._ready, self._front
+            self._fresh = False
+        return self._slots[self._front], self._info[self._front]
+
+    def hasNewFrame(self):
+        return self._fresh
@@ -0,0 +1,220 @@
+"""
+=============================================================================
+frameStore.py
+----------------------------------------------------------------------------
+Lossless capture of every camera frame for offline analysis.
+Frames are appended as they come from the camera (Bayer/mono or BGR) into
+preallocated memory-mapped segment files, so a frame costs one memcpy and
+no encoding. The next segment file is created by a helper thread while the
+current one fills up. Each capture goes into its own empty directory, which
+holds
+    store.json                   frame shape, dtype, segment size
+    segment_0000.frames.npy      (framesPerSegment, *frameShape)
+    segment_0000.times.npy       (framesPerSegment, 3) int64: frame number,
+                                 time.perf_counter_ns() and camera timestamp
+                                 of each row, -1 if the row was never written
+With maxSegments the files are reused as a ring and only the newest
+maxSegments * framesPerSegment frames are kept; without it new segments are
+added until the capture is stopped.
+=============================================================================
+"""
+import os
+import json
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+FRAMES_PER_SEGMENT = 500
+
+#=============================================================================================
+# Writer. append() is called from the camera thread. The segment files are created ahead by a
+# helper thread, so the camera thread only copies the frame.
+#=============================================================================================
+class FrameStoreWriter(object):
+    def __init__(self,directory,framesPerSegment=FRAMES_PER_SEGMENT,maxSegments=None,pixelFormat='',
+                 frameShape=None,dtype=None):
+        '''
+        @param directory: created if it does not exist. It must be empty; an old capture is never overwritten.
+        @param maxSegments: number of segment files reused as a ring. None adds segments forever.
+        @param pixelFormat: written to store.json for the reader, e.g. 'BayerRG8'
+        @param frameShape: shape of the frames if it is known, with *dtype*. The first segment is then
+                           created before the first frame arrives; otherwise the first frame waits for it.
+        '''
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise FileExistsError('frameStore: {} is not empty'.format(directory))
+        self.directory = directory
+        self.framesPerSegment = framesPerSegment
+        self.maxSegments = maxSegments
+        self.pixelFormat = pixelFormat
+        self.frameShape = None # set by the first frame
+        self.dtype = None
+        self.framesWritten = 0
+        self.segmentWaits = 0 # segment changes at which the next segment was not ready yet
+        self._segment = None # (frames, times) memmaps of the current segment
+        self._next = None # future of the (frames, times) of the next segment
+        self._nextNumber = 0
+        self._closed = False
+        self._lock = threading.Lock() # close() may be called from another thread
+        self._helper = ThreadPoolExecutor(max_workers=1,thread_name_prefix='frameStore')
+        os.makedirs(directory,exist_ok=True)
+        if frameShape is not None:
+            self._setFormat(tuple(frameShape),np.dtype(dtype))
+            self._next.result()
+
+    def _segmentPath(self,slot):
+        return os.path.join(self.directory,'segment_{:04d}'.format(slot))
+
+    def _isNewSegment(self,number):
+        ''' False if segment *number* reuses the file of an earlier segment (ring) '''
+        return not self.maxSegments or number < self.maxSegments
+
+    #==============================================================================================
+    # Run by the helper thread
+    #==============================================================================================
+    def _openSegment(self,number):
+        path = self._segmentPath(number % self.maxSegments if self.maxSegments else number)
+        if not self._isNewSegment(number):
+            # ring: reuse the file created earlier in this capture. Old rows stay valid until they are overwritten.
+            frames = np.load(path + '.frames.npy',mmap_mode='r+')
+            times = np.load(path + '.times.npy',mmap_mode='r+')
+        else:
+            frames = np.lib.format.open_memmap(path + '.frames.npy',mode='w+',dtype=self.dtype,
+                                               shape=(self.framesPerSegment,) + self.frameShape)
+            times = np.lib.format.open_memmap(path + '.times.npy',mode='w+',dtype=np.int64,
+                                              shape=(self.framesPerSegment,3))
+            times[:] = -1
+            times.flush()
+            frames.reshape(-1)[::mmap.PAGESIZE] = 0 # touch every page, so the camera thread does not fault them in
+        return frames, times
+
+    @staticmethod
+    def _flushSegment(segment):
+        segment[0].flush()
+        segment[1].flush()
+
+    @staticmethod
+    def _releaseSegment(segment):
+        pass # the last reference is dropped in the helper thread
+
+    def _prepareNext(self):
+        self._next = self._helper.submit(self._openSegment,self._nextNumber)
+
+    def _saveInfo(self):
+        info = {'frameShape': self.frameShape, 'dtype': np.dtype(self.dtype).str, 'pixelFormat': self.pixelFormat,
+                'framesPerSegment': self.framesPerSegment, 'maxSegments': self.maxSegments,
+                'framesWritten': self.framesWritten}
+        with open(os.path.join(self.directory,'store.json'),'w') as f:
+            json.dump(info,f,indent=1)
+
+    def _setFormat(self,frameShape,dtype):
+        self.frameShape = frameShape
+        self.dtype = dtype
+        self._saveInfo()
+        self._prepareNext()
+
+    #==============================================================================================
+    # Camera thread
+    #==============================================================================================
+    def append(self,frame,timestamp,hardwareTimestamp=-1):
+        with self._lock:
+            if self._closed:
+                return False
+            return self._append(frame,timestamp,hardwareTimestamp)
+
+    def _append(self,frame,timestamp,hardwareTimestamp):
+        if self.frameShape is None:
+            self._setFormat(tuple(frame.shape),frame.dtype)
+        elif tuple(frame.shape) != self.frameShape or frame.dtype != self.dtype:
+            return False # the camera settings changed; start a new capture for the new size
+        row = self.framesWritten % self.framesPerSegment
+        if row == 0:
+            # the full segment is not flushed here: msync holds the GIL for tens of ms, and the
+            # kernel writes the pages back anyway once the memory map is released
+            if not self._next.done():
+                self.segmentWaits += 1
+            # the old memory maps are released by the helper, unmapping a segment takes milliseconds
+            self._helper.submit(self._releaseSegment,self._segment)
+            self._segment = self._next.result()
+            self._nextNumber += 1
+            self._prepareNext()
+        frames, times = self._segment
+        np.copyto(frames[row],frame)
+        times[row] = (self.framesWritten, timestamp, hardwareTimestamp) # after the frame, so a valid row has a complete frame
+        self.framesWritten += 1
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            segment, self._segment = self._segment, None
+            prepared, self._next = self._next, None
+        self._helper.shutdown(wait=True)
+        if segment is not None:
+            self._flushSegment(segment)
+        if prepared is not None and self._isNewSegment(self._nextNumber):
+            # the segment created ahead was never used
+            path = self._segmentPath(self._nextNumber)
+            prepared = None # releases the memory maps
+            for suffix in ('.frames.npy','.times.npy'):
+                try:
+                    os.remove(path + suffix)
+                except OSError as e:
+                    print('⚠️ frameStore: cannot remove the unused {}{}: {}'.format(path,suffix,e))
+        if self.frameShape is not None:
+            self._saveInfo()
+        if self.segmentWaits:
+            print('⚠️ frameStore: the camera thread waited for {} new segments'.format(self.segmentWaits))
+
+#=============================================================================================
+# Reader. Frames are returned as read-only views into the memory-mapped files.
+#=============================================================================================
+class FrameStoreReader(object):
+    def __init__(self,directory):
+        with open(os.path.join(directory,'store.json')) as f:
+            self.info = json.load(f)
+        self.frameShape = tuple(self.info['frameShape'])
+        self.pixelFormat = self.info['pixelFormat']
+        self.segments = []
+        rows = []
+        slot = 0
+        while os.path.exists(os.path.join(directory,'segment_{:04d}.frames.npy'.format(slot))):
+            path = os.path.join(directory,'segment_{:04d}'.format(slot))
+            self.segments.append(np.load(path + '.frames.npy',mmap_mode='r'))
+            times = np.load(path + '.times.npy')
+            valid = np.flatnonzero(times[:,0] >= 0)
+            rows.append(np.column_stack((times[valid],np.full(len(valid),slot),valid)))
+            slot += 1
+        rows = np.concatenate(rows) if rows else np.zeros((0,5),dtype=np.int64)
+        rows = rows[np.argsort(rows[:,0],kind='stable')]
+        # one row per frame, ordered by frame number: number, timestamp, camera timestamp, segment, row
+        self.frameNumbers = rows[:,0]
+        self.timestamps = rows[:,1]
+        self.hardwareTimestamps = rows[:,2]
+        self._location = rows[:,3:5]
+
+    def __len__(self):
+        return len(self.frameNumbers)
+
+    def __getitem__(self,i):
+        ''' The i-th stored frame (oldest first) '''
+        segment, row = self._location[i]
+        return self.segments[segment][row]
+
+    def frame(self,frameNumber):
+        ''' Return (frame, timestamp, hardwareTimestamp) of *frameNumber*, or None if it is not stored '''
+        i = np.searchsorted(self.frameNumbers,frameNumber)
+        if i == len(self) or self.frameNumbers[i] != frameNumber:
+            return None
+        return self[i], self.timestamps[i], self.hardwareTimestamps[i]
+
+    def framesBetween(self,start,end):
+        '''
+        Iterate over (frameNumber, timestamp, frame) of the frames with start <= timestamp < end.
+        Timestamps are time.perf_counter_ns() values.
+        '''
+        first, last = np.searchsorted(self.timestamps,[start,end])
+        for i in range(first,last):
+            yield self.frameNumbers[i], self.timestamps[i], self[i]
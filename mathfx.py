@@ -1,4 +1,5 @@
 from math import pi, sin, cos, radians, sqrt
+import numpy as np
 def cosd(val):
     return cos(radians(val))
 
@@ -41,6 +42,29 @@ def oscBetween(currentTime,oscShape,frequency,bound1,bound2,phaseOffset=0):
     else:
         return 0
 
+def oscBetweenArray(currentTime,oscShape,frequency,bound1,bound2,phaseOffset=0):
+    """
+    Same as oscBetween(), but *currentTime* is a numpy array of times (s).
+    Used to sample a full period of a waveform in one call.
+    """
+    currentTime = np.asarray(currentTime,dtype=float)
+    if frequency == 0 or bound1 == bound2:
+        return np.zeros_like(currentTime)
+    lowerBound, upperBound = min(bound1,bound2), max(bound1,bound2)
+    time = currentTime + 1/frequency*phaseOffset
+    if oscShape == 'sin':
+        return 0.5 * (lowerBound+upperBound) + (upperBound-lowerBound)*0.5 * np.sin(2*pi*frequency*(time-0.25/frequency))
+    elif oscShape == 'cos':
+        return 0.5 * (lowerBound+upperBound) + (upperBound-lowerBound)*0.5 * np.cos(2*pi*frequency*time)
+    elif oscShape == 'saw':
+        return lowerBound + np.mod(time*frequency*(upperBound-lowerBound),upperBound-lowerBound)
+    elif oscShape == 'square':
+        return np.where(np.trunc(frequency * 2 * time) % 2 == 0, lowerBound, upperBound)
+    elif oscShape == 'triangle':
+        return lowerBound + np.abs((lowerBound-upperBound) + np.mod((time+0.5/frequency)*frequency*2*(upperBound-lowerBound),2*(upperBound-lowerBound)))
+    else:
+        return np.zeros_like(currentTime)
+
 def normalizeTime(currentTime,frequency):
     '''
     This function converts the x-axis variable (time) of a periodic function to the normalized time, range: 0 - 1
@@ -58,6 +82,8 @@ def perpendicularFootToLine(x,y,x1,y1,x2,y2):
     """
     A = y2 - y1
     B = x1 - x2
+    if A == 0 and B == 0:
+        return x1, y1 # P1 and P2 are the same point
     C = y1 * (x2 - x1) - x1 * (y2 - y1)
     footX = (B**2*x - A*B*y - A*C) / (A**2 + B**2)
     footY = (A**2*y - A*B*x - B*C) / (A**2 + B**2)
@@ -1,4 +1,4 @@
-import cv2, math
+import cv2, math, heapq
 import numpy as np
 
 #=============================================================================================
@@ -16,7 +16,7 @@ def detectBiggestContour(imageFiltered,imageOriginal,agent):
     imageFiltered=cv2.copyMakeBorder(imageFiltered, top=1, bottom=1, left=1, right=1, borderType= cv2.BORDER_CONSTANT, value=[255,255,255])
     nOfSamples = 2
     contours, hierarchy = cv2.findContours(imageFiltered, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = sorted(contours, key = cv2.contourArea, reverse = True)[:nOfSamples]
+    cnts = heapq.nlargest(nOfSamples, contours, key = cv2.contourArea)
     if len(cnts) > 1:
         targetCnt = cnts[1] # cnt[0] is the edge of the screen
         # get info
@@ -25,10 +25,70 @@ def detectBiggestContour(imageFiltered,imageOriginal,agent):
         agent.set(x,y,angleCorrected) # update the position of the agnet
         # draw contour
         rect = cv2.minAreaRect(targetCnt) # (x,y)(w,h)theta
-        box = np.int0(cv2.boxPoints(rect)) # vertices of the bounding rect
+        box = np.intp(cv2.boxPoints(rect)) # vertices of the bounding rect
         cv2.drawContours(imageOriginal,[box],0,(0,255,0), 3) # draw boundingRect on the original image
     return imageOriginal
 
+#====================================================
+# Use binary image as input in this algorithm
+# Same target as detectBiggestContour (the biggest dark object on a bright background),
+# but once the object has been found, only a region of interest around its last position
+# is searched. The ROI is the bounding box of the last fitted ellipse, enlarged by
+# TRACK_MARGIN to allow for the motion between two frames.
+# The whole frame is searched again when the object is lost, i.e. when nothing is found
+# in the ROI or the object touches the edge of the ROI.
+#====================================================
+TRACK_MARGIN = 2.0    # ROI size relative to the bounding box of the object
+TRACK_MIN_HALFSIZE = 20 # px
+TRACK_MIN_AREA = 10   # px^2, smaller contours are noise
+
+def _biggestDarkContour(imageBinary, offset=(0,0)):
+    # the object is dark: invert so that it becomes the outer contour of a white blob
+    contours, _ = cv2.findContours(cv2.bitwise_not(imageBinary), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    if not contours:
+        return None
+    cnt = max(contours, key = cv2.contourArea) # only the biggest one is needed; no sorting
+    if cv2.contourArea(cnt) < TRACK_MIN_AREA or len(cnt) < 5: # fitEllipse needs 5 points
+        return None
+    return cnt
+
+def trackBiggestContour(imageFiltered,imageOriginal,agent):
+    height, width = imageFiltered.shape[:2]
+    targetCnt = None
+    if agent.tracking:
+        # bounding box of the ellipse found in the previous frame
+        MA, ma = agent.axes
+        theta = math.radians(90 - agent.orientation)
+        halfW = (abs(MA * math.cos(theta)) + abs(ma * math.sin(theta))) / 2
+        halfH = (abs(MA * math.sin(theta)) + abs(ma * math.cos(theta))) / 2
+        halfW = max(halfW * TRACK_MARGIN, TRACK_MIN_HALFSIZE)
+        halfH = max(halfH * TRACK_MARGIN, TRACK_MIN_HALFSIZE)
+        x0, x1 = max(int(agent.x - halfW), 0), min(int(agent.x + halfW) + 1, width)
+        y0, y1 = max(int(agent.y - halfH), 0), min(int(agent.y + halfH) + 1, height)
+        if x1 - x0 > 1 and y1 - y0 > 1:
+            targetCnt = _biggestDarkContour(imageFiltered[y0:y1, x0:x1], offset=(x0, y0))
+        if targetCnt is not None:
+            # the object must lie inside the ROI, unless it touches the edge of the frame
+            bx, by, bw, bh = cv2.boundingRect(targetCnt)
+            if (bx <= x0 and x0 > 0) or (by <= y0 and y0 > 0) or (bx + bw >= x1 and x1 < width) or (by + bh >= y1 and y1 < height):
+                targetCnt = None
+        if targetCnt is not None:
+            cv2.rectangle(imageOriginal, (x0, y0), (x1 - 1, y1 - 1), (255, 0, 0), 1) # draw the ROI
+    if targetCnt is None:
+        # (re)acquire on the whole frame
+        agent.tracking = False
+        targetCnt = _biggestDarkContour(imageFiltered)
+        if targetCnt is None:
+            return imageOriginal
+    (x,y),(MA,ma),angle = cv2.fitEllipse(targetCnt)
+    agent.set(x,y,-angle + 90)
+    agent.axes = (MA, ma)
+    agent.tracking = True
+    rect = cv2.minAreaRect(targetCnt)
+    box = np.intp(cv2.boxPoints(rect))
+    cv2.drawContours(imageOriginal,[box],0,(0,255,0), 3)
+    return imageOriginal
+
 #====================================================
 # Use binary image as input in this algorithm
 # Detect all contours and use PCA to find the orientation
@@ -58,8 +118,8 @@ def primaryComponentAnalysis(imageFiltered,imageOriginal,agent):
         if area < 1e2 or 1e5 < area:    # get rid of small areas (noise) and big areas (the edges of the screen)
             continue
         cv2.drawContours(imageOriginal, contours, i, (0, 255, 0), 2, 8, hierarchy, 0)
-        X = np.array(contours[i], dtype=np.float).reshape((contours[i].shape[0], contours[i].shape[2])) # save contour as float array
-        mean, eigenvectors = cv2.PCACompute(X, mean=np.array([], dtype=np.float), maxComponents=1) # one-dimensioanl Primary Component Analysis
+        X = np.array(contours[i], dtype=float).reshape((contours[i].shape[0], contours[i].shape[2])) # save contour as float array
+        mean, eigenvectors = cv2.PCACompute(X, mean=np.array([], dtype=float), maxComponents=1) # one-dimensioanl Primary Component Analysis
         pt = (mean[0][0], mean[0][1])
         vec = (eigenvectors[0][0], eigenvectors[0][1]) # eigen vectors
         drawAxis(imageOriginal, pt, vec, (0, 0, 255), 150)
@@ -77,6 +137,9 @@ class Agent():
         self.x = 0
         self.y = 0
         self.orientation = 0
+        # used by trackBiggestContour
+        self.tracking = False # the object was found in the previous frame
+        self.axes = (0, 0) # axes of the ellipse fitted to the object (px)
 
     def set(self,x,y,orientation = 0):
         self.x = x
@@ -0,0 +1,210 @@
+"""
+=============================================================================
+poseFusion.py
+----------------------------------------------------------------------------
+Fusion of the agent detections of several cameras into one pose.
+Each camera is described in data/cameras.json:
+    {
+     "cameras": {
+      "1": {"homography": [[1, 0, 0], [0, 1, 0], [0, 0, 1]], "latencyMs": 0, "sigma": 2},
+      ...
+     }
+    }
+    homography  3x3 matrix from image pixels to the shared frame
+    latencyMs   time from exposure to the frame timestamp (grab), subtracted from it
+    sigma       standard deviation of a detection in the shared frame
+Cameras that are not listed use the identity, no latency and sigma 2.
+
+A detection is corrected by the latency of its camera and mapped into the
+shared frame. update() brings the new detections of all cameras to the time
+of the newest one, linearly from the last two detections of each camera,
+and corrects a constant-velocity Kalman filter (state x, y, vx, vy) with
+them. Detections older than maxAge are left out. The filter predicts
+through gaps without detections (dropped frames, slow cameras) and only
+starts again from rest after restartAfter without any.
+=============================================================================
+"""
+import os
+import json
+from collections import namedtuple
+import numpy as np
+from scheduler import NS_PER_S
+
+CAMERAS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cameras.json')
+DEFAULT_CAMERA = {'homography': np.eye(3).tolist(), 'latencyMs': 0, 'sigma': 2.0}
+
+#=============================================================================================
+# Output of the fusion
+#   t          time of the estimate: frame timestamp of the newest detection (perf_counter_ns)
+#   x, y       position in the shared frame at t + lookahead
+#   vx, vy     velocity (per second)
+#   covariance 4x4 covariance of (x, y, vx, vy)
+#   cameras    ids of the cameras that contributed
+#   lookahead  time (ns) the pose was extrapolated beyond t by predict(); 0 for the estimate itself
+#=============================================================================================
+FusedPose = namedtuple('FusedPose', ['t', 'x', 'y', 'vx', 'vy', 'covariance', 'cameras', 'lookahead'])
+
+class CameraModel(object):
+    def __init__(self,homography=None,latencyMs=0,sigma=2.0):
+        self.homography = np.asarray(homography if homography is not None else np.eye(3),dtype=float)
+        self.latency = int(latencyMs * 1e6) # ns
+        self.sigma = sigma
+
+    def toShared(self,x,y):
+        u, v, w = self.homography @ (x, y, 1.0)
+        return u / w, v / w
+
+    def toImage(self,x,y):
+        ''' Inverse of toShared(), e.g. to draw a point of the shared frame on the image of this camera '''
+        u, v, w = np.linalg.solve(self.homography,(x, y, 1.0))
+        return u / w, v / w
+
+def loadCameras(path=CAMERAS_PATH):
+    ''' Return a dict camera id (str) -> CameraModel '''
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        cameras = json.load(f)['cameras']
+    return {cameraId: CameraModel(**dict(DEFAULT_CAMERA, **camera)) for cameraId, camera in cameras.items()}
+
+class PoseFusion(object):
+    def __init__(self,cameras=None,maxAge=0.1,accelerationSigma=50.0,restartAfter=1.0):
+        '''
+        @param cameras: dict camera id -> CameraModel. Loaded from data/cameras.json if None.
+        @param maxAge: detections older than this (s) at the time of fusion are ignored
+        @param accelerationSigma: process noise of the constant-velocity model (units/s^2)
+        @param restartAfter: the filter starts again from rest after this long (s) without a detection
+        '''
+        self.cameras = loadCameras() if cameras is None else cameras
+        self.maxAge = int(maxAge * NS_PER_S)
+        self.restartAfter = int(restartAfter * NS_PER_S)
+        self.accelerationSigma = accelerationSigma
+        self.history = {} # camera id -> [previous, newest] detections (t, x, y) in the shared frame
+        self.fresh = set() # cameras with a detection that was not fused yet
+        self.state = None # Kalman state (x, y, vx, vy)
+        self.covariance = None
+        self.t = None # time of the state (ns)
+        self.rejected = 0 # detections that were too old when they arrived
+
+    def camera(self,cameraId):
+        cameraId = str(cameraId)
+        if cameraId not in self.cameras:
+            self.cameras[cameraId] = CameraModel()
+        return self.cameras[cameraId]
+
+    def reset(self):
+        self.history = {}
+        self.fresh = set()
+        self.state = None
+        self.t = None
+
+    #==============================================================================================
+    # Input
+    #==============================================================================================
+    def addDetection(self,cameraId,timestamp,x,y):
+        '''
+        @param timestamp: time.perf_counter_ns() at which the frame was grabbed (Vision.agentState[0])
+        @param x, y: position in the image (px)
+        '''
+        camera = self.camera(cameraId)
+        t = timestamp - camera.latency
+        if self.t is not None and t < self.t - self.maxAge:
+            self.rejected += 1
+            return
+        sample = (t,) + camera.toShared(x,y)
+        samples = self.history.setdefault(str(cameraId),[])
+        if samples and samples[-1][0] >= t:
+            return # the same frame again
+        samples.append(sample)
+        del samples[:-2]
+        self.fresh.add(str(cameraId))
+
+    #==============================================================================================
+    # Output
+    #==============================================================================================
+    def aligned(self,t,cameras=None):
+        '''
+        Positions of *cameras* (default: all) at time *t*: list of (camera id, x, y, variance).
+        Each is extrapolated from the last two detections of its camera; stale cameras are left out.
+        '''
+        result = []
+        for cameraId in (self.history if cameras is None else cameras):
+            samples = self.history[cameraId]
+            t1, x1, y1 = samples[-1]
+            age = t - t1
+            if age > self.maxAge:
+                continue
+            variance = self.cameras[cameraId].sigma ** 2
+            if len(samples) == 2 and age != 0:
+                t0, x0, y0 = samples[0]
+                if t1 - t0 <= self.maxAge:
+                    k = age / (t1 - t0)
+                    x1 = x1 + (x1 - x0) * k
+                    y1 = y1 + (y1 - y0) * k
+                    variance *= (1 + k) ** 2 + k ** 2 # both detections contribute their noise
+            result.append((cameraId, x1, y1, variance))
+        return result
+
+    def update(self):
+        '''
+        Fuse the new detections at the time of the newest one. Every detection is used once.
+        Returns a FusedPose, or None if there is no estimate.
+        '''
+        if not self.fresh:
+            return None if self.state is None else self.pose()
+        t = max(self.history[cameraId][-1][0] for cameraId in self.fresh)
+        if self.t is not None:
+            t = max(t,self.t) # the filter cannot go back in time
+        restart = self.state is None or t - self.t > self.restartAfter
+        measurements = self.aligned(t,None if restart else self.fresh)
+        self.fresh = set()
+        if not measurements:
+            return None if restart else self.pose()
+        if restart:
+            # (re)start from the mean position, at rest with a large velocity uncertainty
+            variance = min(m[3] for m in measurements)
+            self.state = np.array([np.mean([m[1] for m in measurements]), np.mean([m[2] for m in measurements]), 0.0, 0.0])
+            self.covariance = np.diag([variance, variance, 1e6, 1e6])
+            self.t = t
+        else:
+            self._predict(t)
+        for _, x, y, variance in measurements:
+            self._correct(x,y,variance)
+        return self.pose([m[0] for m in measurements])
+
+    def predict(self,lookahead):
+        ''' Pose *lookahead* ns after the current estimate, without changing it '''
+        if self.state is None:
+            return None
+        state, covariance = self._propagate(lookahead)
+        return FusedPose(self.t, state[0], state[1], state[2], state[3], covariance, [], lookahead)
+
+    def pose(self,cameras=()):
+        s = self.state
+        return FusedPose(self.t, s[0], s[1], s[2], s[3], self.covariance.copy(), list(cameras), 0)
+
+    #==============================================================================================
+    # Constant-velocity Kalman filter. Time in seconds.
+    #==============================================================================================
+    def _propagate(self,dtNs):
+        dt = dtNs / NS_PER_S
+        F = np.eye(4)
+        F[0,2] = F[1,3] = dt
+        q = self.accelerationSigma ** 2
+        Q = np.zeros((4,4))
+        Q[0,0] = Q[1,1] = q * dt ** 3 / 3
+        Q[0,2] = Q[2,0] = Q[1,3] = Q[3,1] = q * dt ** 2 / 2
+        Q[2,2] = Q[3,3] = q * dt
+        return F @ self.state, F @ self.covariance @ F.T + Q
+
+    def _predict(self,t):
+        if t > self.t:
+            self.state, self.covariance = self._propagate(t - self.t)
+            self.t = t
+
+    def _correct(self,x,y,variance):
+        P = self.covariance
+        S = P[:2,:2] + np.eye(2) * variance
+        K = P[:,:2] @ np.linalg.inv(S)
+        self.state = self.state + K @ (np.array([x, y]) - self.state[:2])
+        self.covariance = P - K @ P[:2,:]
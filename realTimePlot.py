@@ -1,4 +1,5 @@
 import matplotlib
+import threading
 import numpy as np
 from PyQt5.QtCore import pyqtSlot
 from matplotlib.figure import Figure
@@ -8,20 +9,24 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
 class CustomFigCanvas(TimedAnimation, FigureCanvas):
     ''' A class that inherited matplotlib backend. used for plotting field value in real time. '''
-    def __init__(self):
-        self.addedDataX = []
-        self.addedDataY = []
-        self.addedDataZ = []
+    def __init__(self,historyLength=10000,timeWindow=10.0,displayPoints=1000):
+        '''
+        @param historyLength: number of (t,x,y,z) samples kept in the ring buffer
+        @param timeWindow: time span shown on the x axis (s)
+        @param displayPoints: maximum number of points drawn per line. Longer histories are
+                              decimated to the min and max of each bin, so peaks are not lost.
+        '''
         self.ylimRange = [-14,14]
         self.isZoomed = False
         # print(matplotlib.__version__)
 
-        # data
-        self.numberOfSamplesStored = 200
-        self.t = np.linspace(0, self.numberOfSamplesStored - 1, self.numberOfSamplesStored)
-        self.x = (self.t * 0.0)
-        self.y = (self.t * 0.0)
-        self.z = (self.t * 0.0)
+        # data: ring buffer of (t,x,y,z) records
+        self.historyLength = historyLength
+        self.timeWindow = timeWindow
+        self.displayPoints = displayPoints
+        self.data = np.zeros((historyLength,4))
+        self.count = 0 # number of records added so far
+        self.lock = threading.Lock()
         # The window
         self.fig = Figure(figsize=(5,5), dpi=100)
         self.fig.patch.set_facecolor((0.92, 0.92, 0.92))
@@ -50,9 +55,9 @@ class CustomFigCanvas(TimedAnimation, FigureCanvas):
         self.ax1.add_line(self.line3_tail)
         self.ax1.add_line(self.line3_head)
         #lim
-        self.ax1.set_xlim(0, self.numberOfSamplesStored - 1)
+        self.ax1.set_xlim(-timeWindow, 0)
         self.ax1.set_ylim(self.ylimRange[0], self.ylimRange[1])
-        self.ax1.get_xaxis().set_visible(False)
+        self.ax1.set_xlabel('time (s)')
         # init
         FigureCanvas.__init__(self, self.fig)
         TimedAnimation.__init__(self, self.fig, interval = 50, blit = True)
@@ -60,12 +65,51 @@ class CustomFigCanvas(TimedAnimation, FigureCanvas):
     # ========================================================
     # connected to signel callback signal
     # ========================================================
-    def addDataX(self, value): self.addedDataX.append(value)
-    def addDataY(self, value): self.addedDataY.append(value)
-    def addDataZ(self, value): self.addedDataZ.append(value)
+    def addData(self, t, x, y, z):
+        '''
+        Add one sample or a batch of samples. t (s) and x, y, z (mT) are scalars or arrays of the same length.
+        Can be called from any thread.
+        '''
+        records = np.column_stack(np.broadcast_arrays(t, x, y, z))[-self.historyLength:]
+        n = len(records)
+        with self.lock:
+            i = self.count % self.historyLength
+            first = min(n, self.historyLength - i)
+            self.data[i:i + first] = records[:first]
+            self.data[:n - first] = records[first:] # wrap around
+            self.count += n
+
+    def history(self):
+        ''' Return a copy of the stored records (t,x,y,z), oldest first '''
+        with self.lock:
+            n = min(self.count, self.historyLength)
+            i = self.count % self.historyLength
+            if n < self.historyLength:
+                return self.data[:n].copy()
+            return np.concatenate((self.data[i:], self.data[:i]))
+
+    def decimate(self, records):
+        ''' Reduce to at most displayPoints points: the min and the max of each bin, in time order '''
+        bins = self.displayPoints // 2
+        if len(records) <= self.displayPoints or bins == 0:
+            return records
+        size = len(records) // bins
+        blocks = records[len(records) - bins * size:].reshape(bins, size, 4) # the oldest remainder is dropped
+        rows = np.arange(bins)
+        iMin = blocks[:, :, 1:].argmin(axis=1) # (bins, 3) per component
+        iMax = blocks[:, :, 1:].argmax(axis=1)
+        first = np.minimum(iMin, iMax)
+        second = np.maximum(iMin, iMax)
+        out = np.empty((bins, 2, 4))
+        out[:, 0, 0] = blocks[:, 0, 0] # time of the bin
+        out[:, 1, 0] = blocks[:, -1, 0]
+        for c in range(3):
+            out[:, 0, c + 1] = blocks[rows, first[:, c], c + 1]
+            out[:, 1, c + 1] = blocks[rows, second[:, c], c + 1]
+        return out.reshape(-1, 4)
 
     def new_frame_seq(self):
-        return iter(range(self.t.size))
+        return iter(range(self.historyLength))
 
     def _init_draw(self):
         lines = [self.line1, self.line1_tail, self.line1_head,self.line2, self.line2_tail, self.line2_head,self.line3, self.line3_tail, self.line3_head]
@@ -81,31 +125,24 @@ class CustomFigCanvas(TimedAnimation, FigureCanvas):
         self.isZoomed = not self.isZoomed
 
     def _draw_frame(self, frame):
-        margin = 2
-        
-        # Process all added data points
-        while len(self.addedDataX) > 0:
-            self.x = np.roll(self.x, -1)
-            self.y = np.roll(self.y, -1)
-            self.z = np.roll(self.z, -1)
-            self.x[-1] = self.addedDataX.pop(0)  # Pop from the front of the list
-            self.y[-1] = self.addedDataY.pop(0)
-            self.z[-1] = self.addedDataZ.pop(0)
-        
-        # Set the data for lines
-        self.line1.set_data(self.t[:-margin], self.x[:-margin])
-        self.line2.set_data(self.t[:-margin], self.y[:-margin])
-        self.line3.set_data(self.t[:-margin], self.z[:-margin])
-
-        # Update tails with the last 10 points + margin
-        self.line1_tail.set_data(np.concatenate((self.t[-10:-1-margin], [self.t[-1-margin]])), np.concatenate((self.x[-10:-1-margin], [self.x[-1-margin]])))
-        self.line2_tail.set_data(np.concatenate((self.t[-10:-1-margin], [self.t[-1-margin]])), np.concatenate((self.y[-10:-1-margin], [self.y[-1-margin]])))
-        self.line3_tail.set_data(np.concatenate((self.t[-10:-1-margin], [self.t[-1-margin]])), np.concatenate((self.z[-10:-1-margin], [self.z[-1-margin]])))
+        records = self.history()
+        if len(records) == 0:
+            return []
+        tNow = records[-1, 0]
+        records = records[np.searchsorted(records[:, 0], tNow - self.timeWindow):] # inside the window
+        t = records[:, 0] - tNow
+        tail = records[-10:]
+        shown = self.decimate(records)
+        tShown = shown[:, 0] - tNow
+        tTail = tail[:, 0] - tNow
 
-        # Set heads (last point with margin)
-        self.line1_head.set_data([self.t[-1-margin]], [self.x[-1-margin]])
-        self.line2_head.set_data([self.t[-1-margin]], [self.y[-1-margin]])
-        self.line3_head.set_data([self.t[-1-margin]], [self.z[-1-margin]])
+        for c, (line, lineTail, lineHead) in enumerate([(self.line1, self.line1_tail, self.line1_head),
+                                                       (self.line2, self.line2_tail, self.line2_head),
+                                                       (self.line3, self.line3_tail, self.line3_head)]):
+            line.set_data(tShown, shown[:, c + 1])
+            # tail: the last 10 samples, head: the newest sample
+            lineTail.set_data(tTail, tail[:, c + 1])
+            lineHead.set_data([t[-1]], [records[-1, c + 1]])
 
         # Return all updated lines for blitting
         return [self.line1, self.line1_tail, self.line1_head,
@@ -0,0 +1,145 @@
+"""
+=============================================================================
+recorder.py
+----------------------------------------------------------------------------
+Video recording in a background thread.
+Frames are put into a bounded queue and encoded by one thread per recorder,
+so encoding never blocks the frame processing. When the queue is full the
+frame is dropped and counted instead. The video size is taken from the
+first frame, and the timestamp of every written frame is saved next to the
+video in <fileName>.timestamps.csv.
+
+Snapshots are written by a small thread pool shared by all cameras.
+=============================================================================
+"""
+import os
+import time
+import datetime
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import filterlib
+
+class VideoRecorder(object):
+    def __init__(self,fileName,fps=30.0,fourcc='XVID',queueSize=64):
+        '''
+        @param fileName: video file
+        @param fps: frame rate written into the video file
+        @param queueSize: maximum number of frames waiting to be encoded
+        '''
+        self.fileName = fileName
+        self.fps = fps
+        self.fourcc = fourcc
+        self.frameSize = None # (width, height), set by the first frame
+        self.framesWritten = 0
+        self.framesDropped = 0
+        self.maxBacklog = 0
+        self._queue = queue.Queue(maxsize=queueSize)
+        self._thread = threading.Thread(target=self._encodeLoop,daemon=True)
+        self._thread.start()
+
+    def backlog(self):
+        ''' Number of frames waiting to be encoded '''
+        return self._queue.qsize()
+
+    #==============================================================================================
+    # Called from the frame processing thread. Never blocks.
+    #==============================================================================================
+    def write(self,frame,timestamp=None):
+        '''
+        @param frame: image. It is copied, so the caller can reuse its buffer.
+        @param timestamp: time.perf_counter_ns() at which the frame was grabbed
+        '''
+        try:
+            self._queue.put_nowait((frame.copy(), timestamp))
+        except queue.Full:
+            self.framesDropped += 1
+            return
+        backlog = self._queue.qsize()
+        if backlog > self.maxBacklog:
+            self.maxBacklog = backlog
+
+    def stop(self):
+        ''' Encode the frames that are still queued, then close the file '''
+        self._queue.put((None, None))
+        self._thread.join()
+        print('{}: {} frames written, {} dropped, max backlog {}'.format(
+            self.fileName, self.framesWritten, self.framesDropped, self.maxBacklog))
+
+    #==============================================================================================
+    # Encoder thread
+    #==============================================================================================
+    def _encodeLoop(self):
+        writer = None
+        sidecar = open(self.fileName + '.timestamps.csv','w')
+        sidecar.write('frame,timestamp_ns\n')
+        try:
+            while True:
+                frame, timestamp = self._queue.get()
+                if frame is None:
+                    break
+                frame = filterlib.color(frame)
+                if writer is None:
+                    self.frameSize = (frame.shape[1], frame.shape[0])
+                    writer = cv2.VideoWriter(self.fileName,fourcc=cv2.VideoWriter_fourcc(*self.fourcc),
+                                             fps=self.fps,frameSize=self.frameSize,isColor=True)
+                elif (frame.shape[1], frame.shape[0]) != self.frameSize:
+                    frame = cv2.resize(frame,self.frameSize) # VideoWriter drops frames of another size
+                writer.write(frame)
+                sidecar.write('{},{}\n'.format(self.framesWritten, '' if timestamp is None else timestamp))
+                self.framesWritten += 1
+        finally:
+            if writer is not None:
+                writer.release()
+            sidecar.close()
+
+
+#=============================================================================================
+# Snapshots
+# save() copies the frame and returns immediately; the file is written by the pool.
+#=============================================================================================
+SNAPSHOT_WORKERS = 2
+_snapshotPool = ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS,thread_name_prefix='snapshot') # threads start on first use
+
+class SnapshotWriter(object):
+    def __init__(self,directory='.',fileFormat='png',pngCompression=1):
+        '''
+        @param fileFormat: 'png' or 'npy' (raw array, fastest)
+        @param pngCompression: 0 (fast, big files) to 9 (slow, small files). cv2.imwrite uses 3 by default.
+        '''
+        self.directory = directory
+        self.setFormat(fileFormat,pngCompression)
+
+    def setFormat(self,fileFormat,pngCompression=1):
+        if fileFormat not in ('png','npy'):
+            print('Unknown snapshot format {}'.format(fileFormat))
+            return
+        self.fileFormat = fileFormat
+        self.pngCompression = pngCompression
+
+    def save(self,frame,cameraId,hardwareTimestamp=None):
+        '''
+        Queue *frame* for writing and return the file name. The camera id and the camera timestamp
+        are part of the name, so snapshots of several cameras in the same second do not collide.
+        '''
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        if hardwareTimestamp is None:
+            hardwareTimestamp = time.perf_counter_ns()
+        fileName = os.path.join(self.directory,'snapshot_cam{}_{}_{}.{}'.format(cameraId,stamp,hardwareTimestamp,self.fileFormat))
+        _snapshotPool.submit(self._write,fileName,frame.copy(),self.fileFormat,self.pngCompression)
+        return fileName
+
+    @staticmethod
+    def _write(fileName,frame,fileFormat,pngCompression):
+        start = time.perf_counter()
+        try:
+            if fileFormat == 'npy':
+                np.save(fileName,frame)
+            else:
+                cv2.imwrite(fileName,filterlib.color(frame),[cv2.IMWRITE_PNG_COMPRESSION,pngCompression])
+        except Exception as e:
+            print('❌ snapshot {} failed: {}'.format(fileName,e))
+            return
+        print('✅ snapshot: {} ({:.1f} ms to write)'.format(fileName,(time.perf_counter() - start) * 1e3))
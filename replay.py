@@ -0,0 +1,269 @@
+"""
+=============================================================================
+replay.py
+----------------------------------------------------------------------------
+Runs Vision and a SubThread mode on recorded frames instead of the cameras,
+with the simulated S826, to measure detection and control without the rig.
+    python replay.py data/raw/run1 --mode swimmerPathFollowing --params 10,5,0,0,0
+    python replay.py path1.avi --filters "grey()" "threshold(100,255)"
+The source is a raw frame store (a directory written by Vision.startRawCapture)
+or a video. The times of the frames of a video are read from its
+<file>.timestamps.csv (recorder.VideoRecorder) or derived from its fps.
+
+The run is deterministic: the same source, mode and params give the same
+commands and DAC writes. The frames keep their recorded timestamps and the
+mode runs on a scheduler.SimulatedClock that follows them. For each frame
+the clock first executes the DAC ticks of the fixed-rate loops up to the
+frame time (+ --delay, the simulated processing time). Then the frame
+goes through process_frame, and the control law of the mode runs once for
+it before the next frame is fed (lockstep). --speed only paces the replay
+on the wall clock; 0 runs as fast as possible. Modes that do not use
+runFixedRate(), runPrecomputed() or closedLoop (fromCSV) cannot be
+replayed.
+
+The report has the frames/s through process_frame (wall clock), the
+closed-loop commands per second of the recording, the DAC statistics in
+simulated time, the tracing statistics and the trajectory of the agent
+(detections, path length, speed). The vision.* and dac.write stages are
+wall clock, the frame.* stages simulated time. --out saves the trajectory
+with the field after each frame and the DAC writes to an .npz file.
+=============================================================================
+"""
+import os
+import csv
+import time
+import itertools
+import threading
+import argparse
+import numpy as np
+import cv2
+from scheduler import waitUntil, SimulatedClock, NS_PER_S
+from frameStore import FrameStoreReader
+from vision import Vision
+from fieldManager import FieldManager
+from simS826 import SimulatedS826
+from subThread import SubThread
+import tracing
+
+# OpenCV names the Bayer patterns by the second row, pylon by the first
+BAYER_CONVERSION = {
+    'BayerRG8': cv2.COLOR_BayerBG2BGR,
+    'BayerBG8': cv2.COLOR_BayerRG2BGR,
+    'BayerGR8': cv2.COLOR_BayerGB2BGR,
+    'BayerGB8': cv2.COLOR_BayerGR2BGR,
+}
+
+#=============================================================================================
+# Sources. A source yields (frame, timestamp) with the recorded timestamp in ns.
+#=============================================================================================
+class FrameStoreSource(object):
+    def __init__(self,directory):
+        self.reader = FrameStoreReader(directory)
+        self.conversion = BAYER_CONVERSION.get(self.reader.pixelFormat)
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __iter__(self):
+        for i in range(len(self.reader)):
+            frame = self.reader[i]
+            if self.conversion is not None:
+                frame = cv2.cvtColor(frame,self.conversion)
+            else:
+                frame = np.array(frame) # copy out of the memory map, the filters may write into it
+            yield frame, int(self.reader.timestamps[i])
+
+class VideoSource(object):
+    def __init__(self,fileName):
+        self.fileName = fileName
+        capture = cv2.VideoCapture(fileName)
+        if not capture.isOpened():
+            raise IOError('replay: cannot open {}'.format(fileName))
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self.frameCount = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        capture.release()
+        self.timestamps = {}
+        sidecar = fileName + '.timestamps.csv'
+        if os.path.exists(sidecar):
+            with open(sidecar) as f:
+                for row in csv.DictReader(f):
+                    if row['timestamp_ns']:
+                        self.timestamps[int(row['frame'])] = int(row['timestamp_ns'])
+
+    def __len__(self):
+        return self.frameCount
+
+    def __iter__(self):
+        capture = cv2.VideoCapture(self.fileName)
+        period = NS_PER_S / self.fps
+        i = 0
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield frame, self.timestamps.get(i, int(i * period))
+                i += 1
+        finally:
+            capture.release()
+
+def openSource(path):
+    if os.path.isdir(path):
+        return FrameStoreSource(path)
+    return VideoSource(path)
+
+#=============================================================================================
+# Replay
+#=============================================================================================
+class Replay(object):
+    def __init__(self,source,vision=None,mode=None,params=None,speed=0,delay=0.0):
+        '''
+        @param source: FrameStoreSource or VideoSource
+        @param vision: Vision the frames are fed to, configured by the caller
+        @param mode: name of the SubThread mode to run, or None
+        @param params: the 5 parameters of the mode
+        @param speed: wall-clock pacing relative to the recording; 0 = as fast as possible.
+                      The results do not depend on it.
+        @param delay: simulated time (s) from the timestamp of a frame to the end of its processing
+        '''
+        self.source = source
+        self.vision = vision or Vision(index=1,type='replay')
+        self.dac = None # SimulatedS826 on the simulated clock, made by run()
+        self.field = None
+        self.mode = mode
+        self.params = list(params or [0,0,0,0,0])
+        self.speed = speed
+        self.delay = int(delay * NS_PER_S)
+        self.clock = None
+        self.trajectory = None # (N,7): frame timestamp, x, y, orientation, field x, y, z after the frame
+        self.duration = 0.0 # wall clock (s)
+        self.simulatedDuration = 0.0 # recording time covered (s)
+        self.processTimes = None # ns per process_frame call
+
+    def run(self):
+        frames = iter(self.source)
+        first = next(frames,None)
+        if first is None:
+            raise ValueError('replay: the source has no frames')
+        self.clock = clock = SimulatedClock(first[1])
+        self.dac = SimulatedS826(clock=clock.now)
+        self.field = FieldManager(self.dac)
+        thrd = None
+        worker = None
+        if self.mode:
+            thrd = SubThread(self.field,self.vision,None,None)
+            thrd.recordVideo = False
+            thrd.clock = clock
+            thrd.setup(self.mode)
+            thrd.params = self.params
+            thrd.statusSignal.connect(print)
+            worker = threading.Thread(target=thrd.run,daemon=True)
+        isAlive = worker.is_alive if worker is not None else (lambda: False)
+        tracing.tracer.reset()
+        trajectory = []
+        processTimes = []
+        if worker is not None:
+            worker.start()
+        start = time.perf_counter_ns()
+        try:
+            for frame, timestamp in itertools.chain([first],frames):
+                # the mode has handled the previous frame and waits for the next one
+                if not clock.waitIdle(isAlive):
+                    raise RuntimeError('replay: the mode {} does not run on the simulated clock'.format(self.mode))
+                if worker is not None and not worker.is_alive():
+                    print('replay: the mode {} ended after {} frames'.format(self.mode,len(trajectory)))
+                    break
+                if self.speed > 0:
+                    waitUntil(start + int((timestamp - first[1]) / self.speed))
+                clock.advance(timestamp + self.delay)
+                processStart = time.perf_counter_ns()
+                self.vision.process_frame(frame,timestamp,timestamp)
+                processTimes.append(time.perf_counter_ns() - processStart)
+                clock.frame()
+                _, x, y, orientation = self.vision.agentState
+                state = self.field.state
+                trajectory.append((timestamp, x, y, orientation, state.x, state.y, state.z))
+            clock.waitIdle(isAlive) # the command of the last frame
+        finally:
+            self.duration = (time.perf_counter_ns() - start) / NS_PER_S
+            self.simulatedDuration = (clock.now() - first[1]) / NS_PER_S
+            if thrd is not None:
+                thrd.stop()
+                clock.close()
+                worker.join()
+        self.trajectory = np.array(trajectory,dtype=np.float64).reshape(-1,7)
+        self.processTimes = np.array(processTimes,dtype=np.int64)
+
+    #==============================================================================================
+    # Metrics. Commands and DAC writes are in simulated time; process_frame times are wall clock.
+    #==============================================================================================
+    def metrics(self):
+        frames = len(self.trajectory)
+        command = tracing.tracer.stages.get('frame.command')
+        commands = command.count if command is not None else 0
+        dac = self.dac.sim.stats()
+        seconds = self.simulatedDuration
+        result = {'frames': frames, 'duration': self.duration, 'simulatedDuration': seconds,
+                  'framesPerSecond': frames / self.duration if self.duration else 0.0,
+                  'commands': commands,
+                  'commandsPerSecond': commands / seconds if seconds else 0.0,
+                  'dac': dac,
+                  'process': tuple(np.percentile(self.processTimes,[50,99])) + (int(self.processTimes.max()),)
+                             if frames else (0, 0, 0)}
+        # the agent keeps its last position when nothing is found
+        t, x, y = self.trajectory[:,0] / NS_PER_S, self.trajectory[:,1], self.trajectory[:,2]
+        found = np.flatnonzero((x != 0) | (y != 0))
+        steps = np.hypot(np.diff(x[found]),np.diff(y[found])) if len(found) > 1 else np.zeros(0)
+        span = t[found[-1]] - t[found[0]] if len(found) > 1 else 0.0
+        result['detections'] = len(found)
+        result['pathLength'] = float(steps.sum())
+        result['meanSpeed'] = float(steps.sum() / span) if span > 0 else 0.0
+        result['maxStep'] = float(steps.max()) if len(steps) else 0.0
+        return result
+
+    def report(self):
+        m = self.metrics()
+        lines = ['{} frames ({:.2f} s recorded) in {:.2f} s: {:.1f} frames/s, process_frame p50/p99/max {:.2f}/{:.2f}/{:.2f} ms'.format(
+                     m['frames'], m['simulatedDuration'], m['duration'], m['framesPerSecond'], *[v / 1e6 for v in m['process']]),
+                 '{} commands, {:.1f} commands/s'.format(m['commands'], m['commandsPerSecond']),
+                 'DAC (simulated time): ' + self.dac.sim.report(),
+                 'trajectory: {} detections, path {:.1f} px, mean speed {:.1f} px/s, max step {:.1f} px'.format(
+                     m['detections'], m['pathLength'], m['meanSpeed'], m['maxStep']),
+                 '{:<22}{:>8}{:>9}{:>9}{:>9}{:>9}  ms'.format('stage','count','p50','p95','p99','max')]
+        # frame.detected compares the recorded timestamp with the wall clock; it means nothing here
+        stages = {stage: h for stage, h in tracing.tracer.stages.items() if stage != 'frame.detected'}
+        for stage, (count, p50, p95, p99, pmax) in tracing.tracer.summary(stages).items():
+            lines.append('{:<22}{:>8}{:>9.3f}{:>9.3f}{:>9.3f}{:>9.3f}'.format(
+                stage, count, p50 / 1e6, p95 / 1e6, p99 / 1e6, pmax / 1e6))
+        return '\n'.join(lines)
+
+    def save(self,path):
+        ''' Trajectory, process_frame times and DAC writes (simulated timestamps, channels, setpoints) as .npz '''
+        timestamps, channels, setpoints = self.dac.sim.records()
+        np.savez(path,trajectory=self.trajectory,processTimes=self.processTimes,
+                 dacTimestamps=timestamps,dacChannels=channels,dacSetpoints=setpoints)
+        return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run Vision and a SubThread mode on recorded frames')
+    parser.add_argument('source',help='raw frame store directory or video file')
+    parser.add_argument('--mode',default=None,help='SubThread mode, e.g. swimmerPathFollowing')
+    parser.add_argument('--params',default='0,0,0,0,0',help='the 5 parameters of the mode')
+    parser.add_argument('--speed',type=float,default=0,help='wall-clock pacing relative to the recording, 0 = as fast as possible')
+    parser.add_argument('--delay',type=float,default=0,help='simulated processing time of a frame (ms)')
+    parser.add_argument('--filters',nargs='*',default=['grey()','threshold(100,255)'],help='filter routing, one filter per argument')
+    parser.add_argument('--detection',default='detectBiggestContour',help='algorithm in objectDetection.py')
+    parser.add_argument('--out',default=None,help='save the trajectory and the DAC writes to this .npz file')
+    args = parser.parse_args()
+
+    vision = Vision(index=1,type='replay')
+    vision.createFilterRouting(args.filters)
+    vision.setStateFiltersBypassed(False)
+    vision.setStateObjectDetection(True,args.detection)
+    source = openSource(args.source)
+    print('replay: {} frames from {}'.format(len(source),args.source))
+    replay = Replay(source,vision,args.mode,[float(p) for p in args.params.split(',')],args.speed,args.delay / 1e3)
+    replay.run()
+    print(replay.report())
+    if args.out:
+        print('saved to {}'.format(replay.save(args.out)))
@@ -1,14 +1,50 @@
-from ctypes import cdll
-s826dll = cdll.LoadLibrary("./lib826_64.so")
+import time
+from ctypes import cdll, c_int, c_uint, CDLL
+import numpy as np
+DLL_PATH = "./lib826_64.so"
+s826dll = None # loaded on first use, so that this module can be imported without the board
 BOARD = 0
 RANGE_PARAM = [[0,5],[0,10],[-5,10],[-10,20]] # rangeCode = 0, 1, 2, 3     [lowerV,rangeV]
+NUM_CHANNELS = 8
+ALL_CHANNELS = np.arange(NUM_CHANNELS)
+SETPOINT_MAX = 0xffff # 16-bit DAC
 
+def loadLibrary(path=DLL_PATH):
+    global s826dll
+    if s826dll is None:
+        s826dll = cdll.LoadLibrary(path)
+    return s826dll
 
+#=============================================================================================
+# Look up a function in the shared library once and declare its signature,
+# so that ctypes does not have to guess the argument types on every call.
+#=============================================================================================
+def bindFunction(dll,name,argtypes,restype=c_int):
+    func = getattr(dll,name)
+    if isinstance(dll,CDLL):
+        func.argtypes = argtypes
+        func.restype = restype
+    return func
 
+
+#=============================================================================================
+# DAC backend
+# *dll* is the library that talks to the board. By default the Sensoray driver is loaded.
+# Any object that provides S826_SystemOpen, S826_SystemClose, S826_DacRangeWrite and
+# S826_DacDataWrite with the same arguments can be used instead (see simS826.py).
+#=============================================================================================
 class S826(object):
-    def __init__(self):
-        self.lowerV = [-5,-5,-5,-5,-5,-5,-5,-5]  # default range selection = 2
-        self.rangeV = [10,10,10,10,10,10,10,10]  # default range selection = 2
+    def __init__(self,dll=None):
+        if dll is None:
+            dll = loadLibrary()
+        self.dll = dll
+        self.lowerV = np.full(NUM_CHANNELS,-5.0)  # default range selection = 2
+        self.rangeV = np.full(NUM_CHANNELS,10.0)  # default range selection = 2
+        self.lastWriteLatency = 0 # duration of the last s826_writeSetpoints call (ns)
+        self._systemOpen = bindFunction(dll,'S826_SystemOpen',[])
+        self._systemClose = bindFunction(dll,'S826_SystemClose',[])
+        self._dacRangeWrite = bindFunction(dll,'S826_DacRangeWrite',[c_uint,c_uint,c_uint,c_uint])
+        self._dacDataWrite = bindFunction(dll,'S826_DacDataWrite',[c_uint,c_uint,c_uint,c_uint])
         errcode = self.s826_init()
         if errcode != 1:
             print('Cannot detect s826 board. Error code: {}'.format(errcode))
@@ -17,14 +53,14 @@ class S826(object):
         self.s826_initRange()
 
     def s826_init(self):
-        errCode = s826dll.S826_SystemOpen()
+        errCode = self._systemOpen()
         return errCode
 
     def s826_close(self):
-        s826dll.S826_SystemClose()
+        self._systemClose()
 
     def s826_initRange(self):
-        for i in range(8):
+        for i in range(NUM_CHANNELS):
             self.s826_setRange(i,2)
 
     # ======================================================================
@@ -33,7 +69,7 @@ class S826(object):
     def s826_setRange(self,chan,rangeCode):
         self.lowerV[chan] = RANGE_PARAM[rangeCode][0]
         self.rangeV[chan] = RANGE_PARAM[rangeCode][1]
-        s826dll.S826_DacRangeWrite(BOARD,chan,rangeCode,0) # BOARD, chan, rangeCode, output V
+        self._dacRangeWrite(BOARD,chan,rangeCode,0) # BOARD, chan, rangeCode, output V
 
     # ======================================================================
     # Set 1 AO channel.
@@ -43,9 +79,45 @@ class S826(object):
     def s826_aoPin(self,chan,outputV):
         lowerV = self.lowerV[chan]
         rangeV = self.rangeV[chan]
-        setpoint = int((outputV-lowerV)/rangeV*0xffff)
-        # 加入打印，看看写入 DAC 的值
+        setpoint = int((outputV-lowerV)/rangeV*SETPOINT_MAX)
+        setpoint = min(max(setpoint,0),SETPOINT_MAX)
         # print(f"Writing to DAC: Channel={chan}, OutputV={outputV}, Setpoint={setpoint}")
-        s826dll.S826_DacDataWrite(BOARD,chan,setpoint,0)
-        err = s826dll.S826_DacDataWrite(BOARD, chan, setpoint, 0)
-    
+        self._dacDataWrite(BOARD,chan,setpoint,0)
+        return setpoint
+
+    # ======================================================================
+    # Set several AO channels in one call.
+    # outputV: array of desired output voltages, one per channel in *chans*.
+    # chans: DAC channel #s. All 8 channels (0 to 7) are written if None.
+    # Returns the 16-bit setpoints that were written.
+    # ======================================================================
+    def s826_aoChannels(self,outputV,chans=None):
+        if chans is None:
+            chans = ALL_CHANNELS
+        setpoints = self.s826_toSetpoints(outputV,chans)
+        self.s826_writeSetpoints(setpoints,chans)
+        return setpoints
+
+    # ======================================================================
+    # Convert output voltages to 16-bit setpoints (clamped to the range of each channel).
+    # ======================================================================
+    def s826_toSetpoints(self,outputV,chans=None):
+        if chans is None:
+            chans = ALL_CHANNELS
+        chans = np.asarray(chans)
+        scaled = (np.asarray(outputV,dtype=float) - self.lowerV[chans]) / self.rangeV[chans] * SETPOINT_MAX
+        return np.clip(scaled,0,SETPOINT_MAX).astype(np.uint16)
+
+    # ======================================================================
+    # Write precomputed setpoints. Each channel is written exactly once.
+    # The time spent in the write is stored in *lastWriteLatency* (ns).
+    # ======================================================================
+    def s826_writeSetpoints(self,setpoints,chans=None):
+        if chans is None:
+            chans = ALL_CHANNELS
+        write = self._dacDataWrite
+        pairs = zip(np.asarray(chans).tolist(),np.asarray(setpoints).tolist())
+        start = time.perf_counter_ns()
+        for chan, setpoint in pairs:
+            write(BOARD,chan,setpoint,0)
+        self.lastWriteLatency = time.perf_counter_ns() - start
@@ -0,0 +1,224 @@
+"""
+=============================================================================
+scheduler.py
+----------------------------------------------------------------------------
+Fixed-rate loop used by the waveform modes of SubThread.
+Ticks are scheduled on absolute time.perf_counter_ns() deadlines, so that
+timing errors do not accumulate. The thread sleeps until shortly before a
+deadline and yields in a short spin for the rest of the wait.
+
+SimulatedClock replaces the wall clock for offline runs (replay.py): the
+loops and the detection waits of a SubThread mode are stepped by the
+thread that drives the clock, so a run only depends on its input.
+=============================================================================
+"""
+import time
+import threading
+import numpy as np
+
+NS_PER_S = 1000000000
+SPIN_TIME = 200000 # ns
+
+#=============================================================================================
+# Sleep until shortly before the deadline (perf_counter_ns), then spin.
+# time.sleep(0) releases the GIL while spinning so that the GUI thread is not starved.
+#=============================================================================================
+def waitUntil(deadline,spinTime=SPIN_TIME):
+    remaining = deadline - time.perf_counter_ns()
+    if remaining > spinTime:
+        time.sleep((remaining - spinTime) / NS_PER_S)
+    while time.perf_counter_ns() < deadline:
+        time.sleep(0)
+
+class FixedRateLoop(object):
+    def __init__(self,rate=2000,spinTime=SPIN_TIME,reportInterval=1.0,historySize=1<<16):
+        '''
+        @param rate: update rate (Hz)
+        @param spinTime: the last *spinTime* ns before a deadline are spent spinning instead of sleeping
+        @param reportInterval: how often (s) the statistics are reported
+        @param historySize: number of wake-up latencies kept for the jitter percentiles
+        '''
+        self.spinTime = spinTime
+        self.reportInterval = reportInterval
+        self.setRate(rate)
+        self.ticks = 0
+        self.overruns = 0
+        self._lateness = np.zeros(historySize,dtype=np.int64)
+
+    def setRate(self,rate):
+        self.rate = rate
+        self.period = int(NS_PER_S / rate)
+
+    def waitUntil(self,deadline):
+        waitUntil(deadline,self.spinTime)
+
+    #==============================================================================================
+    # Call tick(t) once per period until isStopped() returns True.
+    # t is the scheduled time (s) since the start, not the time of wake-up.
+    # If a tick finishes after the next deadline, it is counted as an overrun and the
+    # deadlines that were missed are skipped instead of being executed in a burst.
+    # report(str) is called every *reportInterval* seconds.
+    #==============================================================================================
+    def run(self,tick,isStopped,report=None):
+        lateness = self._lateness
+        historySize = len(lateness)
+        start = time.perf_counter_ns()
+        deadline = start
+        nextReport = start + int(self.reportInterval * NS_PER_S)
+        reportTicks = 0
+        reportStart = start
+        while not isStopped():
+            self.waitUntil(deadline)
+            lateness[self.ticks % historySize] = time.perf_counter_ns() - deadline
+            tick((deadline - start) / NS_PER_S)
+            self.ticks += 1
+            deadline += self.period
+            now = time.perf_counter_ns()
+            if now > deadline:
+                self.overruns += 1
+                deadline += ((now - deadline) // self.period + 1) * self.period
+            if now >= nextReport:
+                if report is not None:
+                    report(self.summary(self.ticks - reportTicks,now - reportStart))
+                reportTicks = self.ticks
+                reportStart = now
+                nextReport = now + int(self.reportInterval * NS_PER_S)
+
+    #==============================================================================================
+    # Statistics
+    #==============================================================================================
+    def jitter(self,n=None):
+        ''' Return p50, p99 and max of the wake-up latency (ns) of the last *n* ticks. '''
+        n = min(self.ticks,len(self._lateness)) if n is None else min(n,self.ticks,len(self._lateness))
+        if n == 0:
+            return 0, 0, 0
+        i = self.ticks % len(self._lateness)
+        samples = np.concatenate((self._lateness[i:],self._lateness[:i]))[-n:] if n > i else self._lateness[i-n:i]
+        p50, p99 = np.percentile(samples,[50,99])
+        return p50, p99, samples.max()
+
+    def summary(self,ticks,elapsed):
+        ''' Text report of the achieved rate over *ticks* ticks that took *elapsed* ns '''
+        p50, p99, pmax = self.jitter(ticks)
+        return 'rate {:.1f}/{:.0f} Hz, overruns {}, jitter p50/p99/max {:.1f}/{:.1f}/{:.1f} us'.format(
+            ticks * NS_PER_S / elapsed if elapsed else 0, self.rate, self.overruns,
+            p50 / 1e3, p99 / 1e3, pmax / 1e3)
+
+#=============================================================================================
+# Simulated time (ns) for offline runs, driven by one thread (e.g. replay.py) in lockstep with
+# the consumer (a SubThread mode):
+#   - loops registered with add() or run() get no thread; advance(t) executes their ticks at
+#     the scheduled times up to t in the driving thread, with now() set to the time of the tick
+#   - waitFrame() replaces the wait for a new detection: the driver calls frame() after each
+#     frame and waitIdle() before the next one, which returns once the consumer waits again
+#=============================================================================================
+class SimulatedClock(object):
+    def __init__(self,start=0):
+        self.t = start
+        self.frames = 0 # frames announced by frame()
+        self._handled = 0 # frames before the last waitFrame() of the consumer
+        self._waiting = False # the consumer is blocked in waitFrame()
+        self._running = 0 # consumers blocked in run(); they wait for nothing but the time
+        self._loops = []
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def now(self):
+        return self.t
+
+    #==============================================================================================
+    # Consumer side
+    #==============================================================================================
+    def add(self,rate,tick):
+        ''' Call tick(t) every 1/rate s from now on; t is the scheduled time (s) since now, as in FixedRateLoop '''
+        loop = [self.t, int(NS_PER_S / rate), tick, self.t] # start, period, tick, next deadline
+        with self._condition:
+            self._loops.append(loop)
+        return loop
+
+    def loop(self,rate):
+        ''' Counterpart of FixedRateLoop(rate) on this clock '''
+        return SimulatedLoop(self,rate)
+
+    def remove(self,loop):
+        with self._condition:
+            self._loops.remove(loop)
+
+    def run(self,rate,tick,isStopped,report=None):
+        ''' Same as FixedRateLoop(rate).run(); blocks until isStopped() or close() '''
+        loop = self.add(rate,tick)
+        with self._condition:
+            self._running += 1
+            self._condition.notify_all()
+            while not isStopped() and not self._closed:
+                self._condition.wait(0.05) # isStopped() is not notified
+            self._running -= 1
+        self.remove(loop)
+
+    def waitFrame(self,ready):
+        '''
+        Wait until ready() returns a true value after a new frame, and return it.
+        Returns None after close().
+        '''
+        with self._condition:
+            while not self._closed:
+                self._handled = self.frames
+                self._waiting = True
+                self._condition.notify_all()
+                self._condition.wait_for(lambda: self.frames > self._handled or self._closed)
+                self._waiting = False
+                result = ready()
+                if result:
+                    return result
+        return None
+
+    #==============================================================================================
+    # Driver side
+    #==============================================================================================
+    def advance(self,t):
+        ''' Execute the ticks scheduled before *t* (ns) in time order, then set the time to *t* '''
+        while True:
+            with self._condition:
+                due = [loop for loop in self._loops if loop[3] < t]
+            if not due:
+                break
+            loop = min(due,key=lambda loop: loop[3])
+            self.t = loop[3]
+            loop[3] += loop[1]
+            loop[2]((self.t - loop[0]) / NS_PER_S)
+        self.t = max(self.t,t)
+
+    def frame(self):
+        ''' Announce a new frame to waitFrame() '''
+        with self._condition:
+            self.frames += 1
+            self._condition.notify_all()
+
+    def waitIdle(self,isAlive,timeout=5.0):
+        '''
+        Wait until the consumer has handled every frame and waits in waitFrame() or run(), or
+        isAlive() is False. Returns False after *timeout* s (wall clock) without that.
+        '''
+        deadline = time.perf_counter() + timeout
+        with self._condition:
+            while not (self._waiting and self._handled >= self.frames) and not self._running:
+                if not isAlive():
+                    return True
+                if time.perf_counter() > deadline:
+                    return False
+                self._condition.wait(0.01)
+        return True
+
+    def close(self):
+        ''' Release the consumer from run() and waitFrame() '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+class SimulatedLoop(object):
+    def __init__(self,clock,rate):
+        self.clock = clock
+        self.rate = rate
+
+    def run(self,tick,isStopped,report=None):
+        self.clock.run(self.rate,tick,isStopped,report)
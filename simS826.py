@@ -0,0 +1,167 @@
+"""
+=============================================================================
+simS826.py
+----------------------------------------------------------------------------
+Simulated Sensoray 826 board for running the coil system without hardware.
+Every DAC write is recorded into a preallocated ring buffer together with
+a time.perf_counter_ns() timestamp, so that the update rate, the jitter and
+the skew between channels of a waveform can be measured offline.
+
+Usage:
+    dac = SimulatedS826(writeLatency=2000) # 2 us per DAC write
+    field = FieldManager(dac)
+    ...
+    print(dac.sim.report())
+=============================================================================
+"""
+import time
+import numpy as np
+from s826 import S826, NUM_CHANNELS, RANGE_PARAM
+
+#=============================================================================================
+# Pure Python implementation of the functions of lib826_64.so used by S826
+#=============================================================================================
+class SimulatedS826Library(object):
+    def __init__(self,bufferSize=1<<20,writeLatency=0,latencyJitter=0,seed=None,clock=None):
+        '''
+        @param bufferSize: number of DAC writes kept in the ring buffer
+        @param writeLatency: modelled bus latency of one DAC write (ns). The call busy-waits for this long.
+        @param latencyJitter: standard deviation of the modelled latency (ns)
+        @param clock: returns the timestamp (ns) of a write, e.g. scheduler.SimulatedClock.now.
+                      Default time.perf_counter_ns.
+        '''
+        self.clock = clock or time.perf_counter_ns
+        self.bufferSize = bufferSize
+        self.writeLatency = writeLatency
+        self.latencyJitter = latencyJitter
+        self._rng = np.random.default_rng(seed)
+        # ring buffer
+        self.timestamps = np.zeros(bufferSize,dtype=np.int64)
+        self.channels = np.zeros(bufferSize,dtype=np.uint8)
+        self.setpoints = np.zeros(bufferSize,dtype=np.uint16)
+        self.count = 0 # total number of writes since reset()
+        # state of the simulated board
+        self.isOpen = False
+        self.rangeCodes = np.full(NUM_CHANNELS,2)
+        self.outputs = np.zeros(NUM_CHANNELS,dtype=np.uint16) # current setpoint of each channel
+
+    def reset(self):
+        self.count = 0
+
+    #==============================================================================================
+    # API of lib826_64.so
+    #==============================================================================================
+    def S826_SystemOpen(self):
+        self.isOpen = True
+        return 1 # number of boards detected
+
+    def S826_SystemClose(self):
+        self.isOpen = False
+        return 0
+
+    def S826_DacRangeWrite(self,board,chan,rangeCode,safemode):
+        self.rangeCodes[chan] = rangeCode
+        return 0
+
+    def S826_DacDataWrite(self,board,chan,setpoint,safemode):
+        if self.writeLatency:
+            latency = self.writeLatency
+            if self.latencyJitter:
+                latency = max(0,latency + self.latencyJitter * self._rng.standard_normal())
+            end = time.perf_counter_ns() + latency
+            while time.perf_counter_ns() < end:
+                pass
+        i = self.count % self.bufferSize
+        self.timestamps[i] = self.clock()
+        self.channels[i] = chan
+        self.setpoints[i] = setpoint
+        self.outputs[chan] = setpoint
+        self.count += 1
+        return 0
+
+    #==============================================================================================
+    # Analysis of the recorded writes
+    #==============================================================================================
+    def records(self):
+        ''' Return (timestamps, channels, setpoints) of the buffered writes, oldest first. '''
+        n = min(self.count,self.bufferSize)
+        start = (self.count - n) % self.bufferSize
+        order = (np.arange(n) + start) % self.bufferSize
+        return self.timestamps[order], self.channels[order], self.setpoints[order]
+
+    def outputVoltage(self,chan):
+        lowerV, rangeV = RANGE_PARAM[self.rangeCodes[chan]]
+        return lowerV + self.outputs[chan] / 0xffff * rangeV
+
+    def stats(self,refChannel=None):
+        '''
+        An update is a burst of writes that starts with a write to *refChannel*
+        (by default the first channel that was recorded).
+        Returns a dict with
+            writes: number of buffered writes
+            updates: number of updates
+            rate: updates per second (Hz)
+            jitter: p50/p99/max deviation of the update period from its mean (ns)
+            skew: p50/p99/max time between the first and the last write of an update (ns)
+        '''
+        timestamps, channels, _ = self.records()
+        result = {'writes': len(timestamps), 'updates': 0, 'rate': 0.0,
+                  'jitter': (0, 0, 0), 'skew': (0, 0, 0)}
+        if len(timestamps) == 0:
+            return result
+        if refChannel is None:
+            refChannel = channels[0]
+        starts = np.flatnonzero(channels == refChannel)
+        result['updates'] = len(starts)
+        if len(starts) < 2:
+            return result
+        periods = np.diff(timestamps[starts])
+        result['rate'] = 1e9 / periods.mean()
+        deviation = np.abs(periods - periods.mean())
+        result['jitter'] = tuple(np.percentile(deviation,[50,99])) + (deviation.max(),)
+        skew = timestamps[starts[1:] - 1] - timestamps[starts[:-1]]
+        result['skew'] = tuple(np.percentile(skew,[50,99])) + (skew.max(),)
+        return result
+
+    def report(self,refChannel=None):
+        s = self.stats(refChannel)
+        return ('{} writes, {} updates, {:.1f} Hz, jitter p50/p99/max {:.1f}/{:.1f}/{:.1f} us, '
+                'skew p50/p99/max {:.1f}/{:.1f}/{:.1f} us').format(
+                s['writes'], s['updates'], s['rate'],
+                *[v / 1e3 for v in s['jitter']], *[v / 1e3 for v in s['skew']])
+
+
+#=============================================================================================
+# Drop-in replacement for S826
+#=============================================================================================
+class SimulatedS826(S826):
+    def __init__(self,bufferSize=1<<20,writeLatency=0,latencyJitter=0,seed=None,clock=None):
+        self.sim = SimulatedS826Library(bufferSize,writeLatency,latencyJitter,seed,clock)
+        super(SimulatedS826, self).__init__(dll=self.sim)
+
+
+# SubThread modes that only depend on time and params
+WAVEFORM_MODES = ['rotateXY','rotateYZ','rotateXZ','osc_saw','osc_triangle','osc_square',
+                  'osc_sin','osc_cos','oni_cutting','examplePiecewiseFunction','crawler_walking','xy_angle',
+                  'formulaControlledField']
+
+if __name__ == "__main__":
+    ''' Run this script directly to benchmark the SubThread waveforms without hardware '''
+    import sys
+    import threading
+    from fieldManager import FieldManager
+    from subThread import SubThread
+
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0 # seconds per mode
+    for name in WAVEFORM_MODES:
+        dac = SimulatedS826()
+        thrd = SubThread(FieldManager(dac),None,None,None)
+        thrd.setup(name)
+        thrd.params = [1,5,5,45,30]
+        dac.sim.reset()
+        worker = threading.Thread(target=thrd.run)
+        worker.start()
+        time.sleep(duration)
+        thrd.stop()
+        worker.join()
+        print('{:<24} {}'.format(name,dac.sim.report()))
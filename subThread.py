@@ -13,10 +13,15 @@ import time
 from mathfx import *
 from math import pi, sin, cos, sqrt, atan2, degrees
 from PyQt5.QtCore import pyqtSignal, QMutexLocker, QMutex, QThread
-import csv
-import pandas as pd
+import numpy as np
+from scheduler import FixedRateLoop
+from waveform import WaveformEngine
+from waveformPlayer import loadWaveform, WaveformPlayer
+from closedLoop import DetectionWaiter, CarrierOutput
 import os
 
+DETECTION_TIMEOUT = 0.5 # s without a new position before the closed-loop modes warn
+
 def subthreadNotDefined():
     print('Subthread not defined.')
     return
@@ -38,6 +43,13 @@ class SubThread(QThread):
         self._subthreadName = ''
         self.running = True
         self.params = [0,0,0,0,0]
+        self.updateRate = 2000 # Hz, rate of the modes that run in runFixedRate()
+        self.recordVideo = True # modes that record call startRecording()
+        self.clock = None # scheduler.SimulatedClock that steps the loops and the closed-loop modes offline (replay.py)
+        self.latencyCompensation = True # closed-loop modes act on the pose predicted for the time of the DAC write
+        self.waveformEngine = None # set while a precomputed waveform is playing
+        self.waveformPlayer = None # set while fromCSV is playing
+        self.csvPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'waveform.csv')
         self.labelOnGui = {'twistField': ['Frequency (Hz)','Magniude (mT)','AzimuthalAngle (deg)','PolarAngle (deg)','SpanAngle (deg)'],
                         'rotateXY': ['Frequency (Hz)','Magnitude-X (mT)','Magnitude-Y (mT)','N/A','N/A'],
                         'rotateYZ': ['Frequency (Hz)','Magnitude-Y (mT)','Magnitude-Z (mT)','N/A','N/A'],
@@ -54,7 +66,7 @@ class SubThread(QThread):
                         'swimmerPathFollowing': ['Frequency (Hz)','Magniude (mT)','temp angle','N/A','N/A'],
                         'swimmerBenchmark': ['bias angle (deg)','N/A','N/A','N/A','N/A'],
                         'tianqiGripper': ['N/A','Magnitude (mT)','Frequency (Hz)','Direction (deg)','N/A'],
-                        'fromCSV': ['N/A', 'N/A', 'N/A', 'N/A', 'N/A'],
+                        'fromCSV': ['Rate scale', 'Loop (0/1)', 'Start (s)', 'N/A', 'N/A'],
                         'formulaControlledField': ['N/A', 'N/A', 'N/A', 'N/A', 'N/A'],
                         'crawler_walking': ['Bmax (mT)', 'Frequency (Hz)', 'Max2'],
                         'xy_angle': ['Magnitude (mT)', 'Angle (deg)','N/A','N/A','N/A'],
@@ -64,7 +76,7 @@ class SubThread(QThread):
                         'drawing': [0,0,0,1,0],
                         'swimmerPathFollowing': [-20,2,0,0,0],
                         'tianqiGripper': [0,15,0.5,0,0],
-                        'fromCSV': [0, 0, 0, 0, 0],
+                        'fromCSV': [1, 0, 0, 0, 0],
                         'formulaControlledField': [0, 0, 0, 0, 0],
                         'crawler_walking': [5, 5, 5],
                         'default':[0,0,0,0,0]
@@ -83,7 +95,7 @@ class SubThread(QThread):
                         'examplePiecewiseFunction': [-20,0,-360,0,0],
                         'swimmerPathFollowing': [-100,0,0,0,0],
                         'tianqiGripper': [0,0,0,-720,0],
-                        'fromCSV': [0, 0, 0, 0, 0],
+                        'fromCSV': [0.01, 0, 0, 0, 0],
                         'formulaControlledField': [0, 0, 0, 0, 0],
                         'crawler_walking': [-50, 0, -50],
                         'xy_angle': [-50, 0, -50],
@@ -104,7 +116,7 @@ class SubThread(QThread):
                         'swimmerPathFollowing': [100,20,360,0,0],
                         'swimmerBenchmark': [360,0,0,0,0],
                         'tianqiGripper': [10,20,120,720,0],
-                        'fromCSV': [0, 0, 0, 0, 0],
+                        'fromCSV': [100, 1, 86400, 0, 0],
                         'formulaControlledField': [0, 0, 0, 0, 0],
                         'crawler_walking': [50, 10, 50],
                         'xy_angle': [50, 360, 50],
@@ -135,13 +147,103 @@ class SubThread(QThread):
         subthreadFunction = getattr(self,self._subthreadName,subthreadNotDefined)
         subthreadFunction()
 
-    def setParam0(self,val): 
+    def setParam0(self,val):
         self.params[0] = val
+        self.paramsChanged()
         # print(f"param0 被设置为 {val}")
-    def setParam1(self,val): self.params[1] = val
-    def setParam2(self,val): self.params[2] = val
-    def setParam3(self,val): self.params[3] = val
-    def setParam4(self,val): self.params[4] = val
+    def setParam1(self,val):
+        self.params[1] = val
+        self.paramsChanged()
+    def setParam2(self,val):
+        self.params[2] = val
+        self.paramsChanged()
+    def setParam3(self,val):
+        self.params[3] = val
+        self.paramsChanged()
+    def setParam4(self,val):
+        self.params[4] = val
+        self.paramsChanged()
+    def paramsChanged(self):
+        if self.waveformEngine is not None:
+            self.waveformEngine.requestRebuild()
+        if self.waveformPlayer is not None:
+            self.waveformPlayer.setRateScale(self.params[0])
+            self.waveformPlayer.loop = bool(self.params[1])
+            if self.params[2] != self.waveformPlayer.seekPosition:
+                self.waveformPlayer.seek(self.params[2])
+    def setUpdateRate(self,val): self.updateRate = val # used by the next mode that starts
+
+    #=========================================
+    # Run a waveform at a fixed update rate.
+    # field(t,params) returns the field (x,y,z) in mT at time t (s).
+    # With *write*, e.g. self.field.setCoils, field() returns its arguments instead.
+    # The achieved rate, overruns and jitter are reported through statusSignal.
+    #=========================================
+    def runFixedRate(self,field,write=None):
+        loop = self.clock.loop(self.updateRate) if self.clock else FixedRateLoop(self.updateRate)
+        params = self.params
+        write = write or self.field.setXYZ
+        def tick(t):
+            write(*field(t,params))
+        loop.run(tick,lambda: self.stopped,self.statusSignal.emit)
+
+    #=========================================
+    # Play a periodic waveform from a precomputed table.
+    # waveform(t,params) returns the field (x,y,z) in mT for an array of times t within one period.
+    # params[0] is the frequency (Hz). The table is rebuilt in the background when a param changes
+    # and replaces the current one at the next period boundary.
+    # observer(t,x,y,z) is called after every update if given.
+    #=========================================
+    def runPrecomputed(self,waveform,observer=None):
+        engine = WaveformEngine(waveform,self.field,self.updateRate,self.params)
+        self.waveformEngine = engine
+        loop = self.clock.loop(self.updateRate) if self.clock else FixedRateLoop(self.updateRate)
+        sample = engine.sample
+        setCoilSetpoints = self.field.setCoilSetpoints
+        def tick(t):
+            setpoints, (x, y, z) = sample(t)
+            setCoilSetpoints(setpoints,x,y,z)
+            if observer is not None:
+                observer(t,x,y,z)
+        try:
+            loop.run(tick,lambda: self.stopped,self.statusSignal.emit)
+        finally:
+            self.waveformEngine = None
+            engine.stop()
+
+    #=========================================
+    # Record the video of every camera to <name>1.avi, <name>2.avi, <name>3.avi
+    # if recordVideo is set
+    #=========================================
+    def startRecording(self,name):
+        if not self.recordVideo:
+            return
+        for i, vision in enumerate([self.vision1, self.vision2, self.vision3]):
+            if vision:
+                vision.startRecording('{}{}.avi'.format(name, i + 1))
+
+    def stopRecording(self):
+        for vision in [self.vision1, self.vision2, self.vision3]:
+            if vision:
+                vision.stopRecording()
+
+    #=========================================
+    # Draw the path, the current goal and a line from the agent to it on every camera.
+    # The points are in the shared frame of the pose fusion; they are mapped to the
+    # image of each camera with the inverse of its homography (poseFusion.CameraModel).
+    #=========================================
+    def drawPathToGoal(self,fusion,goalsX,goalsY,goalX,goalY,x,y):
+        for cameraId, vision in enumerate([self.vision1, self.vision2, self.vision3], 1):
+            if not vision:
+                continue
+            camera = fusion.camera(cameraId)
+            path = [camera.toImage(px, py) for px, py in zip(goalsX, goalsY)]
+            gx, gy = camera.toImage(goalX, goalY)
+            ax, ay = camera.toImage(x, y)
+            vision.clearDrawingRouting()  # 防止绘图数据累积
+            vision.addDrawing('closedPath', [[int(px) for px, _ in path], [int(py) for _, py in path]])
+            vision.addDrawing('circle', [int(gx), int(gy), 5])
+            vision.addDrawing('line', [int(ax), int(ay), int(gx), int(gy)]) # cv2 takes integer points
 
     #=========================================
     # Start defining your subthread from here
@@ -158,37 +260,27 @@ class SubThread(QThread):
         # 2 'offsetY'
         # 3 'scale'
         #=============================
-        startTime = time.time()
         # video writing feature
         # self.vision.startRecording('drawing.avi')
            # ✅ Start video recording for all 3 cameras
-        self.vision1.startRecording('drawing1.avi')
-        self.vision2.startRecording('drawing2.avi')
-        self.vision3.startRecording('drawing3.avi')
-
-        while True:
-            # ✅ Clear drawings for all 3 cameras
-            for vision in [self.vision1, self.vision2, self.vision3]:
-                if vision:
-                    vision.clearDrawingRouting()
-                # ✅ Add drawings for all 3 cameras
-            for vision in [self.vision1, self.vision2, self.vision3]:
-                if vision:
-                    vision.addDrawing('pathUT', self.params)
-                    vision.addDrawing('circle', [420, 330, 55])
-                    vision.addDrawing('arrow', [0, 0, 325, 325])
-            # you can also do somthing like:
-            # drawing an arrow from "the robot" to "the destination point"
-            t = time.time() - startTime # elapsed time (sec)
-            self.field.setX(0)
-            self.field.setY(0)
-            self.field.setZ(0)
-            if self.stopped:
-                print("✅ Stopping drawing thread and saving recordings.")
-                self.vision1.stopRecording()
-                self.vision2.stopRecording()
-                self.vision3.stopRecording()
-                return
+        self.startRecording('drawing')
+
+        # ✅ Add drawings for all 3 cameras. self.params is passed by reference,
+        # so the drawing follows the params changed on the GUI.
+        for vision in [self.vision1, self.vision2, self.vision3]:
+            if vision:
+                vision.clearDrawingRouting()
+                vision.addDrawing('pathUT', self.params)
+                vision.addDrawing('circle', [420, 330, 55])
+                vision.addDrawing('arrow', [0, 0, 325, 325])
+        # you can also do somthing like:
+        # drawing an arrow from "the robot" to "the destination point"
+        # t is the elapsed time (sec)
+        def field(t,params):
+            return 0, 0, 0
+        self.runFixedRate(field)
+        print("✅ Stopping drawing thread and saving recordings.")
+        self.stopRecording()
 
     def swimmerPathFollowing(self):
         '''
@@ -203,108 +295,93 @@ class SubThread(QThread):
         #=============================
 
         # Start video recording for all 3 cameras
-        self.vision1.startRecording('path1.avi')
-        self.vision2.startRecording('path2.avi')
-        self.vision3.startRecording('path3.avi')
+        self.startRecording('path')
 
-        startTime = time.time()
         state = 0  # Indicates which goal point the robot is approaching
-        rect = [640, 480]  # Image size in pixels
+        # The path is in the shared frame of the pose fusion (data/cameras.json), the pixels
+        # of camera 1 with the default identity homographies
+        rect = [640, 480]  # Size of the working area
         pointsX = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]  # Normalized X positions
         pointsY = [0.7, 0.3, 0.3, 0.7, 0.3, 0.3, 0.7]  # Normalized Y positions
-        goalsX = [int(rect[0] * i) for i in pointsX]  # Convert to pixel positions
+        goalsX = [int(rect[0] * i) for i in pointsX]  # Convert to the shared frame
         goalsY = [int(rect[1] * i) for i in pointsY]
 
         tolerance = 10  # Distance threshold to consider reaching a goal
         toleranceDeviation = 30  # Threshold for path correction
         magnitudeCorrection = 1  # Factor to avoid overshooting near goals
 
-        while True:
-            # =============================
-            # Get robot position from all 3 cameras
-            # =============================
-            positions = []
-            for vision in [self.vision1, self.vision2, self.vision3]:
-                if vision and hasattr(vision, "agent1"):
-                    positions.append((vision.agent1.x, vision.agent1.y))
-            
-            if not positions:  # 如果所有摄像头都没有检测到目标
-                print("⚠️ Warning: No valid positions detected from any camera!")
-                continue
-
-            # 计算 3 个摄像头的均值作为机器人位置，减少单个摄像头误差
-            x = sum(pos[0] for pos in positions) / len(positions)
-            y = sum(pos[1] for pos in positions) / len(positions)
-
-            # 获取当前目标点
-            goalX = goalsX[state]
-            goalY = goalsY[state]
-
-            # 只有 `state > 0` 时才访问 `goalXPrevious`
-            if state > 0:
-                goalXPrevious = goalsX[state - 1]
-                goalYPrevious = goalsY[state - 1]
-            else:
-                goalXPrevious = goalX
-                goalYPrevious = goalY
-
-            # =============================
-            # Draw reference lines on all 3 cameras
-            # =============================
-            for vision in [self.vision1, self.vision2, self.vision3]:
-                if vision:
-                    vision.clearDrawingRouting()  # 防止绘图数据累积
-                    vision.addDrawing('closedPath', [goalsX, goalsY])
-                    vision.addDrawing('circle', [goalX, goalY, 5])
-                    vision.addDrawing('line', [x, y, goalX, goalY])
-
-            # =======================================================
-            # Calculate heading angle for movement
-            # =======================================================
-            distance = distanceBetweenPoints(x, y, goalX, goalY)
-            footX, footY = perpendicularFootToLine(x, y, goalXPrevious, goalYPrevious, goalX, goalY)
-            deviation = distanceBetweenPoints(x, y, footX, footY)
-
-            if deviation > toleranceDeviation:
-                # Move perpendicular to the reference path
-                angle = degrees(atan2(-(footY - y), footX - x))
-            else:
-                angleRobotToGoal = atan2(-(goalY - y), goalX - x)
-                angleRobotToFoot = atan2(-(footY - y), footX - x)
-                angleCorrectionOffset = normalizeAngle(angleRobotToFoot - angleRobotToGoal) * deviation / toleranceDeviation
-                angle = degrees(angleRobotToGoal + angleCorrectionOffset)
-
-            # Reduce speed near the target
-            magnitudeCorrection = 0.5 if distance <= tolerance * 3 else 1
-
-            # =============================
-            # Check if the goal is reached
-            # =============================
-            if distance <= tolerance:
-                state += 1
-                print(f'>>> Step to point {state} <<<')
-
-            # =============================
-            # Apply magnetic field
-            # =============================
-            t = time.time() - startTime
-            theta = 2 * pi * self.params[0] * t
-            fieldX = magnitudeCorrection * self.params[1] * cos(theta) * cosd(angle + self.params[2])
-            fieldY = magnitudeCorrection * self.params[1] * cos(theta) * sind(angle + self.params[2])
-            fieldZ = magnitudeCorrection * self.params[1] * sin(theta)
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-
-            # =============================
-            # Stop condition: All points reached
-            # =============================
-            if self.stopped or state >= len(pointsX):
-                print("✅ Path following complete. Stopping all recordings.")
-                self.vision1.stopRecording()
-                self.vision2.stopRecording()
-                self.vision3.stopRecording()
-                return
+        # the rotating field is generated at a fixed rate; the control law below runs once per detection
+        carrier = CarrierOutput(self.field, self.updateRate, self.statusSignal.emit, clock=self.clock)
+        carrier.start()
+        detections = DetectionWaiter([self.vision1, self.vision2, self.vision3], clock=self.clock)
+        try:
+            while not self.stopped and state < len(pointsX):
+                # =============================
+                # Wait for a new robot position from any of the 3 cameras
+                # =============================
+                lookahead = carrier.expectedLatency() if self.latencyCompensation else 0
+                pose = detections.wait(timeout=DETECTION_TIMEOUT, lookahead=lookahead)
+                if pose is None:
+                    print("⚠️ Warning: No valid positions detected from any camera!")
+                    continue
+                x = pose.x
+                y = pose.y
+
+                # 获取当前目标点
+                goalX = goalsX[state]
+                goalY = goalsY[state]
+
+                # 只有 `state > 0` 时才访问 `goalXPrevious`
+                if state > 0:
+                    goalXPrevious = goalsX[state - 1]
+                    goalYPrevious = goalsY[state - 1]
+                else:
+                    goalXPrevious = goalX
+                    goalYPrevious = goalY
+
+                # =============================
+                # Draw reference lines on all 3 cameras
+                # =============================
+                self.drawPathToGoal(detections.fusion, goalsX, goalsY, goalX, goalY, x, y)
+
+                # =======================================================
+                # Calculate heading angle for movement
+                # =======================================================
+                distance = distanceBetweenPoints(x, y, goalX, goalY)
+                footX, footY = perpendicularFootToLine(x, y, goalXPrevious, goalYPrevious, goalX, goalY)
+                deviation = distanceBetweenPoints(x, y, footX, footY)
+
+                if deviation > toleranceDeviation:
+                    # Move perpendicular to the reference path
+                    angle = degrees(atan2(-(footY - y), footX - x))
+                else:
+                    angleRobotToGoal = atan2(-(goalY - y), goalX - x)
+                    angleRobotToFoot = atan2(-(footY - y), footX - x)
+                    angleCorrectionOffset = normalizeAngle(angleRobotToFoot - angleRobotToGoal) * deviation / toleranceDeviation
+                    angle = degrees(angleRobotToGoal + angleCorrectionOffset)
+
+                # Reduce speed near the target
+                magnitudeCorrection = 0.5 if distance <= tolerance * 3 else 1
+
+                # =============================
+                # Check if the goal is reached
+                # =============================
+                if distance <= tolerance:
+                    state += 1
+                    print(f'>>> Step to point {state} <<<')
+
+                # =============================
+                # Hand the new heading to the field output
+                # =============================
+                carrier.setCommand(angle + self.params[2], magnitudeCorrection * self.params[1], self.params[0], pose.t)
+        finally:
+            carrier.stop()
+            self.field.setXYZ(0, 0, 0)
+        # =============================
+        # Stop condition: All points reached
+        # =============================
+        print("✅ Path following complete. Stopping all recordings.")
+        self.stopRecording()
 
     def tianqiGripper(self):
         #=============================
@@ -317,7 +394,6 @@ class SubThread(QThread):
         # ''' Video Recording '''
         # self.vision.startRecording('TianqiGripper.avi')
         ''' Init '''
-        startTime = time.time()
         paramSgnMagZ = 1 # use R1 button to change the sign of Z magnitude
         paramFieldScale = 1 # change the field strength with R2
         ''' Rotating the gripper '''
@@ -325,46 +401,50 @@ class SubThread(QThread):
         paramRotationPhase = 0 # used for MODE3 - Fine rotation control
         ''' Modes '''
         mode = 0 # change the mode with buttons on PS3 controller
-        BUTTON_RESPONSE_TIME = 0.2 # at least 0.2 sec between button triggers
-        lastButtonPressedTimeMode = 0
-        lastButtonPressedTimeR1 = 0 # the last time that the user changing the mode
-
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
+        joystick = self.joystick
+        KEY = joystick.KEY
+        joystick.begin() # drop the buttons pressed before the mode started; a playback starts from its beginning
+
+        def field(t,params):
+            nonlocal paramSgnMagZ, paramFieldScale, paramRotationOffsetTime, paramRotationPhase
+            nonlocal mode
+            joystick.advance(t) # a playback follows the clock of this loop
             # =======================================================
-            # Detect Button Pressed to Change the MODE
+            # Button presses since the last update (each press is seen exactly once)
             # =======================================================
-            if t - lastButtonPressedTimeMode > BUTTON_RESPONSE_TIME:
-                if self.joystick.isPressed('CROSS') and not mode == 0:
-                    lastButtonPressedTimeMode = t
+            for event in joystick.getEvents():
+                if not event.pressed:
+                    continue
+                # Change the MODE
+                if event.button == KEY['CROSS'] and not mode == 0:
                     mode = 0
                     print('[MODE] Standby')
-                elif self.joystick.isPressed('CIRCLE') and not mode == 1:
-                    lastButtonPressedTimeMode = t
+                elif event.button == KEY['CIRCLE'] and not mode == 1:
                     mode = 1
                     print('[MODE] Grasp')
-                elif self.joystick.isPressed('TRIANGLE') and not mode == 2:
-                    lastButtonPressedTimeMode = t
+                elif event.button == KEY['TRIANGLE'] and not mode == 2:
                     mode = 2
                     print('[MODE] Transport Auto')
                     paramRotationOffsetTime = t
-                elif self.joystick.isPressed('SQUARE') and not mode == 3:
-                    lastButtonPressedTimeMode = t
-                    mode = 3
-                    print('[MODE] Transport Manual')
-                    paramRotationPhase = pi / 2
-            # =======================================================
-            # Flip direction of Z field
-            # =======================================================
-            if t - lastButtonPressedTimeR1 > BUTTON_RESPONSE_TIME:
-                if self.joystick.isPressed('R1'):
-                    lastButtonPressedTimeR1 = t
+                elif event.button == KEY['SQUARE']:
+                    if not mode == 3:
+                        mode = 3
+                        print('[MODE] Transport Manual')
+                        paramRotationPhase = pi / 2
+                    # in mode 3 each press of SQUARE rotates the gripper, backwards while L1 is held
+                    elif joystick.isPressed('L1',event.state):
+                        paramRotationPhase = paramRotationPhase + pi/16
+                    else:
+                        paramRotationPhase = paramRotationPhase - pi/16
+                # Flip direction of Z field
+                elif event.button == KEY['R1']:
                     paramSgnMagZ = - paramSgnMagZ
                     print('The sign of fieldZ is {}'.format(paramSgnMagZ))
+            state = joystick.state() # one snapshot for all the sticks of this update
             # =======================================================
             # change magnitude of field with R2
             # =======================================================
-            rawR2 = self.joystick.getStick(5) # -1 -> 1
+            rawR2 = joystick.getStick(5,state) # -1 -> 1
             paramFieldScale = 0.5 * (- rawR2 + 1)
             # =======================================================
             # Process fieldXYZ in each mode
@@ -374,34 +454,24 @@ class SubThread(QThread):
                 fieldY = 0
                 fieldZ = 0
             elif mode == 1:
-                polar = self.joystick.getTiltLeft()
-                azimuth = self.joystick.getAngleLeft()
-                fieldX = self.params[1] * cosd(polar) * cosd(azimuth)
-                fieldY = self.params[1] * cosd(polar) * sind(azimuth)
-                fieldZ = self.params[1] * sind(polar)
+                polar = joystick.getTiltLeft(state)
+                azimuth = joystick.getAngleLeft(state)
+                fieldX = params[1] * cosd(polar) * cosd(azimuth)
+                fieldY = params[1] * cosd(polar) * sind(azimuth)
+                fieldZ = params[1] * sind(polar)
             elif mode == 2:
-                theta = - 2 * pi * self.params[2] * (t - paramRotationOffsetTime) + pi / 2
-                fieldX = self.params[1] * cos(theta) * cosd(self.joystick.getAngleLeft())
-                fieldY = self.params[1] * cos(theta) * sind(self.joystick.getAngleLeft())
-                fieldZ = self.params[1] * sin(theta)
+                theta = - 2 * pi * params[2] * (t - paramRotationOffsetTime) + pi / 2
+                fieldX = params[1] * cos(theta) * cosd(joystick.getAngleLeft(state))
+                fieldY = params[1] * cos(theta) * sind(joystick.getAngleLeft(state))
+                fieldZ = params[1] * sin(theta)
             elif mode == 3:
-                if t - lastButtonPressedTimeMode > BUTTON_RESPONSE_TIME:
-                    if self.joystick.isPressed('SQUARE'):
-                        lastButtonPressedTimeMode = t
-                        if self.joystick.isPressed('L1'):
-                            paramRotationPhase = paramRotationPhase + pi/16
-                        else:
-                            paramRotationPhase = paramRotationPhase - pi/16
-                fieldX = self.params[1] * cos(paramRotationPhase) * cosd(self.joystick.getAngleLeft())
-                fieldY = self.params[1] * cos(paramRotationPhase) * sind(self.joystick.getAngleLeft())
-                fieldZ = self.params[1] * sin(paramRotationPhase)
-
-            self.field.setX(fieldX * paramFieldScale)
-            self.field.setY(fieldY * paramFieldScale)
-            self.field.setZ(fieldZ * paramFieldScale * paramSgnMagZ)
-            if self.stopped:
-                # self.vision.stopRecording()
-                return
+                fieldX = params[1] * cos(paramRotationPhase) * cosd(joystick.getAngleLeft(state))
+                fieldY = params[1] * cos(paramRotationPhase) * sind(joystick.getAngleLeft(state))
+                fieldZ = params[1] * sin(paramRotationPhase)
+
+            return fieldX * paramFieldScale, fieldY * paramFieldScale, fieldZ * paramFieldScale * paramSgnMagZ
+        self.runFixedRate(field)
+        # self.vision.stopRecording()
 
     def swimmerBenchmark(self):
         '''
@@ -412,102 +482,86 @@ class SubThread(QThread):
             - Drawing real-time reference lines and target markers
         '''
         # ✅ Start video recording for all 3 cameras
-        self.vision1.startRecording('benchmark1.avi')
-        self.vision2.startRecording('benchmark2.avi')
-        self.vision3.startRecording('benchmark3.avi')
+        self.startRecording('benchmark')
 
-        startTime = time.time()
         state = 0  # Current target point
         freq = [-15, -15, -17, -19, -21, -23, -25]  # Frequencies
         freq = [i - 8 for i in freq]  # Adjusted frequency offset
         magnitude = 8
         benchmarkState = 0  # Current frequency being tested
 
-        rect = [640, 480]  # Image size
+        rect = [640, 480]  # Size of the working area in the shared frame of the pose fusion
         pointsX = [0.2, 0.8]  # Normalized X positions
         pointsY = [0.2, 0.8]  # Normalized Y positions
-        goalsX = [int(rect[0] * i) for i in pointsX]  # Convert to pixels
+        goalsX = [int(rect[0] * i) for i in pointsX]  # Convert to the shared frame
         goalsY = [int(rect[1] * i) for i in pointsY]
 
         tolerance = 20  # Distance threshold to reach a goal
 
         print(f'Moving to the home position. Frequency {freq[benchmarkState]} Hz')
 
-        while True:
-            # =============================
-            # Get robot position from all 3 cameras
-            # =============================
-            positions = []
-            for vision in [self.vision1, self.vision2, self.vision3]:
-                if vision and hasattr(vision, "agent1"):
-                    positions.append((vision.agent1.x, vision.agent1.y))
-
-            if not positions:
-                print("⚠️ Warning: No valid positions detected from any camera!")
-                continue  # Skip this iteration if no valid positions
-
-            # Calculate averaged position from multiple cameras
-            x = sum(pos[0] for pos in positions) / len(positions)
-            y = sum(pos[1] for pos in positions) / len(positions)
-
-            # Get current target point
-            goalX = goalsX[state]
-            goalY = goalsY[state]
-
-            # =============================
-            # Draw reference lines on all 3 cameras
-            # =============================
-            for vision in [self.vision1, self.vision2, self.vision3]:
-                if vision:
-                    vision.clearDrawingRouting()
-                    vision.addDrawing('closedPath', [goalsX, goalsY])
-                    vision.addDrawing('circle', [goalX, goalY, 5])
-                    vision.addDrawing('line', [x, y, goalX, goalY])
-
-            # =============================
-            # Calculate distance and angle
-            # =============================
-            distance = sqrt((goalX - x) ** 2 + (goalY - y) ** 2)
-            angle = degrees(atan2(-(goalY - y), goalX - x))  # Convert to degrees
-
-            # =============================
-            # Check if the goal is reached
-            # =============================
-            if distance <= tolerance:
-                if state == 0:
-                    benchmarkState += 1
+        # the rotating field is generated at a fixed rate; the control law below runs once per detection
+        carrier = CarrierOutput(self.field, self.updateRate, self.statusSignal.emit, clock=self.clock)
+        carrier.start()
+        detections = DetectionWaiter([self.vision1, self.vision2, self.vision3], clock=self.clock)
+        try:
+            while not self.stopped and benchmarkState < len(freq):
+                # =============================
+                # Wait for a new robot position from any of the 3 cameras
+                # =============================
+                lookahead = carrier.expectedLatency() if self.latencyCompensation else 0
+                pose = detections.wait(timeout=DETECTION_TIMEOUT, lookahead=lookahead)
+                if pose is None:
+                    print("⚠️ Warning: No valid positions detected from any camera!")
+                    continue
+                x = pose.x
+                y = pose.y
+
+                # Get current target point
+                goalX = goalsX[state]
+                goalY = goalsY[state]
+
+                # =============================
+                # Draw reference lines on all 3 cameras
+                # =============================
+                self.drawPathToGoal(detections.fusion, goalsX, goalsY, goalX, goalY, x, y)
+
+                # =============================
+                # Calculate distance and angle
+                # =============================
+                distance = sqrt((goalX - x) ** 2 + (goalY - y) ** 2)
+                angle = degrees(atan2(-(goalY - y), goalX - x))  # Convert to degrees
+
+                # =============================
+                # Check if the goal is reached
+                # =============================
+                if distance <= tolerance:
+                    if state == 0:
+                        benchmarkState += 1
+                        if benchmarkState < len(freq):
+                            print(f'Case {benchmarkState} - Benchmark Frequency {freq[benchmarkState]} Hz')
+
+                    state += 1  # Move to next goal
+                    if state == len(pointsX):
+                        state = 0  # Reset path if completed
+
                     if benchmarkState < len(freq):
-                        print(f'Case {benchmarkState} - Benchmark Frequency {freq[benchmarkState]} Hz')
-
-                state += 1  # Move to next goal
-                if state == len(pointsX):
-                    state = 0  # Reset path if completed
-
-                if benchmarkState < len(freq):
-                    print(f'    >>> Step to point {state} <<<')
-
-            # =============================
-            # Apply magnetic field
-            # =============================
-            t = time.time() - startTime
-            theta = 2 * pi * freq[benchmarkState] * t
-            fieldX = magnitude * cos(theta) * cosd(angle + self.params[0])
-            fieldY = magnitude * cos(theta) * sind(angle + self.params[0])
-            fieldZ = magnitude * sin(theta)
-
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-
-            # =============================
-            # Stop condition: All frequencies tested
-            # =============================
-            if self.stopped or benchmarkState == len(freq):
-                print("✅ Benchmark complete. Stopping all recordings.")
-                self.vision1.stopRecording()
-                self.vision2.stopRecording()
-                self.vision3.stopRecording()
-                return
+                        print(f'    >>> Step to point {state} <<<')
+                    else:
+                        break
+
+                # =============================
+                # Hand the new heading to the field output
+                # =============================
+                carrier.setCommand(angle + self.params[0], magnitude, freq[benchmarkState], pose.t)
+        finally:
+            carrier.stop()
+            self.field.setXYZ(0, 0, 0)
+        # =============================
+        # Stop condition: All frequencies tested
+        # =============================
+        print("✅ Benchmark complete. Stopping all recordings.")
+        self.stopRecording()
 
     def examplePiecewiseFunction(self):
         """
@@ -524,28 +578,22 @@ class SubThread(QThread):
         # 3 'period1 (0-1)'
         # 4 'period2 (0-1)'
         #=============================
-        startTime = time.time()
-
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            normT = normalizeTime(t,self.params[0]) # 0 <= normT < 1
-            if normT < self.params[3]:
-                magnitude = self.params[1] / oscX_sawself.params[3] * normT
+        def field(t,params):
+            normT = normalizeTime(t,params[0]) # 0 <= normT < 1
+            if normT < params[3]:
+                magnitude = params[1] / params[3] * normT
                 angle = 180
-            elif normT < self.params[4]:
-                magnitude = self.params[1]
-                angle = (180 - self.params[2])/(self.params[3] - self.params[4]) * (normT - self.params[3]) + 180
+            elif normT < params[4]:
+                magnitude = params[1]
+                angle = (180 - params[2])/(params[3] - params[4]) * (normT - params[3]) + 180
             else:
-                magnitude = self.params[1] / (self.params[4] - 1) * (normT - 1)
-                angle = self.params[2]
+                magnitude = params[1] / (params[4] - 1) * (normT - 1)
+                angle = params[2]
             fieldX = magnitude * sind(angle)
             fieldY = 0
             fieldZ = magnitude * cosd(angle)
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-            if self.stopped:
-                return
+            return fieldX, fieldY, fieldZ
+        self.runFixedRate(field)
 
     def ellipse(self):
         #=============================
@@ -556,33 +604,18 @@ class SubThread(QThread):
         # 3 'B_vert (mT)'
         # 4 'B_horzB (mT)'
         #=============================
-        startTime = time.time()
-        counter = 0
-        record = ''
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            theta = 2 * pi * self.params[0] * t
-            normT = normalizeTime(t,self.params[0]) # 0 <= normT < 1
+        def field(t,params):
+            theta = 2 * pi * params[0] * t
+            normT = normalizeTime(t,params[0]) # 0 <= normT < 1
             if normT < 0.5:
-                B_horz = self.params[2] * cos(theta)
+                B_horz = params[2] * cos(theta)
             else:
-                B_horz = self.params[4] * cos(theta)
-            fieldX = B_horz * cosd(self.params[1])
-            fieldY = B_horz * sind(self.params[1])
-            fieldZ = self.params[3] * sin(theta)
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-            # save to txt
-            counter += 1
-            if counter > 10:
-                counter = 0
-                record = record + '{:.5f}, {:.2f}, {:.2f}, {:.2f}, {}, {}\n'.format(t,self.field.x,self.field.y,self.field.z,self.vision.agent1.x,self.vision.agent1.y)
-            if self.stopped:
-                text_file = open("Output.txt", "w")
-                text_file.write(record)
-                text_file.close()
-                return
+                B_horz = params[4] * cos(theta)
+            fieldX = B_horz * cosd(params[1])
+            fieldY = B_horz * sind(params[1])
+            fieldZ = params[3] * sin(theta)
+            return fieldX, fieldY, fieldZ
+        self.runFixedRate(field)
 
     def oni_cutting(self):
         #=============================
@@ -592,17 +625,12 @@ class SubThread(QThread):
         # 2 'angleBound1 (deg)'
         # 3 'angleBound2 (deg)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            angle = oscBetween(t,'sin',self.params[0],self.params[2],self.params[3])
-            fieldX = self.params[1] * cosd(angle)
-            fieldY = self.params[1] * sind(angle)
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(0)
-            if self.stopped:
-                return
+        def field(t,params):
+            angle = oscBetween(t,'sin',params[0],params[2],params[3])
+            fieldX = params[1] * cosd(angle)
+            fieldY = params[1] * sind(angle)
+            return fieldX, fieldY, 0
+        self.runFixedRate(field)
 
     def twistField(self):
         ''' credit to Omid '''
@@ -614,27 +642,12 @@ class SubThread(QThread):
         # 3 'PolarAngle (deg)'
         # 4 'SpanAngle (deg)'
         #=============================
-        startTime = time.time()
-        record = 'Time(s), FieldX(mT), FiledY(mT), FieldZ(mT), X(pixel), Y(pixel) \n' # output to a txt file
-        counter = 0
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            fieldX = self.params[1]* ( cosd(self.params[2])*cosd(self.params[3])*cosd(90-self.params[4]*0.5)*cos(2*pi*self.params[0]*t) - sind(self.params[2])*cosd(90-self.params[4]*0.5)*sin(2*pi*self.params[0]*t) + cosd(self.params[2])*sind(self.params[3])*cosd(self.params[4]*0.5));
-            fieldY = self.params[1]* ( sind(self.params[2])*cosd(self.params[3])*cosd(90-self.params[4]*0.5)*cos(2*pi*self.params[0]*t) + cosd(self.params[2])*cosd(90-self.params[4]*0.5)*sin(2*pi*self.params[0]*t) + sind(self.params[2])*sind(self.params[3])*cosd(self.params[4]*0.5));
-            fieldZ = self.params[1]* (-sind(self.params[3])*cosd(90-self.params[4]*0.5)*cos(2*pi*self.params[0]*t) + cosd(self.params[3])*cosd(self.params[4]*0.5));
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-            # save to txt
-            counter += 1
-            if counter > 300:
-                counter = 0
-                record = record + '{:.5f}, {:.2f}, {:.2f}, {:.2f}, {}, {}\n'.format(t,self.field.x,self.field.y,self.field.z,self.vision.agent1.x,self.vision.agent1.y)
-            if self.stopped:
-                text_file = open("Output.txt", "w")
-                text_file.write(record)
-                text_file.close()
-                return
+        def waveform(t,params):
+            fieldX = params[1]* ( cosd(params[2])*cosd(params[3])*cosd(90-params[4]*0.5)*np.cos(2*pi*params[0]*t) - sind(params[2])*cosd(90-params[4]*0.5)*np.sin(2*pi*params[0]*t) + cosd(params[2])*sind(params[3])*cosd(params[4]*0.5));
+            fieldY = params[1]* ( sind(params[2])*cosd(params[3])*cosd(90-params[4]*0.5)*np.cos(2*pi*params[0]*t) + cosd(params[2])*cosd(90-params[4]*0.5)*np.sin(2*pi*params[0]*t) + sind(params[2])*sind(params[3])*cosd(params[4]*0.5));
+            fieldZ = params[1]* (-sind(params[3])*cosd(90-params[4]*0.5)*np.cos(2*pi*params[0]*t) + cosd(params[3])*cosd(params[4]*0.5));
+            return fieldX, fieldY, fieldZ
+        self.runPrecomputed(waveform)
 
     def osc_saw(self):
         #=============================
@@ -645,18 +658,13 @@ class SubThread(QThread):
         # 3 'Azimuthal Angle (deg)'
         # 4 'Polar Angle (deg)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            magnitude = oscBetween(t,'saw',self.params[0],self.params[1],self.params[2])
-            fieldZ = magnitude * sind(self.params[4])
-            fieldX = magnitude * cosd(self.params[4]) * cosd(self.params[3])
-            fieldY = magnitude * cosd(self.params[4]) * sind(self.params[3])
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-            if self.stopped:
-                return
+        def waveform(t,params):
+            magnitude = oscBetweenArray(t,'saw',params[0],params[1],params[2])
+            fieldZ = magnitude * sind(params[4])
+            fieldX = magnitude * cosd(params[4]) * cosd(params[3])
+            fieldY = magnitude * cosd(params[4]) * sind(params[3])
+            return fieldX, fieldY, fieldZ
+        self.runPrecomputed(waveform)
 
     def osc_triangle(self):
         #=============================
@@ -667,18 +675,13 @@ class SubThread(QThread):
         # 3 'Azimuthal Angle (deg)'
         # 4 'Polar Angle (deg)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            magnitude = oscBetween(t,'triangle',self.params[0],self.params[1],self.params[2])
-            fieldZ = magnitude * sind(self.params[4])
-            fieldX = magnitude * cosd(self.params[4]) * cosd(self.params[3])
-            fieldY = magnitude * cosd(self.params[4]) * sind(self.params[3])
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-            if self.stopped:
-                return
+        def waveform(t,params):
+            magnitude = oscBetweenArray(t,'triangle',params[0],params[1],params[2])
+            fieldZ = magnitude * sind(params[4])
+            fieldX = magnitude * cosd(params[4]) * cosd(params[3])
+            fieldY = magnitude * cosd(params[4]) * sind(params[3])
+            return fieldX, fieldY, fieldZ
+        self.runPrecomputed(waveform)
 
     def osc_square(self):
         #=============================
@@ -689,18 +692,13 @@ class SubThread(QThread):
         # 3 'Azimuthal Angle (deg)'
         # 4 'Polar Angle (deg)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            magnitude = oscBetween(t,'square',self.params[0],self.params[1],self.params[2])
-            fieldZ = magnitude * sind(self.params[4])
-            fieldX = magnitude * cosd(self.params[4]) * cosd(self.params[3])
-            fieldY = magnitude * cosd(self.params[4]) * sind(self.params[3])
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-            if self.stopped:
-                return
+        def waveform(t,params):
+            magnitude = oscBetweenArray(t,'square',params[0],params[1],params[2])
+            fieldZ = magnitude * sind(params[4])
+            fieldX = magnitude * cosd(params[4]) * cosd(params[3])
+            fieldY = magnitude * cosd(params[4]) * sind(params[3])
+            return fieldX, fieldY, fieldZ
+        self.runPrecomputed(waveform)
 
     def osc_sin(self):
         #=============================
@@ -711,22 +709,13 @@ class SubThread(QThread):
         # 3 'Azimuthal Angle (deg)'
         # 4 'Polar Angle (deg)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            magnitude = oscBetween(t,'sin',self.params[0],self.params[1],self.params[2])
-            fieldZ = magnitude * sind(self.params[4])
-            fieldX = magnitude * cosd(self.params[4]) * cosd(self.params[3])
-            fieldY = magnitude * cosd(self.params[4]) * sind(self.params[3])
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-           
-      
-            # time.sleep(1/2000)  # 控制刷新速率，避免 CPU 飙高
-
-            if self.stopped:
-                return
+        def waveform(t,params):
+            magnitude = oscBetweenArray(t,'sin',params[0],params[1],params[2])
+            fieldZ = magnitude * sind(params[4])
+            fieldX = magnitude * cosd(params[4]) * cosd(params[3])
+            fieldY = magnitude * cosd(params[4]) * sind(params[3])
+            return fieldX, fieldY, fieldZ
+        self.runPrecomputed(waveform)
     def osc_cos(self):
         #=============================
         # reference params
@@ -736,18 +725,13 @@ class SubThread(QThread):
         # 3 'Azimuthal Angle (deg)'
         # 4 'Polar Angle (deg)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            magnitude = oscBetween(t, 'cos', self.params[0], self.params[1], self.params[2])
-            fieldZ = magnitude * sind(self.params[4])
-            fieldX = magnitude * cosd(self.params[4]) * cosd(self.params[3])
-            fieldY = magnitude * cosd(self.params[4]) * sind(self.params[3])
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-            if self.stopped:
-                return
+        def waveform(t,params):
+            magnitude = oscBetweenArray(t, 'cos', params[0], params[1], params[2])
+            fieldZ = magnitude * sind(params[4])
+            fieldX = magnitude * cosd(params[4]) * cosd(params[3])
+            fieldY = magnitude * cosd(params[4]) * sind(params[3])
+            return fieldX, fieldY, fieldZ
+        self.runPrecomputed(waveform)
             
     def setPlotCanvas(self, canvas):
         self.canvas = canvas
@@ -759,17 +743,12 @@ class SubThread(QThread):
         # 0 'Frequency (Hz)'
         # 1 'Magniude (mT)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            theta = 2 * pi * self.params[0] * t
-            fieldX = self.params[1] * cos(theta)
-            fieldY = self.params[2] * sin(theta)
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(0)
-            if self.stopped:
-                return
+        def waveform(t,params):
+            theta = 2 * pi * params[0] * t
+            fieldX = params[1] * np.cos(theta)
+            fieldY = params[2] * np.sin(theta)
+            return fieldX, fieldY, 0
+        self.runPrecomputed(waveform)
 
     def rotateYZ(self):
         #=============================
@@ -777,17 +756,12 @@ class SubThread(QThread):
         # 0 'Frequency (Hz)'
         # 1 'Magniude (mT)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            theta = 2 * pi * self.params[0] * t
-            fieldY = self.params[1] * cos(theta)
-            fieldZ = self.params[2] * sin(theta)
-            self.field.setX(0)
-            self.field.setY(fieldY)
-            self.field.setZ(fieldZ)
-            if self.stopped:
-                return
+        def waveform(t,params):
+            theta = 2 * pi * params[0] * t
+            fieldY = params[1] * np.cos(theta)
+            fieldZ = params[2] * np.sin(theta)
+            return 0, fieldY, fieldZ
+        self.runPrecomputed(waveform)
 
     def rotateXZ(self):
         #=============================
@@ -795,70 +769,39 @@ class SubThread(QThread):
         # 0 'Frequency (Hz)'
         # 1 'Magniude (mT)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            theta = 2 * pi * self.params[0] * t
-            fieldX = self.params[1] * cos(theta)
-            fieldZ = self.params[2] * sin(theta)
-            self.field.setX(fieldX)
-            self.field.setY(0)
-            self.field.setZ(fieldZ)
-            if self.stopped:
-                return
+        def waveform(t,params):
+            theta = 2 * pi * params[0] * t
+            fieldX = params[1] * np.cos(theta)
+            fieldZ = params[2] * np.sin(theta)
+            return fieldX, 0, fieldZ
+        self.runPrecomputed(waveform)
     
     def fromCSV(self):
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        csv_path = os.path.join(base_dir, "data", "waveform.csv")
-
-        df = pd.read_csv(csv_path)
-
-        num_rows = len(df)
-
-        for i in range(num_rows):
-            x1 = df['X1_val'][i]
-            x2 = df['X2_val'][i]
-            y1 = df['Y1_val'][i]
-            y2 = df['Y2_val'][i]
-            z1 = df['Z1_val'][i]
-            z2 = df['Z2_val'][i]
-
-            self.field.dac.s826_aoPin(5, x1 / 4.433)  # X1
-            self.field.dac.s826_aoPin(1, x2 / 5.024)  # X2
-            self.field.dac.s826_aoPin(2, y1 / 5.224)  # Y1
-            self.field.dac.s826_aoPin(6, y2 / 5.224)  # Y2
-            self.field.dac.s826_aoPin(3, z1 / 4.879)  # Z1
-            self.field.dac.s826_aoPin(7, z2 / 5.000)  # Z2
-
-            x = x1 + x2
-            y = y1 + y2
-            z = z1 + z2
-            self.field.x = x
-            self.field.y = y
-            self.field.z = z
-
-         
-            if i < num_rows - 1:
-                dt = df['t'][i+1] - df['t'][i]
-                time.sleep(max(0, dt)) 
-
-            if self.stopped:
-                print("✅ fromCSV thread stopped.")
-                returnI
-
-        print("✅ fromCSV completed")
+        #=============================
+        # reference params
+        # 0 'Rate scale'
+        # 1 'Loop (0/1)'
+        # 2 'Start (s)'
+        #=============================
+        data = loadWaveform(self.csvPath, self.field)
+        player = WaveformPlayer(data, self.field, self.params[0] or 1, bool(self.params[1]))
+        player.seek(self.params[2])
+        self.waveformPlayer = player
+        try:
+            player.play(lambda: self.stopped)
+        finally:
+            self.waveformPlayer = None
+        if player.lateRows:
+            self.statusSignal.emit('fromCSV: {} rows were late'.format(player.lateRows))
+        if self.stopped:
+            print("✅ fromCSV thread stopped.")
+        else:
+            print("✅ fromCSV completed")
 
     def formulaControlledField(self):
-        import math
-        from math import pi, sin, cos
-
         freq = 1
-        start_time = time.time()
-
-        while True:
-            t = time.time() - start_time
-
 
+        def field(t,params):
             x = sin(pi*freq*t)
             # x = 0
             # y = 3 * cos(2 * pi * freq * t + pi / 2)
@@ -872,24 +815,10 @@ class SubThread(QThread):
             z1 = z / 2
             z2 = z / 2
 
-            self.field.dac.s826_aoPin(5, x1 / 4.433)  # X1
-            self.field.dac.s826_aoPin(1, x2 / 5.024)  # X2
-            self.field.dac.s826_aoPin(2, y1 / 5.224)  # Y1
-            self.field.dac.s826_aoPin(6, y2 / 5.224)  # Y2
-            self.field.dac.s826_aoPin(3, z1 / 4.879)  # Z1
-            self.field.dac.s826_aoPin(7, z2 / 5.000)  # Z2
-
-            self.field.x = x
-            self.field.y = y
-            self.field.z = z
-
-  
-
-            time.sleep(1 / 200)
-
-            if self.stopped:
-                print("✅ Formula controlled field stopped.")
-                return
+            # X1, X2, Y1, Y2, Z1, Z2
+            return (x1, x2, y1, y2, z1, z2), x, y, z
+        self.runFixedRate(field,self.field.setCoils)
+        print("✅ Formula controlled field stopped.")
     
     def crawler_walking(self):
         #=============================
@@ -897,25 +826,20 @@ class SubThread(QThread):
         # 0 'Bmax (mT)'
         # 1 'Frequency (Hz)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            bmax = self.params[0]
-            freq = self.params[1]
-            max2 = self.params[2]
+        def field(t,params):
+            bmax = params[0]
+            freq = params[1]
+            max2 = params[2]
             b_0 = (t % (1/freq)) * freq * bmax
             theta = pi + (t % (1/freq)) * freq * pi/4
-            theta2 = 2 * pi * self.params[0] * t
+            theta2 = 2 * pi * params[0] * t
             fieldX = b_0 * cos(theta)
             fieldY = b_0 * max2 * sin(theta)
             # fieldY = b_0 * sin(theta)
             field2 = bmax * sin(theta2)
             # self.field.setX(-max2)
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(0)
-            if self.stopped:
-                return
+            return fieldX, fieldY, 0
+        self.runFixedRate(field)
     
     def xy_angle(self):
         #=============================
@@ -923,16 +847,11 @@ class SubThread(QThread):
         # 0 'Bmax (mT)'
         # 1 'Frequency (Hz)'
         #=============================
-        startTime = time.time()
-        while True:
-            t = time.time() - startTime # elapsed time (sec)
-            magnitude = self.params[0]
-            angle = self.params[1]
+        def field(t,params):
+            magnitude = params[0]
+            angle = params[1]
             fieldX = magnitude * cosd(angle)
             fieldY = magnitude * sind(angle)
-            self.field.setX(fieldX)
-            self.field.setY(fieldY)
-            self.field.setZ(0)
-            if self.stopped:
-                return
+            return fieldX, fieldY, 0
+        self.runFixedRate(field)
         
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""
+=============================================================================
+telemetry.py
+----------------------------------------------------------------------------
+Full-rate log of the field commands.
+FieldManager calls record() for every command it writes to the DAC, from
+whichever thread wrote it (SubThread, GUI), with its lock held, so there is
+one producer at a time. The record goes into preallocated numpy columns used
+as a ring, without a lock or string formatting. A flusher thread copies the
+new rows into a chunk buffer and saves each full chunk as an .npz file with
+one array per column:
+    t          int64     time.perf_counter_ns() of the command
+    field      float32   (3,) commanded field x, y, z (mT)
+    setpoints  uint16    (6,) DAC setpoints X1, X2, Y1, Y2, Z1, Z2
+    agent      float32   (3,) x, y, orientation of the tracked agent (nan if none)
+    agentT     int64     frame timestamp of the agent pose (-1 if none)
+Use load(directory) to read a log back.
+=============================================================================
+"""
+import os
+import glob
+import time
+import threading
+import numpy as np
+
+COLUMNS = ['t', 'field', 'setpoints', 'agent', 'agentT']
+
+class TelemetryRecorder(object):
+    def __init__(self,directory,capacity=1<<16,chunkRows=1<<16,flushInterval=0.5,poseSource=None):
+        '''
+        @param directory: chunk files telemetry_00000.npz, ... are written here
+        @param capacity: rows in the ring. The flusher must empty it within capacity / command rate seconds.
+        @param chunkRows: rows per file
+        @param poseSource: object with an *agentState* attribute (timestamp, x, y, orientation), e.g. a Vision
+        '''
+        self.directory = directory
+        self.capacity = capacity
+        self.chunkRows = chunkRows
+        self.flushInterval = flushInterval
+        self.poseSource = poseSource
+        self.t = np.zeros(capacity,dtype=np.int64)
+        self.field = np.zeros((capacity,3),dtype=np.float32)
+        self.setpoints = np.zeros((capacity,6),dtype=np.uint16)
+        self.agent = np.full((capacity,3),np.nan,dtype=np.float32)
+        self.agentT = np.full(capacity,-1,dtype=np.int64)
+        self.written = 0 # rows recorded; only changed by record()
+        self.flushed = 0 # rows copied by the flusher; only changed by the flusher
+        self.lostRows = 0 # rows overwritten before or while the flusher copied them
+        self.chunks = 0
+        self._chunk = {name: np.empty((chunkRows,) + getattr(self,name).shape[1:],dtype=getattr(self,name).dtype) for name in COLUMNS}
+        self._chunkFill = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    #==============================================================================================
+    # Producer side. Called by FieldManager with its lock held, from every thread that writes the DAC.
+    #==============================================================================================
+    def record(self,setpoints,x,y,z):
+        agentT, ax, ay, orientation = self.poseSource.agentState if self.poseSource is not None else (None, 0, 0, 0)
+        i = self.written % self.capacity
+        self.t[i] = time.perf_counter_ns()
+        self.field[i] = (x,y,z)
+        self.setpoints[i] = setpoints
+        if agentT is not None:
+            self.agent[i] = (ax,ay,orientation)
+            self.agentT[i] = agentT
+        else:
+            self.agent[i] = np.nan
+            self.agentT[i] = -1
+        self.written += 1 # publish the row after it is complete
+
+    #==============================================================================================
+    # Flusher
+    #==============================================================================================
+    def start(self):
+        os.makedirs(self.directory,exist_ok=True)
+        self._thread = threading.Thread(target=self._flushLoop,daemon=True)
+        self._thread.start()
+        print('Telemetry: recording to {}'.format(self.directory))
+
+    def stop(self):
+        ''' Write everything that was recorded and stop the flusher '''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        print('Telemetry: {} rows in {} files, {} lost'.format(self.written - self.lostRows, self.chunks, self.lostRows))
+
+    def _flushLoop(self):
+        while not self._stopped.wait(self.flushInterval):
+            self._collect()
+        self._collect()
+        self._saveChunk()
+
+    def _collect(self):
+        written = self.written
+        if written - self.flushed > self.capacity:
+            self.lostRows += written - self.flushed - self.capacity
+            self.flushed = written - self.capacity
+        while self.flushed < written:
+            i = self.flushed % self.capacity
+            n = min(written - self.flushed, self.capacity - i, self.chunkRows - self._chunkFill)
+            for name in COLUMNS:
+                self._chunk[name][self._chunkFill:self._chunkFill + n] = getattr(self,name)[i:i + n]
+            # the producer may have lapped the ring during the copy. Rows from before
+            # written - capacity + 1 were overwritten, or are being overwritten, and are dropped.
+            torn = min(max(self.written - self.capacity + 1 - self.flushed, 0), n)
+            if torn:
+                fill = self._chunkFill
+                for name in COLUMNS:
+                    self._chunk[name][fill:fill + n - torn] = self._chunk[name][fill + torn:fill + n].copy()
+                self.lostRows += torn
+            self._chunkFill += n - torn
+            self.flushed += n
+            if self._chunkFill == self.chunkRows:
+                self._saveChunk()
+
+    def _saveChunk(self):
+        if self._chunkFill == 0:
+            return
+        path = os.path.join(self.directory,'telemetry_{:05d}.npz'.format(self.chunks))
+        np.savez(path,**{name: self._chunk[name][:self._chunkFill] for name in COLUMNS})
+        self.chunks += 1
+        self._chunkFill = 0
+
+#=============================================================================================
+# Read a log written by TelemetryRecorder. Returns a dict of columns.
+#=============================================================================================
+def load(directory):
+    files = sorted(glob.glob(os.path.join(directory,'telemetry_*.npz')))
+    parts = [np.load(f) for f in files]
+    return {name: np.concatenate([p[name] for p in parts]) if parts else np.zeros(0) for name in COLUMNS}
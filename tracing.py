@@ -0,0 +1,186 @@
+"""
+=============================================================================
+tracing.py
+----------------------------------------------------------------------------
+Latency of the stages between the camera and the DAC.
+Code at a stage boundary calls
+    tracing.record('vision.detection', start)       # start = perf_counter_ns()
+and the time since *start* is added to the histogram of the stage. Stage
+names are grouped by the part before the dot. Frames are stamped with the
+perf_counter_ns() of their grab, so stages like 'frame.processed' measure
+from the grab to that point.
+
+A histogram has 8 bins per power of two of nanoseconds (percentiles are
+accurate to 1/8 of their value), so recording is a few integer operations
+and the memory does not grow. Each thread records into histograms of its
+own, which are merged when they are read, so recording takes no lock. report() gives count, p50, p95, p99 and max
+per stage; dump() writes them with the bins to a JSON file.
+Set COIL_TRACING=0 to turn recording off.
+
+Stages
+    frame.published   grab -> frame in the camera triple buffer (CameraThread)
+    frame.dequeued    grab -> taken by the VisionWorker
+    frame.detected    grab -> agentState updated (Vision.process_frame)
+    frame.processed   grab -> processed frame published by the VisionWorker
+    frame.displayed   grab -> shown in the CameraWindow
+    frame.fused       grab -> pose fused (closedLoop.DetectionWaiter)
+    frame.command     pose -> command of the control law
+    frame.dac         pose -> first DAC write of that command
+    camera.convert    pylon ImageFormatConverter
+    vision.*          stages of Vision.process_frame
+    dac.write         one write of the coil setpoints (FieldManager)
+=============================================================================
+"""
+import os
+import time
+import json
+import threading
+
+ENABLED = os.environ.get('COIL_TRACING', '1') != '0'
+SUB_BITS = 3 # 2**SUB_BITS bins per power of two
+NUM_BINS = (65 - SUB_BITS) << SUB_BITS
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * NUM_BINS
+        self.count = 0
+        self.max = 0
+
+    def add(self,ns):
+        if ns < 0:
+            ns = 0
+        shift = ns.bit_length() - SUB_BITS - 1
+        if shift <= 0:
+            i = ns # exact below 2**(SUB_BITS+1)
+        else:
+            i = ((shift + 1) << SUB_BITS) + ((ns >> shift) & ((1 << SUB_BITS) - 1))
+        self.counts[i] += 1
+        self.count += 1
+        if ns > self.max:
+            self.max = ns
+
+    def merge(self,other):
+        ''' Add the counts of *other* to this histogram '''
+        self.counts = [a + b for a, b in zip(self.counts,other.counts)]
+        self.count += other.count
+        self.max = max(self.max,other.max)
+
+    @staticmethod
+    def upperBound(i):
+        ''' Largest value (ns) that falls into bin *i* '''
+        if i < 2 << SUB_BITS:
+            return i
+        shift = (i >> SUB_BITS) - 1
+        return ((((1 << SUB_BITS) | (i & ((1 << SUB_BITS) - 1))) + 1) << shift) - 1
+
+    def percentile(self,q):
+        if self.count == 0:
+            return 0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.upperBound(i),self.max)
+        return self.max
+
+#=============================================================================================
+# Registry of the stages. A stage such as dac.write is recorded from several threads (SubThread,
+# GUI, waveform engine), so every thread gets its own table of histograms and only adds to it.
+# The lock protects the list of tables; *stages* merges them.
+#=============================================================================================
+class Tracer(object):
+    def __init__(self):
+        self.started = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._tables = [] # one dict stage -> Histogram per thread that recorded since reset()
+        self._generation = 0 # increased by reset(), so that the threads start new tables
+        self._local = threading.local()
+
+    def histogram(self,stage):
+        ''' The histogram of *stage* of the calling thread '''
+        local = self._local
+        if getattr(local,'generation',None) != self._generation:
+            with self._lock:
+                local.table = {}
+                local.generation = self._generation
+                self._tables.append(local.table)
+        histogram = local.table.get(stage)
+        if histogram is None:
+            histogram = local.table[stage] = Histogram()
+        return histogram
+
+    @property
+    def stages(self):
+        ''' dict stage -> Histogram with the samples of all threads '''
+        with self._lock:
+            tables = list(self._tables)
+        merged = {}
+        for table in tables:
+            for stage, histogram in dict(table).items(): # the owner may add a stage meanwhile
+                merged.setdefault(stage,Histogram()).merge(histogram)
+        return merged
+
+    def record(self,stage,start,end=None):
+        ''' Add the time from *start* to *end* (default: now), both perf_counter_ns(), to *stage* '''
+        if end is None:
+            end = time.perf_counter_ns()
+        self.histogram(stage).add(end - start)
+
+    def recordDuration(self,stage,ns):
+        self.histogram(stage).add(ns)
+
+    def reset(self):
+        with self._lock:
+            self._tables = []
+            self._generation += 1
+            self.started = time.perf_counter_ns()
+
+    def summary(self,stages=None):
+        ''' dict stage -> (count, p50, p95, p99, max) in ns '''
+        stages = self.stages if stages is None else stages
+        return {stage: (h.count, h.percentile(50), h.percentile(95), h.percentile(99), h.max)
+                for stage, h in sorted(stages.items())}
+
+    def report(self):
+        lines = ['{:<22}{:>8}{:>9}{:>9}{:>9}{:>9}  ms'.format('stage','count','p50','p95','p99','max')]
+        for stage, (count, p50, p95, p99, pmax) in self.summary().items():
+            lines.append('{:<22}{:>8}{:>9.3f}{:>9.3f}{:>9.3f}{:>9.3f}'.format(
+                stage, count, p50 / 1e6, p95 / 1e6, p99 / 1e6, pmax / 1e6))
+        return '\n'.join(lines)
+
+    def dump(self,path):
+        '''
+        Write the statistics and the histograms to *path* (JSON). The bins of a histogram are
+        listed as [upper bound (ns), count], empty bins are left out.
+        '''
+        stages = self.stages
+        data = {'duration': (time.perf_counter_ns() - self.started) / 1e9, 'stages': {}}
+        for stage, (count, p50, p95, p99, pmax) in self.summary(stages).items():
+            counts = stages[stage].counts
+            data['stages'][stage] = {'count': count, 'p50': p50, 'p95': p95, 'p99': p99, 'max': pmax,
+                                     'bins': [[Histogram.upperBound(i), n] for i, n in enumerate(counts) if n]}
+        with open(path,'w') as f:
+            json.dump(data,f,indent=1)
+        return path
+
+tracer = Tracer()
+
+def record(stage,start,end=None):
+    if ENABLED:
+        tracer.record(stage,start,end)
+
+def recordDuration(stage,ns):
+    if ENABLED:
+        tracer.recordDuration(stage,ns)
+
+if __name__ == "__main__":
+    ''' Print the statistics of a file written by dump(): python tracing.py data/tracing/tracing_....json '''
+    import sys
+    with open(sys.argv[1]) as f:
+        data = json.load(f)
+    print('{:.1f} s'.format(data['duration']))
+    print('{:<22}{:>8}{:>9}{:>9}{:>9}{:>9}  ms'.format('stage','count','p50','p95','p99','max'))
+    for stage, h in data['stages'].items():
+        print('{:<22}{:>8}{:>9.3f}{:>9.3f}{:>9.3f}{:>9.3f}'.format(
+            stage, h['count'], h['p50'] / 1e6, h['p95'] / 1e6, h['p99'] / 1e6, h['max'] / 1e6))
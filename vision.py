@@ -16,13 +16,20 @@ import cv2
 import sys
 import re
 import time
+import threading
 from PyQt5.QtCore import QThread, pyqtSignal
-from pydc1394 import Camera
 import filterlib
 import drawing
 import objectDetection
 from objectDetection import Agent
-from pypylon import pylon
+from frameBuffer import TripleBuffer
+from recorder import VideoRecorder, SnapshotWriter
+from frameStore import FrameStoreWriter, FRAMES_PER_SEGMENT
+import tracing
+try:
+    from pypylon import pylon
+except ImportError:
+    pylon = None # Pylon SDK is not installed. CameraThread will report an error when started.
 import numpy as np
 import traceback  
 import datetime
@@ -40,12 +47,39 @@ def showClickedCoordinate(event,x,y,flags,param):
 
 
 
+#=============================================================================================
+# Downscale *frame* into *buffer* (TripleBuffer) to fit *size* (width, height), keeping the
+# aspect ratio, and publish it. Used to prepare frames for display outside the GUI thread.
+#=============================================================================================
+def publishScaled(buffer, frame, size, timestamp=0, meta=None):
+    height, width = frame.shape[:2]
+    scale = min(size[0] / width, size[1] / height, 1)
+    dsize = (max(int(width * scale), 1), max(int(height * scale), 1))
+    dst = buffer.writeBuffer((dsize[1], dsize[0]) + frame.shape[2:], frame.dtype)
+    cv2.resize(frame, dsize, dst=dst, interpolation=cv2.INTER_AREA)
+    buffer.publish(timestamp, meta)
+
+#=============================================================================================
+# Shape of the unconverted frames of an 8-bit pixel format, or None if it is not known.
+# The raw capture creates its first segment with it before the first frame arrives.
+#=============================================================================================
+def rawFrameShape(pixelFormat, height, width):
+    if pixelFormat in ('Mono8', 'BayerRG8', 'BayerBG8', 'BayerGR8', 'BayerGB8'):
+        return (height, width)
+    if pixelFormat in ('RGB8', 'BGR8', 'RGB8Packed', 'BGR8Packed'):
+        return (height, width, 3)
+    return None
+
 #=============================================================================================
 # Camera Thread to handle Basler Pylon Camera in a separate thread
 #=============================================================================================
 class CameraThread(QThread):
-  
-    frame_ready = pyqtSignal(object)  
+    '''
+    Grabbed frames are copied into *frames* (full resolution) and, scaled to the size set with
+    setDisplaySize(), into *displayFrames*. Both are triple buffers, so only the frame id is sent
+    with frame_ready and readers always get the latest frame.
+    '''
+    frame_ready = pyqtSignal(int) # frame id
 
     def __init__(self, camera_index):
         super(CameraThread, self).__init__()
@@ -53,6 +87,13 @@ class CameraThread(QThread):
         self.camera = None
         self.converter = None
         self.camera_index = camera_index  
+        self.frames = TripleBuffer()
+        self.displayFrames = TripleBuffer()
+        self.displaySize = None # (width, height) of the widget that shows the frames
+        self.rawCapture = None # frameStore.FrameStoreWriter that receives every grabbed frame
+
+    def setDisplaySize(self, width, height):
+        self.displaySize = (width, height)
 
     def run(self):
        
@@ -88,15 +129,28 @@ class CameraThread(QThread):
                     continue
                 
                 
+                timestamp = time.perf_counter_ns()
+                hardwareTimestamp = grabResult.GetTimeStamp() # camera clock
+                rawCapture = self.rawCapture
+                if rawCapture is not None:
+                    # the unconverted camera buffer (Bayer/mono) is stored
+                    with grabResult.GetArrayZeroCopy() as raw:
+                        rawCapture.append(raw, timestamp, hardwareTimestamp)
+                convertStart = time.perf_counter_ns()
                 image = self.converter.Convert(grabResult)
-                frame = image.GetArray()
+                grabResult.Release()
+                tracing.record('camera.convert', convertStart)
+                with image.GetArrayZeroCopy() as src:
+                    frame = self.frames.writeBuffer(src.shape, src.dtype)
+                    np.copyto(frame, src)
                 
                 # print(f"📷 Camera {self.camera_index} frame shape: {frame.shape}")
 
-                if self.frame_ready:
-                    # print(f"✅ Emitting frame from Camera {self.camera_index}")  # ✅ 确保触发
-                    self.frame_ready.emit(frame)
-                grabResult.Release()
+                if self.displaySize is not None:
+                    publishScaled(self.displayFrames, frame, self.displaySize, timestamp, hardwareTimestamp)
+                frameId = self.frames.publish(timestamp, hardwareTimestamp)
+                tracing.record('frame.published', timestamp)
+                self.frame_ready.emit(frameId)
 
         except Exception as e:
             print(f"❌ Camera {self.camera_index} error: {e}")
@@ -117,6 +171,63 @@ class CameraThread(QThread):
         print(f"✅ Camera {self.camera_index} stopped successfully")
 
 
+#=============================================================================================
+# Runs Vision.process_frame() on the frames of one CameraThread in a separate thread.
+# It always takes the latest frame, so frames are dropped instead of queued when processing
+# is slower than the camera, and the latency stays below one processing time.
+# Has the display interface of CameraThread (frame_ready, displayFrames, setDisplaySize), so the
+# processed frames can be shown in place of the raw ones. Only the scaled display copy is kept.
+#=============================================================================================
+class VisionWorker(QThread):
+
+    frame_ready = pyqtSignal(int) # frame id of the camera frame that was processed
+
+    def __init__(self, vision, cameraThread):
+        super(VisionWorker, self).__init__()
+        self.vision = vision
+        self.cameraThread = cameraThread
+        vision.camera_thread = cameraThread
+        self.running = False
+        self.displayFrames = TripleBuffer()
+        self.displaySize = None
+        self.framesProcessed = 0
+
+    def setDisplaySize(self, width, height):
+        self.displaySize = (width, height)
+
+    def framesDropped(self):
+        ''' Camera frames that were replaced by a newer one before they could be processed '''
+        return self.cameraThread.frames.framesDropped
+
+    def run(self):
+        self.running = True
+        while self.running:
+            frame, info = self.cameraThread.frames.read(timeout=0.1)
+            if frame is None:
+                continue
+            frameId, timestamp, hardwareTimestamp = info
+            tracing.record('frame.dequeued', timestamp)
+            try:
+                # the camera thread does not write into *frame* until the next read()
+                processed = self.vision.process_frame(frame, timestamp, hardwareTimestamp)
+            except Exception:
+                traceback.print_exc()
+                continue
+            if self.displaySize is not None:
+                publishScaled(self.displayFrames, processed, self.displaySize, timestamp, hardwareTimestamp)
+            tracing.record('frame.processed', timestamp)
+            self.framesProcessed += 1
+            self.frame_ready.emit(frameId)
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+#=============================================================================================
+# Notified by every Vision after it updated agentState, so that a controller can wait for
+# new detections of any camera instead of polling (see closedLoop.DetectionWaiter).
+#=============================================================================================
+detectionCondition = threading.Condition()
 
 class Vision(object):
     def __init__(self,index,type, guid=0000000000000000,buffersize=10):
@@ -129,7 +240,7 @@ class Vision(object):
         self._isSnapshotEnabled = False
         self._detectionAlgorithm = ''
         self.camera_thread = None
-        self.filterRouting = [] # data structure: {"filterName", "args"}, defined in the GUI text editor
+        self.filterRouting = [] # list of filterlib.CompiledFilter, defined in the GUI text editor
         # self._camera_index = camera_index  
 
 
@@ -137,38 +248,58 @@ class Vision(object):
         # Pass them to *processObjectDetection()*
         self.agent1 = Agent()
         self.agent2 = Agent()
+        # (frame timestamp, x, y, orientation) of agent1, replaced as a whole after each detection
+        # so that another thread never sees a position from one frame and a time from another
+        self.agentState = (None, 0, 0, 0)
 
         # drawings
         self.drawingRouting = [] # data structure: {"drawingName", "args"}, defined in Subthread
 
         # video writing
         self._isVideoWritingEnabled = False
-        self.videoWriter =  None
+        self.videoWriter =  None # recorder.VideoRecorder
+        self.snapshotWriter = SnapshotWriter()
 
 
 
-    def process_frame(self, frame):
- 
+    def process_frame(self, frame, timestamp=None, hardwareTimestamp=None):
+        '''
+        Run filters, object detection, drawings, snapshot and video writing on *frame*.
+        @param timestamp: time.perf_counter_ns() at which the frame was grabbed. It is stored with the agent state.
+        @param hardwareTimestamp: camera timestamp of the frame, used in snapshot file names
+        '''
         if not self._isFilterBypassed and self.filterRouting:
-            frame = self.processFilters(frame.copy())
+            start = time.perf_counter_ns()
+            frame = self.processFilters(frame) # the filters write into their own buffers
+            tracing.record('vision.filters', start)
 
         if self._isObjectDetectionEnabled:
+            start = time.perf_counter_ns()
             frame = self.processObjectDetection(frame, frame)
+            self.agentState = (timestamp, self.agent1.x, self.agent1.y, self.agent1.orientation)
+            with detectionCondition:
+                detectionCondition.notify_all()
+            tracing.record('vision.detection', start)
+            if timestamp is not None:
+                tracing.record('frame.detected', timestamp)
 
         if self.isDrawingEnabled():
+            start = time.perf_counter_ns()
             frame = self.processDrawings(frame)
+            tracing.record('vision.drawings', start)
 
         if self.isSnapshotEnabled():
-            snapshot_frame = frame.copy()
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"snapshot_{timestamp}.png"
-            cv2.imwrite(filename, filterlib.color(snapshot_frame))
-            print(f"✅ snapshot: {filename}")
+            start = time.perf_counter()
+            filename = self.snapshotWriter.save(frame, self._id, hardwareTimestamp) # written in the background
+            print(f"snapshot queued: {filename} ({(time.perf_counter() - start) * 1e3:.2f} ms in the frame loop)")
             self.setStateSnapshotEnabled(False)
 
        
-        if self.isVideoWritingEnabled() and self.videoWriter is not None:
-            self.videoWriter.write(filterlib.color(frame))
+        videoWriter = self.videoWriter # may be stopped from another thread
+        if self.isVideoWritingEnabled() and videoWriter is not None:
+            start = time.perf_counter_ns()
+            videoWriter.write(frame, timestamp) # queued; encoded in the recorder thread
+            tracing.record('vision.videoWrite', start)
 
 
 
@@ -224,6 +355,10 @@ class Vision(object):
     def setVideoWritingEnabled(self,state):
         self._isVideoWritingEnabled = state
 
+    def setSnapshotFormat(self,fileFormat,pngCompression=1):
+        ''' 'png' with compression level 0-9 or 'npy' '''
+        self.snapshotWriter.setFormat(fileFormat,pngCompression)
+
     def setStateSnapshotEnabled(self,state):
 
         self._isSnapshotEnabled = state
@@ -234,25 +369,61 @@ class Vision(object):
     #==============================================================================================
     # Video recording
     #==============================================================================================
-    def createVideoWriter(self,fileName):
-        self.videoWriter = cv2.VideoWriter(fileName,fourcc=cv2.VideoWriter_fourcc(*'XVID'),fps=30.0,frameSize=(640,480),isColor=True)
+    def createVideoWriter(self,fileName,fps=30.0):
+        self.videoWriter = VideoRecorder(fileName,fps=fps)
 
-    def startRecording(self,fileName):
-        self.createVideoWriter(fileName)
+    def startRecording(self,fileName,fps=30.0):
+        if self.videoWriter is not None:
+            self.stopRecording()
+        self.createVideoWriter(fileName,fps)
         self.setVideoWritingEnabled(True)
         print('Start recording' + fileName)
 
     def stopRecording(self):
-        self.setStateSnapshotEnabled(False)
-        self.videoWriter.release()
+        self.setVideoWritingEnabled(False)
+        videoWriter, self.videoWriter = self.videoWriter, None
+        if videoWriter is not None:
+            videoWriter.stop() # waits until the queued frames are encoded
         print('Stop recording.')
 
+    #==============================================================================================
+    # Raw capture
+    # Every frame of the camera is stored without compression by the camera thread,
+    # including the frames that are dropped by the processing. See frameStore.py.
+    #==============================================================================================
+    def startRawCapture(self,directory,framesPerSegment=FRAMES_PER_SEGMENT,maxSegments=None):
+        if self.camera_thread is None:
+            print('❌ CamID:{} raw capture needs a camera thread'.format(self._id))
+            return
+        self.stopRawCapture()
+        pixelFormat = ''
+        frameShape = None
+        camera = self.camera_thread.camera
+        if camera is not None:
+            pixelFormat = camera.PixelFormat.GetValue()
+            frameShape = rawFrameShape(pixelFormat,camera.Height.GetValue(),camera.Width.GetValue())
+        try:
+            writer = FrameStoreWriter(directory,framesPerSegment,maxSegments,pixelFormat,frameShape,np.uint8)
+        except FileExistsError as e:
+            print('❌ CamID:{} {}'.format(self._id,e))
+            return
+        self.camera_thread.rawCapture = writer
+        print('Start raw capture ' + directory)
+
+    def stopRawCapture(self):
+        if self.camera_thread is None or self.camera_thread.rawCapture is None:
+            return
+        writer, self.camera_thread.rawCapture = self.camera_thread.rawCapture, None
+        writer.close()
+        print('Stop raw capture. {} frames'.format(writer.framesWritten))
+
     #==============================================================================================
     # <Filters>
     # Define the filters in filterlib.py
     #==============================================================================================
     def createFilterRouting(self,text):
-        self.filterRouting = []
+        ''' Compile the lines of the editor into filters. The args are parsed here, not per frame. '''
+        routing = []
         for line in text:
             line = line.split('//')[0]  # strip after //
             line = line.strip()         # strip spaces at both ends
@@ -261,14 +432,23 @@ class Vision(object):
                 name = match.group('function')
                 args = match.group('args')
                 args = re.sub(r'\s+', '', args) # strip spaces in args
-                self.filterRouting.append({'filterName': name, 'args': args})
+                stage = filterlib.compileFilter(name,args)
+                if stage is not None:
+                    routing.append(stage)
+        self.filterRouting = routing # replaced as a whole; the worker thread may be running the old one
 
     def processFilters(self,image):
-        for item in self.filterRouting:
-            image = getattr(filterlib,item['filterName'],filterlib.filterNotDefined)(image,item['args'])
+        for stage in self.filterRouting:
+            image = stage(image)
         # You can add custom filters here if you don't want to use the editor
         return image
 
+    def filterTimingReport(self):
+        ''' Time spent in each filter since the routing was created '''
+        lines = ['CamID:{} filters'.format(self._id)]
+        lines += ['    ' + stage.report() for stage in self.filterRouting]
+        return '\n'.join(lines)
+
     #==============================================================================================
     # <object detection>
     # Object detection algorithm is executed after all the filters
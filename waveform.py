@@ -0,0 +1,115 @@
+"""
+=============================================================================
+waveform.py
+----------------------------------------------------------------------------
+Precomputed periodic waveforms.
+One period of a waveform is evaluated with numpy into a table of DAC
+setpoints for the six coils. The output loop only looks up the row that
+belongs to the current phase, so no trigonometry runs at the update rate.
+
+When the params change, a new table is built in a background thread and
+replaces the current one at the next period boundary.
+=============================================================================
+"""
+import threading
+import numpy as np
+
+MAX_SAMPLES = 1<<20 # upper limit of the number of samples per period
+
+#=============================================================================================
+# One period of a waveform
+#=============================================================================================
+class WaveformTable(object):
+    def __init__(self,setpoints,fields,period):
+        '''
+        @param setpoints: (N,6) coil setpoints in the order X1, X2, Y1, Y2, Z1, Z2
+        @param fields: (N,3) field (x,y,z) in mT of each sample
+        @param period: duration of the table (s)
+        '''
+        self.setpoints = setpoints
+        self.fields = fields
+        self.period = period
+        self.size = len(setpoints)
+        self.samplesPerSecond = self.size / period
+
+#=============================================================================================
+# Builds tables from a waveform function and plays them back
+#=============================================================================================
+class WaveformEngine(object):
+    def __init__(self,waveform,field,sampleRate,params,frequencyParam=0):
+        '''
+        @param waveform: waveform(t,params) returns the field (x,y,z) in mT for an array of times t (s).
+                         Scalars are allowed for constant components.
+        @param field: instance of FieldManager, used to convert mT to setpoints
+        @param sampleRate: number of samples per second in the table, normally the update rate of the output loop
+        @param params: list of params. It is read again whenever a rebuild is requested.
+        @param frequencyParam: index of the param that holds the frequency (Hz) of the waveform
+        '''
+        self.waveform = waveform
+        self.field = field
+        self.sampleRate = sampleRate
+        self.params = params
+        self.frequencyParam = frequencyParam
+        self.table = self.build(list(params))
+        self.tableStart = 0 # time at which the current table started (s)
+        self.rebuilds = 0
+        self._pending = None # newest table from the builder, swapped under _pendingLock
+        self._pendingLock = threading.Lock()
+        self._rebuildRequested = threading.Event()
+        self._stopped = False
+        self._builder = threading.Thread(target=self._buildLoop,daemon=True)
+        self._builder.start()
+
+    def build(self,params):
+        frequency = abs(params[self.frequencyParam])
+        if frequency == 0:
+            period = 1 / self.sampleRate # constant field: one sample
+        else:
+            period = 1 / frequency
+        n = int(min(max(round(period * self.sampleRate),1),MAX_SAMPLES))
+        t = np.arange(n) * (period / n)
+        fields = np.column_stack([np.broadcast_to(np.asarray(v,dtype=float),t.shape) for v in self.waveform(t,params)])
+        setpoints = self.field.toCoilSetpoints(fields)
+        return WaveformTable(setpoints,fields,period)
+
+    #==============================================================================================
+    # Rebuild in the background thread
+    #==============================================================================================
+    def requestRebuild(self):
+        self._rebuildRequested.set()
+
+    def stop(self):
+        self._stopped = True
+        self._rebuildRequested.set()
+        self._builder.join()
+
+    def _buildLoop(self):
+        while True:
+            self._rebuildRequested.wait()
+            self._rebuildRequested.clear()
+            if self._stopped:
+                return
+            table = self.build(list(self.params))
+            with self._pendingLock:
+                self._pending = table
+
+    #==============================================================================================
+    # Look up the sample at time t (s). Called from the output loop; t must not decrease.
+    # A new table is swapped in when the current one has played a full period.
+    #==============================================================================================
+    def sample(self,t):
+        table = self.table
+        elapsed = t - self.tableStart
+        if elapsed >= table.period:
+            self.tableStart += table.period * (elapsed // table.period)
+            if self._pending is not None:
+                with self._pendingLock:
+                    pending, self._pending = self._pending, None
+                table = self.table = pending
+                self.rebuilds += 1
+            elapsed = t - self.tableStart
+            if elapsed >= table.period: # the new table is shorter than the time since the boundary
+                self.tableStart += table.period * (elapsed // table.period)
+                elapsed = t - self.tableStart
+        i = min(int(elapsed * table.samplesPerSecond),table.size - 1)
+        return table.setpoints[i], table.fields[i]
@@ -0,0 +1,208 @@
+"""
+=============================================================================
+waveformPlayer.py
+----------------------------------------------------------------------------
+Plays waveform files of arbitrary length.
+A CSV file in the format
+    t, X1_val, X2_val, Y1_val, Y2_val, Z1_val, Z2_val
+is converted once, in chunks, into a binary .npy file that holds the time
+and the precomputed DAC setpoints of every row. The .npy file is memory
+mapped for playback and read chunk by chunk, so it never has to fit in RAM.
+
+Compiled files are cached in data/cache, keyed by the hash of the CSV file
+and of the calibration (data/calibration.json and DAC ranges), so they are
+rebuilt automatically when either of them changes.
+
+Each row is scheduled against an absolute start time, so timing errors do
+not pile up over long recordings.
+=============================================================================
+"""
+import os
+import time
+import bisect
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+from scheduler import waitUntil, NS_PER_S
+
+COIL_COLUMNS = ['X1_val', 'X2_val', 'Y1_val', 'Y2_val', 'Z1_val', 'Z2_val']
+WAVEFORM_DTYPE = np.dtype([('t', '<f8'), ('setpoints', '<u2', (6,)), ('field', '<f4', (3,))])
+CSV_CHUNK_ROWS = 100000
+PLAY_CHUNK_ROWS = 65536
+MIN_LOOP_PERIOD = 1e-3 # s, a loop of a file whose rows all have the same t still waits this long
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cache')
+CACHE_VERSION = 1 # increase when the compiled format changes
+_loadedKeys = set() # cache files loaded by this process; they may still be memory mapped
+
+#=============================================================================================
+# CSV -> .npy conversion
+#=============================================================================================
+def countRows(csvPath):
+    ''' Number of data rows (excluding the header) '''
+    n = 0
+    with open(csvPath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            n += block.count(b'\n')
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            n += 1 # last line without a line break
+    return n - 1
+
+def compileCSV(csvPath, npyPath, field):
+    '''
+    Convert *csvPath* into *npyPath* (WAVEFORM_DTYPE).
+    The per-coil values (mT) are converted to setpoints with *field* (FieldManager).
+    '''
+    data = np.lib.format.open_memmap(npyPath + '.tmp', mode='w+', dtype=WAVEFORM_DTYPE, shape=(countRows(csvPath),))
+    i = 0
+    for chunk in pd.read_csv(csvPath, chunksize=CSV_CHUNK_ROWS, skipinitialspace=True):
+        coils = chunk[COIL_COLUMNS].to_numpy(dtype=float)
+        rows = data[i:i + len(chunk)]
+        rows['t'] = chunk['t'].to_numpy(dtype=float)
+        rows['setpoints'] = field.coilsToSetpoints(coils)
+        rows['field'] = coils[:, 0::2] + coils[:, 1::2] # X1 + X2, Y1 + Y2, Z1 + Z2
+        i += len(chunk)
+    data.flush()
+    del data
+    os.replace(npyPath + '.tmp', npyPath)
+
+#=============================================================================================
+# Cache of compiled waveforms
+# index.json remembers the content hash of each CSV file together with its size and
+# modification time, so that an unchanged file does not have to be hashed again.
+#=============================================================================================
+def hashFile(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _loadIndex():
+    try:
+        with open(os.path.join(CACHE_DIR, 'index.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _saveIndex(index):
+    path = os.path.join(CACHE_DIR, 'index.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def cacheKey(csvPath, field, index):
+    csvPath = os.path.abspath(csvPath)
+    stat = os.stat(csvPath)
+    entry = index.get(csvPath)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        contentHash = entry['hash']
+    else:
+        contentHash = hashFile(csvPath)
+    h = hashlib.sha1()
+    h.update(repr((CACHE_VERSION, WAVEFORM_DTYPE.descr, contentHash, field.calibration())).encode())
+    return h.hexdigest(), {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': contentHash}
+
+def loadWaveform(csvPath, field):
+    '''
+    Return the memory-mapped compiled waveform of *csvPath*.
+    It is compiled if the cache does not hold a file for the current CSV content and calibration.
+    '''
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    index = _loadIndex()
+    key, entry = cacheKey(csvPath, field, index)
+    npyPath = os.path.join(CACHE_DIR, key + '.npy')
+    if not os.path.exists(npyPath):
+        print('Compiling waveform {}'.format(csvPath))
+        compileCSV(csvPath, npyPath, field)
+    previous = index.get(os.path.abspath(csvPath), {}).get('key')
+    entry['key'] = key
+    index[os.path.abspath(csvPath)] = entry
+    _saveIndex(index)
+    # the previous file is stale unless another CSV with the same content uses it or it is still mapped
+    stale = os.path.join(CACHE_DIR, '{}.npy'.format(previous))
+    if (previous and previous != key and previous not in _loadedKeys and os.path.exists(stale)
+            and all(other.get('key') != previous for other in index.values())):
+        os.remove(stale)
+    _loadedKeys.add(key)
+    return np.load(npyPath, mmap_mode='r')
+
+
+#=============================================================================================
+# Playback
+#=============================================================================================
+class WaveformPlayer(object):
+    def __init__(self, data, field, rateScale=1.0, loop=False):
+        '''
+        @param data: compiled waveform (WAVEFORM_DTYPE), usually memory mapped
+        @param field: instance of FieldManager
+        @param rateScale: playback speed. 2 plays twice as fast.
+        @param loop: start again from the beginning at the end of the file
+        '''
+        self.data = data
+        self.field = field
+        self.rateScale = rateScale
+        self.loop = loop
+        self.position = 0 # index of the next row
+        self.lateRows = 0 # rows that were written after their scheduled time had passed the next row
+        self.seekPosition = None # the last position passed to seek()
+        self._seekTo = None
+        self._anchor = None # (perf_counter_ns, waveform time) used to schedule the rows
+
+    def duration(self):
+        if len(self.data) == 0:
+            return 0
+        return self.data['t'][-1] - self.data['t'][0]
+
+    #==============================================================================================
+    # Can be called from another thread while playing
+    #==============================================================================================
+    def seek(self, seconds):
+        ''' Jump to *seconds* after the first row '''
+        self.seekPosition = seconds
+        self._seekTo = seconds
+
+    def setRateScale(self, rateScale):
+        if rateScale > 0:
+            self.rateScale = rateScale
+            self._anchor = None # re-anchor at the next row
+
+    #==============================================================================================
+    # Play until the end (or forever if loop is set) or until isStopped() returns True
+    #==============================================================================================
+    def play(self, isStopped):
+        n = len(self.data)
+        if n == 0:
+            return
+        # the last row is held for the median row interval before looping
+        tail = float(np.median(np.diff(self.data['t'][:1000]))) if n > 1 else 0
+        period = max(self.data['t'][-1] - self.data['t'][0] + tail, MIN_LOOP_PERIOD)
+        loopOffset = 0 # waveform time added every time the file starts again
+        setCoilSetpoints = self.field.setCoilSetpoints
+        while not isStopped():
+            if self._seekTo is not None:
+                # binary search on the memory-mapped column only touches a few pages
+                self.position = bisect.bisect_left(self.data['t'], self.data['t'][0] + self._seekTo)
+                self._seekTo = None
+                self._anchor = None
+            if self.position >= n:
+                if not self.loop:
+                    return
+                loopOffset += period
+                self.position = 0
+            chunk = np.array(self.data[self.position:self.position + PLAY_CHUNK_ROWS]) # one read from the file
+            times = (chunk['t'] + loopOffset).tolist()
+            setpoints = chunk['setpoints']
+            fields = chunk['field'].tolist()
+            for k in range(len(chunk)):
+                if self._anchor is None:
+                    self._anchor = (time.perf_counter_ns(), times[k])
+                anchorNs, anchorT = self._anchor
+                waitUntil(anchorNs + int((times[k] - anchorT) / self.rateScale * NS_PER_S))
+                setCoilSetpoints(setpoints[k], *fields[k])
+                self.position += 1
+                if k + 1 < len(chunk) and time.perf_counter_ns() > anchorNs + (times[k + 1] - anchorT) / self.rateScale * NS_PER_S:
+                    self.lateRows += 1
+                if isStopped() or self._seekTo is not None:
+                    break